@@ -0,0 +1,262 @@
+#!/usr/bin/env python3
+"""
+fusion_align.py - Coarse-to-Fine Image Registration
+
+fusion_main.fusion() only resizes image 2 to the size of image 1, so captures
+that are slightly shifted or rotated against each other (hand-held shots,
+restoration inputs, focus stacks) fuse with ghosted edges. This module
+estimates the motion between the two images and warps image 2 onto image 1
+before the transform.
+
+Estimation never runs at full resolution:
+
+1. Both images are converted to grayscale and shrunk to at most MAX_SIZE
+   pixels on the long side, then reduced further with pyrDown until the
+   coarsest level is about COARSE_SIZE pixels.
+2. Phase correlation on the coarsest level gives a starting translation,
+   which copes with shifts too large for ECC alone.
+3. ECC (cv2.findTransformECC) refines the chosen motion model level by
+   level, from coarse to fine, each level starting from the previous one.
+4. The estimate is rescaled to full resolution and image 2 is warped once,
+   which also takes care of any size difference.
+
+So the cost of alignment depends on MAX_SIZE, not on the image size, and is
+a small fraction of the fusion itself on large images.
+
+If the images do not correlate well enough once aligned (below
+MIN_CORRELATION, as with different modalities such as CT and MRI, whose
+intensities do not match), the estimate is not trusted and image 2 is only
+resized, as without alignment.
+
+Motion models:
+    - 'translation': Shift only
+    - 'euclidean': Shift and rotation
+    - 'affine': Shift, rotation, scale and shear
+    - 'homography': Full perspective transform (e.g. a hand-held camera
+      turned slightly between shots of a flat scene)
+
+Usage:
+    python3 fusion_align.py demo/rose1.png moved.png aligned.png --motion affine
+
+Example:
+    import fusion_main as fuse
+    fuse.fusion("shot1.jpg", "shot2.jpg", align='euclidean')
+
+    import fusion_align
+    aligned, matrix = fusion_align.align(I1, I2, 'homography')
+"""
+
+import argparse
+import sys
+
+import cv2
+import numpy as np
+
+
+# Motion models understood by estimateTransform()
+MOTIONS = ('translation', 'euclidean', 'affine', 'homography')
+
+_ECC_MOTIONS = {
+    'translation': cv2.MOTION_TRANSLATION,
+    'euclidean': cv2.MOTION_EUCLIDEAN,
+    'affine': cv2.MOTION_AFFINE,
+    'homography': cv2.MOTION_HOMOGRAPHY,
+}
+
+# Long side, in pixels, of the finest level used for estimation
+MAX_SIZE = 512
+
+# Long side, in pixels, below which the pyramid stops
+COARSE_SIZE = 64
+
+# ECC stopping criteria per level: iterations and change of the warp
+ECC_ITERATIONS = 50
+ECC_EPS = 1e-4
+
+# Lowest ECC correlation, on the finest level, at which an estimate is used
+MIN_CORRELATION = 0.8
+
+
+def _gray(image):
+    """Return `image` as a float32 grayscale image."""
+    if image.ndim == 3:
+        image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    return image.astype(np.float32)
+
+
+def _scaling(fromShape, toShape):
+    """
+    Return the 3x3 matrix taking pixel coordinates of an image of
+    `fromShape` to those of the same image resized to `toShape`.
+
+    cv2.resize aligns pixel centers, hence the half-pixel terms.
+    """
+    sy = toShape[0] / fromShape[0]
+    sx = toShape[1] / fromShape[1]
+    return np.array([[sx, 0, 0.5 * sx - 0.5],
+                     [0, sy, 0.5 * sy - 0.5],
+                     [0, 0, 1]])
+
+
+def _pyramid(gray, size):
+    """Shrink `gray` to `size` (cols, rows), then halve it to COARSE_SIZE.
+
+    Returns the levels, coarsest first.
+    """
+    levels = [cv2.resize(gray, size, interpolation=cv2.INTER_AREA)]
+    while max(levels[-1].shape) > COARSE_SIZE and \
+            min(levels[-1].shape) >= 32:
+        levels.append(cv2.pyrDown(levels[-1]))
+    return levels[::-1]
+
+
+def estimateTransform(reference, moving, motion='affine', maxSize=MAX_SIZE):
+    """
+    Estimate the motion that maps `reference` onto `moving`.
+
+    Args:
+        reference (numpy.ndarray): Image to align to, grayscale or BGR.
+        moving (numpy.ndarray): Image to be aligned. It may differ in size
+            from `reference`.
+        motion (str): One of MOTIONS. Defaults to 'affine'.
+        maxSize (int): Long side, in pixels, of the finest level the
+            estimate is refined on. Larger is more precise and slower.
+
+    Returns:
+        numpy.ndarray: float32 matrix, 2x3 (3x3 for 'homography'), that
+            takes a pixel position in `reference` to the matching
+            position in `moving`, as used by warp(). A plain rescaling
+            if the estimate is rejected (see MIN_CORRELATION).
+
+    Raises:
+        ValueError: If the motion model is unknown.
+    """
+    if motion not in MOTIONS:
+        raise ValueError("Unknown motion model: " + str(motion))
+
+    ref, mov = _gray(reference), _gray(moving)
+    scale = min(1.0, maxSize / max(ref.shape))
+    size = (max(1, int(round(ref.shape[1] * scale))),
+            max(1, int(round(ref.shape[0] * scale))))
+    refs = _pyramid(ref, size)
+    movs = _pyramid(mov, size)
+
+    # A starting shift from phase correlation on the coarsest level
+    window = cv2.createHanningWindow(refs[0].shape[::-1], cv2.CV_32F)
+    (dx, dy), _ = cv2.phaseCorrelate(refs[0], movs[0], window)
+    warpMatrix = np.eye(3, dtype=np.float32)
+    warpMatrix[0, 2], warpMatrix[1, 2] = dx, dy
+
+    criteria = (cv2.TERM_CRITERIA_EPS | cv2.TERM_CRITERIA_COUNT,
+                ECC_ITERATIONS, ECC_EPS)
+    rows = 3 if motion == 'homography' else 2
+    correlation = None
+    for k, (r, m) in enumerate(zip(refs, movs)):
+        if k:
+            # pyrDown halves coordinates: carry the warp one level up
+            warpMatrix[:2, 2] *= 2
+            warpMatrix[2, :2] /= 2
+        try:
+            correlation, found = cv2.findTransformECC(
+                r, m, warpMatrix[:rows].copy(), _ECC_MOTIONS[motion],
+                criteria, None, 5)
+            warpMatrix[:rows] = found
+        except cv2.error:
+            # No convergence on this level (e.g. too little texture):
+            # keep the estimate of the coarser one
+            correlation = None
+    if correlation is None or correlation < MIN_CORRELATION:
+        warpMatrix = np.eye(3, dtype=np.float32)
+
+    # Back to full resolution: reference pixels -> working level ->
+    # moving pixels
+    working = refs[-1].shape
+    full = np.linalg.inv(_scaling(mov.shape, working)) @ warpMatrix @ \
+        _scaling(ref.shape, working)
+    full /= full[2, 2]
+    return full[:rows].astype(np.float32)
+
+
+def warp(image, matrix, shape):
+    """
+    Resample `image` onto the pixel grid of the reference image.
+
+    Args:
+        image (numpy.ndarray): The moving image, grayscale or BGR.
+        matrix (numpy.ndarray): Transform from estimateTransform().
+        shape (tuple): (rows, cols) of the reference image.
+
+    Returns:
+        numpy.ndarray: The warped image, of the given size. Pixels mapped
+            from outside `image` repeat its border.
+    """
+    size = (shape[1], shape[0])
+    flags = cv2.INTER_LINEAR | cv2.WARP_INVERSE_MAP
+    if matrix.shape[0] == 3:
+        return cv2.warpPerspective(image, matrix, size, flags=flags,
+                                   borderMode=cv2.BORDER_REPLICATE)
+    return cv2.warpAffine(image, matrix, size, flags=flags,
+                          borderMode=cv2.BORDER_REPLICATE)
+
+
+def align(reference, moving, motion='affine', maxSize=MAX_SIZE):
+    """
+    Register `moving` to `reference` and warp it into place.
+
+    Args:
+        reference (numpy.ndarray): Image to align to.
+        moving (numpy.ndarray): Image to be aligned, of any size.
+        motion (str): One of MOTIONS. Defaults to 'affine'.
+        maxSize (int): See estimateTransform().
+
+    Returns:
+        tuple: (aligned, matrix) where `aligned` has the size of
+            `reference` and `matrix` is the estimated transform.
+
+    Raises:
+        ValueError: If the motion model is unknown.
+
+    Example:
+        >>> aligned, matrix = align(I1, I2, 'translation')
+        >>> print(matrix[:, 2])  # shift in pixels
+    """
+    matrix = estimateTransform(reference, moving, motion, maxSize)
+    return warp(moving, matrix, reference.shape[:2]), matrix
+
+
+def main(argv=None):
+    """
+    Command line entry point: align one image to another and save it.
+
+    Returns:
+        int: Process exit status.
+    """
+    parser = argparse.ArgumentParser(
+        description="Align an image to a reference image.")
+    parser.add_argument('reference', help="image to align to")
+    parser.add_argument('moving', help="image to align")
+    parser.add_argument('out', help="file to write the aligned image to")
+    parser.add_argument('--motion', choices=MOTIONS, default='affine',
+                        help="motion model (default: affine)")
+    parser.add_argument('--max-size', type=int, default=MAX_SIZE,
+                        help="long side of the finest estimation level "
+                             "(default: %d)" % MAX_SIZE)
+    args = parser.parse_args(argv)
+
+    reference = cv2.imread(args.reference, cv2.IMREAD_COLOR)
+    moving = cv2.imread(args.moving, cv2.IMREAD_COLOR)
+    for path, image in ((args.reference, reference), (args.moving, moving)):
+        if image is None:
+            print("Cannot read image: " + path, file=sys.stderr)
+            return 1
+
+    aligned, matrix = align(reference, moving, args.motion, args.max_size)
+    if not cv2.imwrite(args.out, aligned):
+        print("Cannot write image: " + args.out, file=sys.stderr)
+        return 1
+    print(np.array2string(matrix, precision=4, suppress_small=True))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
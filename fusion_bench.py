@@ -0,0 +1,528 @@
+#!/usr/bin/env python3
+"""
+fusion_bench.py - Reproducible Fusion Benchmarks
+
+This module measures fusion performance on the image pairs shipped in
+demo/ (rose, jug, dol, book, clock, landscape...), upscaled synthetically
+to a fixed set of sizes from 0.5 MP to 100 MP. Every case reports, per
+stage, the wall time and the peak resident memory, plus the overall
+throughput in megapixels per second.
+
+Stages are those reported by fusion_trace.py:
+    read        cv2.imread of both inputs
+    resize      resize of image 2 (only if the sizes differ)
+    convert     conversion to the working color space
+    decompose   forward DWT of both inputs
+    fuse        coefficient fusion
+    reconstruct inverse DWT
+    normalize   conversion to 8 bits
+    write       cv2.imwrite of the result
+
+Upscaled inputs are generated once per run, deterministically (bicubic
+resize of the demo pair), and written as PNG to a scratch directory, so
+`read` measures a real decode. Results go to a JSON file together with the
+library versions and machine they were measured on. The compare mode
+matches the cases of two such files and flags every stage that got slower
+(or used more memory) by more than a threshold.
+
+The imports mode guards cold start: it times `import fusion_main` in fresh
+interpreters and fails if that exceeds a budget or pulls in a GUI,
+plotting or other heavy module.
+
+Usage:
+    python3 fusion_bench.py run --out base.json
+    python3 fusion_bench.py run --sizes 0.5 2 --wavelets db5 haar \\
+        --methods mean max --out new.json
+    python3 fusion_bench.py run --engines dwt pyramid --level 3 --out e.json
+    python3 fusion_bench.py compare base.json new.json --threshold 0.2
+    python3 fusion_bench.py imports --budget 0.3
+"""
+
+import argparse
+import gc
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+
+import cv2
+import numpy as np
+import pywt
+
+import fusion_main as fuse
+import fusion_trace as trace
+from fusion_trace import STAGES
+
+
+# Target input sizes, in megapixels
+DEFAULT_SIZES = (0.5, 2, 8, 32, 100)
+
+# Stage timings below this many seconds are too noisy to flag
+NOISE_FLOOR = 0.01
+
+# Memory growth below this many bytes is too noisy to flag
+MEMORY_FLOOR = 16 * 1024 * 1024
+
+# Seconds `import fusion_main` may take in a fresh interpreter
+IMPORT_BUDGET = 0.3
+
+# Modules the headless core must not load at import time
+HEAVY_MODULES = ('cv2', 'matplotlib', 'PIL', 'PyQt5')
+
+# Run in a fresh interpreter by importTime()
+_IMPORT_PROBE = """
+import json, sys, time
+start = time.perf_counter()
+import %s
+seconds = time.perf_counter() - start
+print(json.dumps({'seconds': seconds, 'loaded': [
+    m for m in %r if m in sys.modules]}))
+"""
+
+
+def demoPairs(directory='demo'):
+    """
+    Find the image pairs in a directory.
+
+    A pair is two files named `<name>1.<ext>` and `<name>2.<ext>`, such
+    as demo/rose1.png and demo/rose2.png.
+
+    Args:
+        directory (str): Directory to search.
+
+    Returns:
+        dict: Pair name -> (path1, path2), e.g. {'rose': (...)}.
+    """
+    firsts = {}
+    seconds = {}
+    for entry in os.listdir(directory):
+        stem, ext = os.path.splitext(entry)
+        if stem.endswith('1'):
+            firsts[stem[:-1]] = os.path.join(directory, entry)
+        elif stem.endswith('2'):
+            seconds[stem[:-1]] = os.path.join(directory, entry)
+    return {name: (firsts[name], seconds[name])
+            for name in sorted(firsts.keys() & seconds.keys())}
+
+
+def scaledShape(shape, megapixels):
+    """
+    Return the (rows, cols) of `shape` scaled to about `megapixels`.
+
+    The aspect ratio is kept.
+    """
+    factor = (megapixels * 1e6 / (shape[0] * shape[1])) ** 0.5
+    return (max(1, int(round(shape[0] * factor))),
+            max(1, int(round(shape[1] * factor))))
+
+
+def _residentBytes():
+    """Return the current resident set size in bytes, or None."""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def _peakResidentBytes():
+    """Return the process's peak resident set size in bytes."""
+    try:
+        import resource
+    except ImportError:
+        return 0
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+class StageRecorder(trace.Tracer):
+    """
+    Tracer that keeps the duration and peak memory of every stage.
+
+    A background thread polls the resident set size every `interval`
+    seconds and keeps the largest value seen for the current stage.
+    Where the current RSS cannot be read (no /proc), each stage gets the
+    process-wide peak so far instead.
+
+    Attributes:
+        stages (dict): Stage name -> {'seconds': float, 'peak_rss': int}.
+    """
+
+    def __init__(self, interval=0.002):
+        trace.Tracer.__init__(self)
+        self.interval = interval
+        self.stages = {}
+        self._peak = 0
+        self._lock = threading.Lock()
+        self._done = threading.Event()
+        self._sampling = _residentBytes() is not None
+        self._thread = None
+        if self._sampling:
+            self._thread = threading.Thread(target=self._sample)
+            self._thread.daemon = True
+            self._thread.start()
+
+    def _sample(self):
+        while not self._done.wait(self.interval):
+            rss = _residentBytes()
+            with self._lock:
+                if rss is not None and rss > self._peak:
+                    self._peak = rss
+
+    def start(self, name):
+        with self._lock:
+            self._peak = (_residentBytes() or 0) if self._sampling else 0
+
+    def emit(self, record):
+        with self._lock:
+            if self._sampling:
+                peak = max(self._peak, _residentBytes() or 0)
+            else:
+                peak = _peakResidentBytes()
+        self.stages[record['stage']] = {
+            'seconds': record['seconds'],
+            'peak_rss': peak,
+        }
+
+    def close(self):
+        """Stop sampling."""
+        trace.Tracer.close(self)
+        self._done.set()
+        if self._thread is not None:
+            self._thread.join()
+
+
+def runCase(img1, img2, out, wavelet='db5', level=1, method='mean',
+            color=False, engine='dwt', threads=1):
+    """
+    Fuse one pair of files with fusion_main.fusion() and measure it.
+
+    Args:
+        img1 (str): First input path.
+        img2 (str): Second input path.
+        out (str): Output path.
+        wavelet (str): Wavelet name.
+        level (int): Number of decomposition levels.
+        method (str or dict): Fuse rule.
+        color (bool): Fuse in color.
+        engine (str): Fusion engine, see fusion_main.ENGINES.
+        threads (int): Threads per fusion, see fusion_parallel.py.
+
+    Returns:
+        dict: Stage name -> {'seconds', 'peak_rss'}.
+
+    Raises:
+        IOError: If an input cannot be read or the output written.
+    """
+    with trace.tracing(StageRecorder()) as recorder:
+        fuse.fusion(img1, img2, out, wavelet, level, method, color=color,
+                    engine=engine, threads=threads)
+    return recorder.stages
+
+
+def environment():
+    """Return the versions and machine a benchmark ran on."""
+    return {
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'pywt': pywt.__version__,
+        'cv2': cv2.__version__,
+        'platform': platform.platform(),
+        'machine': platform.machine(),
+        'cpus': os.cpu_count(),
+    }
+
+
+def runBenchmark(pairs, sizes=DEFAULT_SIZES, wavelets=('db5',),
+                 methods=('mean',), level=1, repeat=3, color=False,
+                 report=None, engines=('dwt',), threads=(1,)):
+    """
+    Run every combination of pair, size, engine, wavelet, fuse method and
+    thread count.
+
+    Each case is run `repeat` times; the fastest run of every stage is
+    kept, which is the most reproducible estimate on a shared machine.
+
+    Args:
+        pairs (dict): Pair name -> (path1, path2), see demoPairs().
+        sizes (sequence): Input sizes in megapixels.
+        wavelets (sequence): Wavelet names.
+        methods (sequence): Fuse rules.
+        level (int): Number of decomposition levels.
+        repeat (int): Runs per case.
+        color (bool): Fuse in color.
+        report (callable, optional): Called with every finished case.
+        engines (sequence): Fusion engines. Wavelets only apply to 'dwt';
+            other engines run once per method with `wavelet` None.
+        threads (sequence): Thread counts per fusion. Comparing 1 with
+            higher counts on one size shows the parallel speed-up.
+
+    Returns:
+        dict: {'environment': ..., 'settings': ..., 'cases': [...]}, where
+            every case holds its parameters, per-stage `stages`, total
+            `seconds`, `mp_per_second` and overall `peak_rss`.
+    """
+    variants = [(engine, wavelet, count) for engine in engines
+                for wavelet in (wavelets if engine == 'dwt' else (None,))
+                for count in (threads if engine == 'dwt' else (1,))]
+    cases = []
+    scratch = tempfile.mkdtemp(prefix='fusion-bench-')
+    try:
+        for name, (path1, path2) in sorted(pairs.items()):
+            base1 = cv2.imread(path1, int(color))
+            base2 = cv2.imread(path2, int(color))
+            if base1 is None or base2 is None:
+                raise IOError("Cannot read demo pair: " + name)
+            for size in sizes:
+                # Synthesize the inputs at this size, deterministically
+                shape = scaledShape(base1.shape, size)
+                img1 = os.path.join(scratch, name + '1.png')
+                img2 = os.path.join(scratch, name + '2.png')
+                for base, path in ((base1, img1), (base2, img2)):
+                    big = cv2.resize(base, shape[::-1],
+                                     interpolation=cv2.INTER_CUBIC)
+                    if not cv2.imwrite(path, big):
+                        raise IOError("Cannot write image: " + path)
+                    del big
+                out = os.path.join(scratch, 'out.png')
+
+                for engine, wavelet, count in variants:
+                    for method in methods:
+                        best = {}
+                        for _ in range(repeat):
+                            gc.collect()
+                            stages = runCase(img1, img2, out, wavelet,
+                                             level, method, color, engine,
+                                             count)
+                            for stage, values in stages.items():
+                                kept = best.get(stage)
+                                if kept is None or \
+                                        values['seconds'] < kept['seconds']:
+                                    best[stage] = values
+                        total = sum(v['seconds'] for v in best.values())
+                        megapixels = shape[0] * shape[1] / 1e6
+                        case = {
+                            'pair': name,
+                            'megapixels': size,
+                            'shape': list(shape),
+                            'engine': engine,
+                            'wavelet': wavelet,
+                            'method': method,
+                            'level': level,
+                            'color': color,
+                            'threads': count,
+                            'stages': best,
+                            'seconds': total,
+                            'mp_per_second': megapixels / total,
+                            'peak_rss': max(v['peak_rss']
+                                            for v in best.values()),
+                        }
+                        cases.append(case)
+                        if report is not None:
+                            report(case)
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+
+    return {
+        'environment': environment(),
+        'settings': {'level': level, 'repeat': repeat, 'color': color},
+        'cases': cases,
+    }
+
+
+def importTime(module='fusion_main', repeat=5):
+    """
+    Time the import of a module in fresh interpreters.
+
+    Args:
+        module (str): Module to import.
+        repeat (int): Number of interpreters to start; the fastest import
+            is reported, as later runs find the files in the OS cache.
+
+    Returns:
+        tuple: (seconds, loaded) where `loaded` lists the HEAVY_MODULES
+            the import pulled in.
+
+    Raises:
+        subprocess.CalledProcessError: If the import fails.
+    """
+    here = os.path.dirname(os.path.abspath(__file__))
+    best = None
+    for _ in range(repeat):
+        output = subprocess.check_output(
+            [sys.executable, '-c', _IMPORT_PROBE % (module, HEAVY_MODULES)],
+            cwd=here)
+        result = json.loads(output.decode().strip().splitlines()[-1])
+        if best is None or result['seconds'] < best['seconds']:
+            best = result
+    return best['seconds'], best['loaded']
+
+
+def caseKey(case):
+    """Return the parameters identifying a case across two runs."""
+    return (case['pair'], case['megapixels'], case.get('engine', 'dwt'),
+            case['wavelet'], json.dumps(case['method'], sort_keys=True),
+            case['level'], case.get('color', False), case.get('threads', 1))
+
+
+def _variant(case):
+    """Return the wavelet name, or the engine for non-wavelet engines,
+    with the thread count if above 1."""
+    name = case['wavelet'] or case.get('engine', 'dwt')
+    if case.get('threads', 1) > 1:
+        name += 'x%d' % case['threads']
+    return name
+
+
+def compareRuns(old, new, threshold=0.2):
+    """
+    Compare two benchmark results and list the regressions.
+
+    A stage regresses if it takes more than `1 + threshold` times as long
+    as before, or if its peak memory grew by more than `threshold`.
+    Differences below NOISE_FLOOR seconds or MEMORY_FLOOR bytes are
+    ignored, since they are within run-to-run noise.
+
+    Args:
+        old (dict): Baseline result of runBenchmark().
+        new (dict): Result to check.
+        threshold (float): Tolerated relative increase.
+
+    Returns:
+        list: One dict per regression with keys case, stage, metric,
+            old, new and ratio. Cases missing from either run are not
+            compared.
+    """
+    baseline = {caseKey(case): case for case in old['cases']}
+    regressions = []
+    for case in new['cases']:
+        before = baseline.get(caseKey(case))
+        if before is None:
+            continue
+        label = "%s %gMP %s %s" % (case['pair'], case['megapixels'],
+                                   _variant(case),
+                                   json.dumps(case['method']))
+        checks = [('total', 'seconds', before['seconds'], case['seconds'])]
+        for stage in STAGES:
+            if stage in case['stages'] and stage in before['stages']:
+                b = before['stages'][stage]
+                n = case['stages'][stage]
+                checks.append((stage, 'seconds', b['seconds'], n['seconds']))
+                checks.append((stage, 'peak_rss', b['peak_rss'],
+                               n['peak_rss']))
+        for stage, metric, b, n in checks:
+            floor = NOISE_FLOOR if metric == 'seconds' else MEMORY_FLOOR
+            if n - b < floor:
+                continue
+            if b > 0 and n > b * (1 + threshold):
+                regressions.append({'case': label, 'stage': stage,
+                                    'metric': metric, 'old': b, 'new': n,
+                                    'ratio': n / b})
+    return regressions
+
+
+def printCase(case):
+    """Print one benchmark case as a single line."""
+    stages = "  ".join("%s %.3f" % (stage, case['stages'][stage]['seconds'])
+                       for stage in STAGES if stage in case['stages'])
+    print("%-10s %6gMP %-7s %-8s %7.3fs %7.2f MP/s %6d MiB | %s" % (
+        case['pair'], case['megapixels'], _variant(case),
+        json.dumps(case['method']), case['seconds'], case['mp_per_second'],
+        case['peak_rss'] >> 20, stages))
+    sys.stdout.flush()
+
+
+def main(argv=None):
+    """
+    Command line entry point.
+
+    Returns:
+        int: Process exit status; for compare, 1 if anything regressed,
+            for imports, 1 if over budget or a heavy module was loaded.
+    """
+    parser = argparse.ArgumentParser(
+        description="Benchmark fusion on upscaled demo pairs.")
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+
+    run = commands.add_parser('run', help="run the benchmark")
+    run.add_argument('--out', required=True, help="JSON result file")
+    run.add_argument('--demo', default='demo',
+                     help="directory with the image pairs (default: demo)")
+    run.add_argument('--pairs', nargs='+',
+                     help="pair names to run (default: all)")
+    run.add_argument('--sizes', type=float, nargs='+',
+                     default=list(DEFAULT_SIZES),
+                     help="input sizes in megapixels")
+    run.add_argument('--wavelets', nargs='+', default=['db5'])
+    run.add_argument('--engines', nargs='+', default=['dwt'],
+                     choices=fuse.ENGINES)
+    run.add_argument('--methods', nargs='+', default=['mean'],
+                     choices=fuse.FUSION_METHODS)
+    run.add_argument('--level', type=int, default=1)
+    run.add_argument('--repeat', type=int, default=3,
+                     help="runs per case, the fastest is kept")
+    run.add_argument('--color', action='store_true')
+    run.add_argument('--threads', type=int, nargs='+', default=[1],
+                     help="threads per fusion, e.g. 1 2 4 8 (default: 1)")
+
+    compare = commands.add_parser('compare',
+                                  help="flag regressions between two runs")
+    compare.add_argument('old', help="baseline JSON result")
+    compare.add_argument('new', help="JSON result to check")
+    compare.add_argument('--threshold', type=float, default=0.2,
+                         help="tolerated relative increase (default: 0.2)")
+
+    imports = commands.add_parser('imports',
+                                  help="check the core's import time")
+    imports.add_argument('--module', default='fusion_main')
+    imports.add_argument('--budget', type=float, default=IMPORT_BUDGET,
+                         help="allowed seconds (default: %g)" % IMPORT_BUDGET)
+    imports.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args(argv)
+
+    if args.command == 'imports':
+        seconds, loaded = importTime(args.module, args.repeat)
+        print("import %s: %.0f ms (budget %.0f ms)" % (
+            args.module, seconds * 1000, args.budget * 1000))
+        if loaded:
+            print("FAIL: heavy modules loaded at import: " + ", ".join(loaded))
+        if seconds > args.budget:
+            print("FAIL: over budget")
+        return 1 if loaded or seconds > args.budget else 0
+
+    if args.command == 'compare':
+        with open(args.old) as f:
+            old = json.load(f)
+        with open(args.new) as f:
+            new = json.load(f)
+        regressions = compareRuns(old, new, args.threshold)
+        for r in regressions:
+            print("REGRESSION  %s  %s %s: %.4g -> %.4g (x%.2f)" % (
+                r['case'], r['stage'], r['metric'], r['old'], r['new'],
+                r['ratio']))
+        print("%d regressions" % len(regressions))
+        return 1 if regressions else 0
+
+    pairs = demoPairs(args.demo)
+    if args.pairs:
+        unknown = set(args.pairs) - set(pairs)
+        if unknown:
+            parser.error("unknown pairs: " + ", ".join(sorted(unknown)))
+        pairs = {name: pairs[name] for name in args.pairs}
+    result = runBenchmark(pairs, args.sizes, args.wavelets, args.methods,
+                          args.level, args.repeat, args.color,
+                          report=printCase, engines=args.engines,
+                          threads=args.threads)
+    with open(args.out, 'w') as f:
+        json.dump(result, f, indent=1)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
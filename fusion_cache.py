@@ -0,0 +1,295 @@
+"""
+fusion_cache.py - LRU Cache of Decoded Images and Wavelet Decompositions
+
+Trying different fuse rules on the same pair repeats the expensive part of
+fusion_main.fusion(): decoding both files, resizing image 2 and running the
+forward DWT. FusionCache keeps those intermediate results in memory, so a
+change of fuse rule only costs the fuse step and the inverse transform.
+
+Entries are keyed by file identity (absolute path, modification time and
+size, or optionally a content hash) plus the parameters that produced
+them, so an edited file is never served stale. The cache is bounded by a
+byte budget and evicts the least recently used entries first.
+
+Example:
+    from fusion_cache import FusionCache
+    import fusion_main as fuse
+
+    cache = FusionCache(maxBytes=1 << 30)
+    for method in ('mean', 'min', 'max'):
+        fuse.fusion("demo/rose1.png", "demo/rose2.png",
+                    out="rose_" + method + ".jpg", method=method,
+                    cache=cache)
+    print(cache.stats())
+"""
+
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
+import cv2
+
+import fusion_main as fuse
+import fusion_trace as trace
+
+
+def fileKey(path, hashContent=False):
+    """
+    Return a key identifying the current content of a file.
+
+    Args:
+        path (str): Path to the file.
+        hashContent (bool): Hash the file bytes instead of trusting the
+            modification time and size. Slower, but survives copies and
+            touch-without-change.
+
+    Returns:
+        tuple: Hashable file identity.
+
+    Raises:
+        IOError: If the file does not exist.
+    """
+    if hashContent:
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                digest.update(chunk)
+        return ('sha256', digest.hexdigest())
+    st = os.stat(path)
+    return (os.path.abspath(path), st.st_mtime_ns, st.st_size)
+
+
+class FusionCache(object):
+    """
+    Size-bounded LRU cache for decoded images and decompositions.
+
+    All methods are thread-safe, so one cache can be shared by GUI
+    workers.
+
+    Attributes:
+        maxBytes (int): Byte budget for all cached arrays.
+        hashContent (bool): Key files by content hash, see fileKey().
+        hits (int): Number of lookups served from the cache.
+        misses (int): Number of lookups that had to compute the value.
+        evictions (int): Number of entries dropped to stay in budget.
+    """
+
+    def __init__(self, maxBytes=512 * 1024 * 1024, hashContent=False):
+        """
+        Args:
+            maxBytes (int): Byte budget. Defaults to 512 MiB.
+            hashContent (bool): Key files by content hash.
+        """
+        self.maxBytes = maxBytes
+        self.hashContent = hashContent
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    @property
+    def currentBytes(self):
+        """int: Bytes currently held by the cache."""
+        return self._bytes
+
+    def get(self, key):
+        """
+        Look up an entry and mark it as recently used.
+
+        Args:
+            key (tuple): Entry key.
+
+        Returns:
+            The cached value, or None if absent.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def _peek(self, key):
+        """Like get(), but without counting a hit or a miss."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            self._entries.move_to_end(key)
+            return entry[0]
+
+    def _requestedShape(self, ident, shape, color):
+        """
+        Return `shape` as a tuple, or None if it is the decoded size.
+
+        A decoded image already of the requested size is cached once,
+        under the key without a size; both image() and decomposition()
+        look it up there.
+        """
+        if shape is None:
+            return None
+        shape = tuple(shape)
+        image = self._peek(('image', ident, None, color))
+        if image is not None and image.shape[:2] == shape:
+            return None
+        return shape
+
+    def put(self, key, value, nbytes):
+        """
+        Store an entry, evicting old ones to stay within the budget.
+
+        Values larger than the whole budget are not stored.
+
+        Args:
+            key (tuple): Entry key.
+            value: Value to cache.
+            nbytes (int): Memory held by `value`.
+        """
+        if nbytes > self.maxBytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= old[1]
+            self._entries[key] = (value, nbytes)
+            self._bytes += nbytes
+            while self._bytes > self.maxBytes:
+                _, (_, size) = self._entries.popitem(last=False)
+                self._bytes -= size
+                self.evictions += 1
+
+    def clear(self):
+        """Drop every entry. Counters are kept."""
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self):
+        """
+        Return the cache counters.
+
+        Returns:
+            dict: entries, bytes, maxBytes, hits, misses and evictions.
+        """
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'maxBytes': self.maxBytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
+
+    def image(self, path, shape=None, color=False):
+        """
+        Return a file decoded in grayscale, optionally resized.
+
+        Args:
+            path (str): Image file path.
+            shape (tuple, optional): (rows, cols) to resize to.
+            color (bool): Decode as 3-channel BGR instead.
+
+        Returns:
+            numpy.ndarray: uint8 image. Treat it as read-only.
+
+        Raises:
+            IOError: If the image cannot be read.
+        """
+        ident = fileKey(path, self.hashContent)
+        shape = self._requestedShape(ident, shape, color)
+        key = ('image', ident, shape, color)
+        # One counted lookup per call; the decoded image a resize starts
+        # from is fetched with _peek()
+        image = self.get(key)
+        if image is not None:
+            return image
+
+        baseKey = ('image', ident, None, color)
+        if shape is not None:
+            image = self._peek(baseKey)
+        if image is None:
+            with trace.stage('read') as st:
+                image = cv2.imread(path, int(color))
+                if image is None:
+                    raise IOError("Cannot read image: " + path)
+                st.output(image)
+            image.flags.writeable = False
+            self.put(baseKey, image, image.nbytes)
+        # An image already of that size is served by the entry without a
+        # size; a second entry would count its bytes twice
+        if shape is not None and image.shape[:2] != shape:
+            with trace.stage('resize', image) as st:
+                image = cv2.resize(image, shape[::-1])
+                st.output(image)
+            image.flags.writeable = False
+            self.put(key, image, image.nbytes)
+        return image
+
+    def decomposition(self, path, wavelet='db5', level=1, shape=None,
+                      color=False):
+        """
+        Return the packed wavelet decomposition of an image file.
+
+        Args:
+            path (str): Image file path.
+            wavelet (str): Wavelet name.
+            level (int): Number of decomposition levels.
+            shape (tuple, optional): (rows, cols) to resize the image to
+                before decomposing.
+            color (bool): Decompose the YCrCb channel stack instead of
+                grayscale, see fusion_main.fuseArrays().
+
+        Returns:
+            tuple: (coeffs, slices, shape) where `coeffs` and `slices` are
+                as returned by fusion_main.decompose() and `shape` is the
+                decomposed image's (rows, cols). Treat `coeffs` as
+                read-only.
+        """
+        ident = fileKey(path, self.hashContent)
+        key = ('dwt', ident, self._requestedShape(ident, shape, color),
+               wavelet, level, color)
+        entry = self.get(key)
+        if entry is None:
+            image = self.image(path, shape, color)
+            with trace.stage('decompose', image) as st:
+                coeffs, slices = fuse.decompose(
+                    fuse.toWorkingSpace(image, color), wavelet, level)
+                st.output(coeffs)
+            coeffs.flags.writeable = False
+            entry = (coeffs, slices, image.shape[:2])
+            self.put(key, entry, coeffs.nbytes)
+        return entry
+
+    def fuse(self, img1, img2, wavelet='db5', level=1, method='mean',
+             progress=None, color=False):
+        """
+        Fuse two image files, reusing cached decompositions.
+
+        Args:
+            img1 (str): File path to the first input image.
+            img2 (str): File path to the second input image, resized to
+                the first.
+            wavelet (str): Wavelet name.
+            level (int): Number of decomposition levels.
+            method (str or dict): Fuse rule, see fusion_main.fusion().
+            progress (callable, optional): Stage callback, see
+                fusion_main.fuseArrays().
+            color (bool): Fuse in color, see fusion_main.fuseArrays().
+
+        Returns:
+            numpy.ndarray: Fused uint8 image.
+        """
+        if progress is not None:
+            progress('decompose')
+        coeffs1, slices, shape = self.decomposition(img1, wavelet, level,
+                                                    color=color)
+        coeffs2, _, _ = self.decomposition(img2, wavelet, level, shape,
+                                           color)
+        return fuse.fuseDecomposed(coeffs1, coeffs2, slices, shape, wavelet,
+                                   method, progress, inPlace=False)
@@ -8,8 +8,9 @@ coefficients and combining them using various fusion methods.
 The fusion algorithm:
 1. Loads two input images in grayscale
 2. Resizes the second image to match the first
-3. Applies 2D DWT to decompose images into frequency components
-4. Fuses the wavelet coefficients (approximation and detail)
+3. Applies a multi-level 2D DWT to decompose images into frequency
+   components, packing all levels into one contiguous array
+4. Fuses the wavelet coefficients (approximation and detail) in place
 5. Reconstructs the fused image using inverse DWT
 6. Normalizes and saves the output
 
@@ -17,18 +18,69 @@ Example:
     import fusion_main as fuse
     result = fuse.fusion("image1.png", "image2.png")
     print(f"Fused image saved to: {result}")
+
+    # Or, for images already in memory:
+    fused = fuse.fuseArrays(array1, array2)
 """
 
+import os
+import threading
+
 import pywt
 import numpy as np
-import matplotlib.pyplot as plt
-import random
-from PIL import Image
-from PIL import ImageFilter
-import cv2
+
+import fusion_trace as trace
+
+# OpenCV is only needed for file I/O, resizing, color conversion and the
+# region methods, so it is imported where it is used. Importing this module
+# then costs little more than numpy and pywt, which matters to short-lived
+# workers; once loaded, a repeated `import cv2` is a dictionary lookup.
+
+
+# Coefficient fusion methods understood by fuseCoeff()
+FUSION_METHODS = ('mean', 'min', 'max', 'maxabs', 'energy', 'variance',
+                  'consistency')
+
+# Methods that compare neighbourhoods instead of single coefficients. They
+# must be applied to one subband at a time, see fuseBands().
+REGION_METHODS = ('energy', 'variance', 'consistency')
+
+# Default neighbourhood edge length, in coefficients, of the region methods
+REGION_WINDOW = 3
+
+# Fusion engines: the wavelet transform of this module, the Laplacian
+# pyramid of fusion_pyramid.py, or 'auto' for the fastest one.
+# `fusion_bench.py run --engines dwt pyramid` measured the pyramid 5-10x
+# faster than db5 (and 4-5x faster than haar) at every size from 0.05 to
+# 8 MP, levels 1 and 3. There is no crossover, so 'auto' is an alias for
+# 'pyramid'; re-measure before making it depend on the image size.
+ENGINES = ('dwt', 'pyramid', 'auto')
+
+# Floating point precisions the DWT engine can work in. float32 halves the
+# memory of every coefficient array and is plenty for 8-bit images.
+PRECISIONS = ('float64', 'float32')
+
+
+def _localMean(values, window):
+    """
+    Average `values` over a window x window neighbourhood.
+
+    cv2.boxFilter keeps running sums, so the cost per coefficient does not
+    depend on the window size. Subbands of a periodized transform are
+    periodic, so they are padded by wrapping around, which also keeps
+    tiled fusion (fusion_tiled.py) identical to whole-image fusion.
+    """
+    import cv2
+    if values.ndim == 3:
+        return np.stack([_localMean(plane, window) for plane in values])
+    r = window // 2
+    if r == 0:
+        return values
+    padded = np.pad(values, r, mode='wrap')
+    return cv2.boxFilter(padded, -1, (window, window))[r:-r, r:-r]
 
 
-def fuseCoeff(coef1, coef2, method):
+def fuseCoeff(coef1, coef2, method, out=None, window=REGION_WINDOW):
     """
     Fuse two sets of wavelet coefficients using the specified method.
 
@@ -43,117 +95,829 @@ def fuseCoeff(coef1, coef2, method):
             - 'mean': Average of both coefficients (balanced fusion)
             - 'min': Minimum value (reduces noise, may lose detail)
             - 'max': Maximum value (preserves edges, may increase noise)
+            - 'maxabs': Coefficient with the larger magnitude (strongest
+              edge, whatever its sign)
+            - 'energy': Coefficient whose neighbourhood has the larger
+              mean energy (sharp like 'maxabs', far less noisy)
+            - 'variance': Coefficient whose neighbourhood has the larger
+              variance
+            - 'consistency': 'maxabs' followed by a majority vote over
+              the neighbourhood, so isolated noisy picks are reverted
+              (consistency verification)
+            The last three are region methods: apply them to a single
+            subband, as fuseBands() does, not to a packed array.
+        out (numpy.ndarray, optional): Array to write the result to. May
+            be `coef1` itself to fuse in place without a temporary.
+        window (int): Neighbourhood edge length of the region methods.
 
     Returns:
-        numpy.ndarray: Fused coefficients, or empty list if invalid method.
+        numpy.ndarray: Fused coefficients.
+
+    Raises:
+        ValueError: If `method` is not one of FUSION_METHODS.
 
     Example:
         >>> fused = fuseCoeff(cA1, cA2, 'mean')
+        >>> fuseCoeff(cA1, cA2, 'max', out=cA1)  # in place
+        >>> fuseCoeff(cH1, cH2, 'energy', window=5)
     """
     if method == 'mean':
-        coef = (coef1 + coef2) / 2
+        coef = np.add(coef1, coef2, out=out)
+        coef *= 0.5
+        return coef
     elif method == 'min':
-        coef = np.minimum(coef1, coef2)
+        return np.minimum(coef1, coef2, out=out)
     elif method == 'max':
-        coef = np.maximum(coef1, coef2)
+        return np.maximum(coef1, coef2, out=out)
+    elif method == 'maxabs':
+        take1 = np.abs(coef1) >= np.abs(coef2)
+    elif method == 'energy':
+        take1 = (_localMean(np.square(coef1), window) >=
+                 _localMean(np.square(coef2), window))
+    elif method == 'variance':
+        # var = E[c^2] - E[c]^2, both from box filters
+        var1 = _localMean(np.square(coef1), window)
+        var1 -= np.square(_localMean(coef1, window))
+        var2 = _localMean(np.square(coef2), window)
+        var2 -= np.square(_localMean(coef2, window))
+        take1 = var1 >= var2
+    elif method == 'consistency':
+        votes = (np.abs(coef1) >= np.abs(coef2)).astype(coef1.dtype)
+        take1 = _localMean(votes, window) > 0.5
+    else:
+        raise ValueError("Unknown fusion method: " + str(method))
+
+    # Selection: start from coef1, then take coef2 where it won
+    if out is None:
+        return np.where(take1, coef1, coef2)
+    if out is not coef1:
+        out[...] = coef1
+    np.copyto(out, coef2, where=~take1)
+    return out
+
+
+def bandMethods(method):
+    """
+    Split a fuse rule into its approximation and detail methods.
+
+    Args:
+        method (str or dict): A single method for every band, or a dict
+            with keys 'approx' and 'detail', e.g.
+            {'approx': 'mean', 'detail': 'max'}. For color fusion the
+            dict may also name a 'chroma' method, see chromaMethod(), and
+            for region methods a 'window' size, see regionWindow().
+
+    Returns:
+        tuple: (approx_method, detail_method).
+
+    Raises:
+        ValueError: If a method is unknown.
+    """
+    if isinstance(method, dict):
+        approx = method.get('approx', 'mean')
+        detail = method.get('detail', 'mean')
+    else:
+        approx = detail = method
+    for m in (approx, detail):
+        if m not in FUSION_METHODS:
+            raise ValueError("Unknown fusion method: " + str(m))
+    return approx, detail
+
+
+def chromaMethod(method):
+    """
+    Return the method used for the chroma channels in color fusion.
+
+    Chroma carries little detail, so it is fused with the cheap 'mean'
+    rule unless the fuse rule dict names a 'chroma' method.
+
+    Args:
+        method (str or dict): Fuse rule, see bandMethods().
+
+    Returns:
+        str: One of FUSION_METHODS.
+
+    Raises:
+        ValueError: If the chroma method is unknown.
+    """
+    chroma = method.get('chroma', 'mean') if isinstance(method, dict) \
+        else 'mean'
+    if chroma not in FUSION_METHODS:
+        raise ValueError("Unknown fusion method: " + str(chroma))
+    return chroma
+
+
+def regionWindow(method):
+    """
+    Return the neighbourhood size used by the region methods.
+
+    Args:
+        method (str or dict): Fuse rule, see bandMethods().
+
+    Returns:
+        int: The rule's 'window' entry, or REGION_WINDOW.
+
+    Raises:
+        ValueError: If the window is not a positive odd integer.
+    """
+    window = method.get('window', REGION_WINDOW) \
+        if isinstance(method, dict) else REGION_WINDOW
+    if not isinstance(window, int) or window < 1 or window % 2 == 0:
+        raise ValueError("Region window must be a positive odd integer: "
+                         + str(window))
+    return window
+
+
+def workingDtype(precision):
+    """
+    Return the numpy dtype of a precision name.
+
+    Args:
+        precision (str): One of PRECISIONS.
+
+    Returns:
+        numpy.dtype: The matching float dtype.
+
+    Raises:
+        ValueError: If the precision is unknown.
+    """
+    if precision not in PRECISIONS:
+        raise ValueError("Unknown precision: " + str(precision))
+    return np.dtype(precision)
+
+
+class FusionWorkspace(object):
+    """
+    Buffers reused by repeated fusions of same-sized images.
+
+    Each fusion otherwise allocates two packed coefficient arrays (plus a
+    third when fusing out of place) and frees them again. Passed to
+    fuseArrays() or fusion(), a workspace keeps those arrays between
+    calls and the transform writes into them, so a long run of same-sized
+    pairs allocates them once. A buffer is only reallocated when the size,
+    wavelet, level or precision changes.
+
+    A workspace must not be shared between threads running fusions at the
+    same time: give every worker its own.
+
+    Example:
+        >>> ws = FusionWorkspace()
+        >>> for frame1, frame2 in pairs:
+        ...     out = fuseArrays(frame1, frame2, precision='float32',
+        ...                      workspace=ws)
+    """
+
+    def __init__(self):
+        self._layouts = {}
+        self._arrays = {}
+
+    def decompose(self, name, image, wavelet, level, dtype):
+        """
+        Run decompose() into the buffer called `name`.
+
+        Args:
+            name (str): Buffer name, one per simultaneously live result.
+            image (numpy.ndarray): 2D image or plane stack.
+            wavelet (str): Wavelet name.
+            level (int): Number of decomposition levels.
+            dtype (numpy.dtype): Working precision.
+
+        Returns:
+            tuple: (coeffs, slices) as returned by decompose(); `coeffs`
+                is overwritten by the next call with the same name.
+        """
+        key = (image.shape, wavelet, level, dtype)
+        entry = self._layouts.get(name)
+        layout = entry[1] if entry is not None and entry[0] == key else None
+        layout = decompose(image, wavelet, level, dtype, out=layout)
+        self._layouts[name] = (key, layout)
+        return layout
+
+    def array(self, name, shape, dtype):
+        """
+        Return the uninitialized buffer called `name`.
+
+        Args:
+            name (str): Buffer name.
+            shape (tuple): Array shape.
+            dtype (numpy.dtype): Array dtype.
+
+        Returns:
+            numpy.ndarray: A buffer of that shape and dtype, reused when
+                the previous one with this name matches.
+        """
+        buf = self._arrays.get(name)
+        if buf is None or buf.shape != shape or buf.dtype != dtype:
+            buf = self._arrays[name] = np.empty(shape, dtype)
+        return buf
+
+    @property
+    def nbytes(self):
+        """Total size of the buffers held, in bytes."""
+        total = sum(a.nbytes for a in self._arrays.values())
+        return total + sum(layout[0].nbytes
+                           for _, layout in self._layouts.values())
+
+    def clear(self):
+        """Release all buffers."""
+        self._layouts.clear()
+        self._arrays.clear()
+
+
+def decompose(image, wavelet='db5', level=1, dtype=None, out=None):
+    """
+    Apply a multi-level 2D DWT and pack all levels into one array.
+
+    The approximation of the deepest level sits in the top left corner of
+    the returned array, surrounded by the detail bands of every level,
+    as laid out by pywt.coeffs_to_array().
+
+    A 3D (channels, rows, cols) image is transformed as one stack over its
+    last two axes, so all channels go through a single pywt call and
+    share one packed array, one contiguous plane per channel.
+
+    Args:
+        image (numpy.ndarray): 2D grayscale image, or 3D channel stack.
+        wavelet (str): Wavelet name. Defaults to 'db5'.
+        level (int): Number of decomposition levels. Defaults to 1.
+        dtype (numpy.dtype, optional): Float dtype to transform in. pywt
+            keeps float32 input in float32; anything else, including
+            8-bit images, is transformed in float64 by default.
+        out (tuple, optional): (coeffs, slices) returned by an earlier
+            call with the same image shape, wavelet, level and dtype. The
+            new coefficients are written into `coeffs` instead of a new
+            array.
+
+    Returns:
+        tuple: (coeffs, slices) where `coeffs` is a contiguous float
+            array and `slices` locates every band inside it.
+    """
+    if dtype is not None and image.dtype != dtype:
+        image = image.astype(dtype)
+    coeffs = pywt.wavedec2(image, wavelet, mode='periodization', level=level)
+    if out is None:
+        return pywt.coeffs_to_array(coeffs, axes=(-2, -1))
+
+    # array_to_coeffs() returns views into the packed array: fill them
+    packed, slices = out
+    views = pywt.array_to_coeffs(packed, slices, output_format='wavedec2')
+    views[0][...] = coeffs[0]
+    for bands, details in zip(views[1:], coeffs[1:]):
+        for band, detail in zip(bands, details):
+            band[...] = detail
+    return out
+
+
+def reconstruct(coeffs, slices, wavelet='db5'):
+    """
+    Invert decompose().
+
+    Args:
+        coeffs (numpy.ndarray): Packed coefficient array.
+        slices (list): Band locations returned by decompose().
+        wavelet (str): Wavelet name used for the decomposition.
+
+    Returns:
+        numpy.ndarray: Reconstructed image (float), 2D or channel stack.
+    """
+    bands = pywt.array_to_coeffs(coeffs, slices, output_format='wavedec2')
+    return pywt.waverec2(bands, wavelet, mode='periodization')
+
+
+def fuseBands(coeffs1, coeffs2, slices, method='mean', out=None):
+    """
+    Fuse two packed coefficient arrays, in place by default.
+
+    When the approximation and detail methods agree, the whole array is
+    fused by a single vectorized call. Otherwise only the small deepest
+    approximation band is fused separately. Region methods look at
+    neighbourhoods, so they are run once per subband instead.
+
+    For color decompositions (luma plane followed by two chroma planes)
+    the fuse rule applies to luma, and both chroma planes are fused
+    together with the cheaper chromaMethod(). If every rule agrees, the
+    whole stack is still fused in one call.
+
+    Args:
+        coeffs1 (numpy.ndarray): Packed coefficients of image 1.
+        coeffs2 (numpy.ndarray): Packed coefficients of image 2.
+        slices (list): Band locations returned by decompose().
+        method (str or dict): Fuse rule, see bandMethods().
+        out (numpy.ndarray, optional): Array receiving the result.
+            Defaults to `coeffs1`; pass a separate array to keep both
+            inputs intact, e.g. when they are cached.
+
+    Returns:
+        numpy.ndarray: `out`, now holding the fused coefficients.
+    """
+    if out is None:
+        out = coeffs1
+    approx, detail = bandMethods(method)
+    window = regionWindow(method)
+    if coeffs1.ndim == 3:
+        chroma = chromaMethod(method)
+        if approx == detail == chroma and chroma not in REGION_METHODS:
+            return fuseCoeff(coeffs1, coeffs2, chroma, out=out)
+        if chroma in REGION_METHODS:
+            rule = {'approx': chroma, 'detail': chroma, 'window': window}
+            for c in (1, 2):
+                fuseBands(coeffs1[c], coeffs2[c], slices, rule, out=out[c])
+        else:
+            fuseCoeff(coeffs1[1:], coeffs2[1:], chroma, out=out[1:])
+        fuseBands(coeffs1[0], coeffs2[0], slices, method, out=out[0])
+        return out
+
+    if approx == detail and detail not in REGION_METHODS:
+        return fuseCoeff(coeffs1, coeffs2, detail, out=out)
+
+    band = slices[0][-2:]
+    fusedApprox = fuseCoeff(coeffs1[band], coeffs2[band], approx,
+                            window=window)
+    if detail in REGION_METHODS:
+        # Neighbourhoods must not straddle two subbands, so every detail
+        # band is fused on its own. Bands beyond a partial array (such as
+        # a preview block) are skipped.
+        for level in slices[1:]:
+            for key in ('da', 'ad', 'dd'):
+                sub = level[key][-2:]
+                if coeffs1[sub].size:
+                    fuseCoeff(coeffs1[sub], coeffs2[sub], detail,
+                              out=out[sub], window=window)
     else:
-        coef = []
+        fuseCoeff(coeffs1, coeffs2, detail, out=out)
+    out[band] = fusedApprox
+    return out
+
+
+def selectEngine(engine, shape):
+    """
+    Resolve an engine name for images of a given size.
+
+    'auto' is currently an alias for 'pyramid', which benchmarks found
+    faster at every image size (see ENGINES); `shape` is accepted so
+    callers need not change if a size crossover appears.
+
+    Args:
+        engine (str): One of ENGINES.
+        shape (tuple): (rows, cols) of the images.
+
+    Returns:
+        str: 'dwt' or 'pyramid'.
+
+    Raises:
+        ValueError: If the engine is unknown.
+    """
+    if engine == 'auto':
+        return 'pyramid'
+    if engine not in ENGINES:
+        raise ValueError("Unknown fusion engine: " + str(engine))
+    return engine
 
-    return coef
 
+def fuseArrays(I1, I2, wavelet='db5', level=1, method='mean', progress=None,
+               color=False, engine='dwt', precision='float64', workspace=None,
+               align=None, threads=1):
+    """
+    Fuse two images held in memory.
+
+    This is the pure-array core of fusion(): no files are read or
+    written, so frames that are already decoded (from a camera, a video
+    or another library) can be fused directly.
+
+    Args:
+        I1 (numpy.ndarray): First image, 2D grayscale or 3-channel BGR.
+        I2 (numpy.ndarray): Second image. It is resized to the size of
+            `I1` if the two differ.
+        wavelet (str): Wavelet name. Defaults to 'db5'.
+        level (int): Number of decomposition levels. Defaults to 1.
+        method (str or dict): Fuse rule, see fusion().
+        progress (callable, optional): Called with the name of each stage
+            ('decompose', 'fuse', 'reconstruct', 'normalize') as it
+            starts. An exception raised by it aborts the fusion, which
+            lets callers cancel a running fusion between stages.
+        color (bool): Fuse in color. Both images are converted to YCrCb
+            and transformed as one plane stack; the fuse rule applies
+            to luma (Y) and chroma (Cr, Cb) uses chromaMethod().
+        engine (str): 'dwt' for the wavelet transform, 'pyramid' for the
+            Laplacian pyramid of fusion_pyramid.py (faster; `wavelet` is
+            ignored), or 'auto', currently an alias for 'pyramid' (see
+            selectEngine()).
+        precision (str): 'float64', or 'float32' to halve the memory of
+            the DWT engine; the pyramid engine always works in float32.
+        workspace (FusionWorkspace, optional): Buffers to reuse across
+            calls, see FusionWorkspace. The returned image is never one
+            of them.
+        align (str, optional): Motion model ('translation', 'euclidean',
+            'affine' or 'homography') to register `I2` to `I1` with
+            before fusing, see fusion_align.py. `I2` is then warped
+            instead of resized.
+        threads (int): Number of threads for the 'dwt' engine. Above 1,
+            both inputs are converted and decomposed at once and the
+            fuse, inverse transform and normalization are split into
+            bands (see fusion_parallel.py); the result is identical.
+
+    Returns:
+        numpy.ndarray: Fused uint8 image with the size of `I1`, 2D
+            grayscale or, with `color`, 3-channel BGR.
+
+    Raises:
+        ValueError: If the fuse rule, engine, precision or motion model
+            is unknown.
 
-def fusion(img1, img2):
+    Example:
+        >>> frame = fuseArrays(visible, thermal, level=2)
+    """
+    # Get dimensions of first image and resize second image to match
+    # This ensures both images have the same size for coefficient fusion
+    x = I1.shape[:2]
+    engine = selectEngine(engine, x)
+    dtype = workingDtype(precision)
+    par = None
+    if threads > 1 and engine == 'dwt':
+        import fusion_parallel
+        par = fusion_parallel.Parallel(threads)
+    if align is not None:
+        import fusion_align
+        with trace.stage('align', I1, I2) as st:
+            I2, _ = fusion_align.align(I1, I2, align)
+            st.output(I2)
+    elif I2.shape[:2] != x:
+        import cv2
+        with trace.stage('resize', I2) as st:
+            invX = x[::-1]  # Reverse dimensions for cv2.resize (width, height)
+            I2 = cv2.resize(I2, invX)
+            st.output(I2)
+
+    # Bring both images to the working color space: grayscale, or a
+    # luma/chroma (YCrCb) plane stack for color fusion
+    with trace.stage('convert', I1, I2) as st:
+        if par is None:
+            I1 = toWorkingSpace(I1, color)
+            I2 = toWorkingSpace(I2, color)
+        else:
+            I1, I2 = par.pair(toWorkingSpace, (I1, color), (I2, color))
+        st.output(I1, I2)
+
+    # Averaging commutes with the linear, perfectly reconstructing DWT (and
+    # pyramid), so chroma fused by 'mean' needs no transform at all; only
+    # luma is then decomposed and color costs little more than grayscale
+    chroma = None
+    if color and chromaMethod(method) == 'mean':
+        chroma = np.add(I1[1:], I2[1:], dtype=dtype)
+        chroma *= 0.5
+        I1, I2 = I1[0], I2[0]
+
+    # Apply multi-level 2D Discrete Wavelet Transform
+    # All levels of each image are packed into one contiguous array:
+    # the approximation (cA) of the deepest level plus the horizontal,
+    # vertical and diagonal details (cH, cV, cD) of every level
+    if progress is not None:
+        progress('decompose')
+    if engine == 'pyramid':
+        import fusion_pyramid as pyramid
+        with trace.stage('decompose', I1, I2) as st:
+            layers1 = pyramid.decompose(I1, level)
+            layers2 = pyramid.decompose(I2, level)
+            st.output(*layers1)
+        return pyramid.fuseDecomposed(layers1, layers2, x, method, progress,
+                                      chroma=chroma)
+
+    def transform(name, image):
+        if workspace is None:
+            return decompose(image, wavelet, level, dtype)
+        return workspace.decompose(name, image, wavelet, level, dtype)
+
+    with trace.stage('decompose', I1, I2) as st:
+        if par is None:
+            cooef1, slices = transform('coeffs1', I1)
+            cooef2, _ = transform('coeffs2', I2)
+        else:
+            (cooef1, slices), (cooef2, _) = par.pair(
+                transform, ('coeffs1', I1), ('coeffs2', I2))
+        st.output(cooef1, cooef2)
+
+    return fuseDecomposed(cooef1, cooef2, slices, x, wavelet, method,
+                          progress, chroma=chroma, threads=threads)
+
+
+def fuseDecomposed(cooef1, cooef2, slices, shape, wavelet='db5',
+                   method='mean', progress=None, inPlace=True, chroma=None,
+                   workspace=None, threads=1):
+    """
+    Fuse two decompositions and turn the result into an 8-bit image.
+
+    This is the second half of fuseArrays(), split out so that callers
+    holding decompositions already (for example from a FusionCache) can
+    skip the forward transform.
+
+    Args:
+        cooef1 (numpy.ndarray): Packed coefficients of image 1.
+        cooef2 (numpy.ndarray): Packed coefficients of image 2.
+        slices (list): Band locations returned by decompose().
+        shape (tuple): (rows, cols) of the source images.
+        wavelet (str): Wavelet name used for the decomposition.
+        method (str or dict): Fuse rule, see fusion().
+        progress (callable, optional): Stage callback, see fuseArrays().
+        inPlace (bool): Fuse into `cooef1`. Set to False to leave both
+            decompositions untouched.
+        chroma (numpy.ndarray, optional): Already fused (2, rows, cols)
+            chroma planes to combine with the luma decompositions.
+        workspace (FusionWorkspace, optional): Supplies the output array
+            when fusing out of place.
+        threads (int): Number of threads, see fuseArrays().
+
+    Returns:
+        numpy.ndarray: Fused uint8 image of the given shape, 3-channel
+            BGR if the decompositions are in color.
+    """
+    x = shape
+    par = None
+    if threads > 1:
+        import fusion_parallel
+        par = fusion_parallel.Parallel(threads)
+
+    # Fuse all bands of all levels in one vectorized step
+    if progress is not None:
+        progress('fuse')
+    with trace.stage('fuse', cooef1, cooef2) as st:
+        if inPlace:
+            out = None
+        elif workspace is None:
+            out = np.empty_like(cooef1)
+        else:
+            out = workspace.array('fused', cooef1.shape, cooef1.dtype)
+        if par is None:
+            fused = fuseBands(cooef1, cooef2, slices, method, out=out)
+        else:
+            fused = par.fuseBands(cooef1, cooef2, slices, method, out=out)
+        st.output(fused)
+
+    # Reconstruct image using inverse DWT, cropping the padding that
+    # periodization adds to odd-sized inputs
+    if progress is not None:
+        progress('reconstruct')
+    with trace.stage('reconstruct', fused) as st:
+        if par is None:
+            outImage = reconstruct(fused, slices, wavelet)
+        else:
+            outImage = par.reconstruct(fused, slices, wavelet)
+        outImage = outImage[..., :x[0], :x[1]]
+        if chroma is not None:
+            outImage = np.concatenate((outImage[np.newaxis], chroma))
+        st.output(outImage)
+
+    if progress is not None:
+        progress('normalize')
+    with trace.stage('normalize', outImage) as st:
+        outImage = toUint8(outImage) if par is None else \
+            par.toUint8(outImage)
+        st.output(outImage)
+    return outImage
+
+
+def toWorkingSpace(image, color=False):
+    """
+    Convert an 8-bit image to the color space fusion works in.
+
+    Args:
+        image (numpy.ndarray): 2D grayscale or 3-channel BGR image.
+        color (bool): Return YCrCb planes instead of grayscale.
+
+    Returns:
+        numpy.ndarray: 2D grayscale image, or (3, rows, cols) YCrCb
+            plane stack.
+    """
+    if color:
+        import cv2
+        if image.ndim == 2:
+            image = cv2.cvtColor(image, cv2.COLOR_GRAY2BGR)
+        image = cv2.cvtColor(image, cv2.COLOR_BGR2YCrCb)
+        return np.ascontiguousarray(image.transpose(2, 0, 1))
+    if image.ndim == 3:
+        import cv2
+        image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    return image
+
+
+def toUint8(image):
+    """
+    Turn a reconstructed float image into an 8-bit image.
+
+    Grayscale images, and the luma channel of YCrCb images, are min-max
+    normalized to [0, 255]. Chroma is only clipped, since stretching it
+    would shift the colors; YCrCb results are converted back to BGR.
+
+    The normalization runs in place, so no float temporaries the size of
+    the image are allocated and `image` is overwritten.
+
+    Args:
+        image (numpy.ndarray): 2D float image, or float YCrCb plane stack.
+
+    Returns:
+        numpy.ndarray: 2D uint8 image, or 3-channel uint8 BGR image.
+    """
+    luma = image if image.ndim == 2 else image[0]
+
+    # Normalize pixel values to [0, 255] range
+    # Min-max normalization: (value - min) / (max - min) * 255
+    lo, hi = np.min(luma), np.max(luma)
+    luma -= lo
+    luma /= (hi - lo) if hi > lo else 1
+    luma *= 255
+    if image.ndim == 2:
+        # Convert to 8-bit unsigned integer for display or saving
+        return luma.astype(np.uint8)
+
+    import cv2
+    np.clip(image[1:], 0, 255, out=image[1:])
+    image = image.astype(np.uint8).transpose(1, 2, 0)
+    return cv2.cvtColor(np.ascontiguousarray(image), cv2.COLOR_YCrCb2BGR)
+
+
+def outputPath(key=None):
+    """
+    Return the default output path for a fused image.
+
+    Args:
+        key (str, optional): Result key from fusion_store.resultKey().
+            Equal inputs and parameters then always get the same name,
+            and different ones never collide.
+
+    Returns:
+        str: demo/out<first 12 key characters>.jpg, or without a key
+            demo/outXXXX.jpg, where XXXX is a random number (1000-2000).
+    """
+    if key is not None:
+        return 'demo/out' + key[:12] + '.jpg'
+    import random
+    x = random.randint(1000, 2000)
+    return 'demo/out' + str(x) + '.jpg'
+
+
+def tempPath(path):
+    """
+    Return a temporary file name next to `path` for an atomic replace.
+
+    The name is unique per process and thread, starts with '.tmp-' and
+    keeps the extension of `path`, which OpenCV needs to pick an encoder.
+    """
+    directory, name = os.path.split(os.path.abspath(path))
+    return os.path.join(directory, '.tmp-%d-%d-%s' % (
+        os.getpid(), threading.get_ident(), name))
+
+
+def writeImage(path, image):
+    """
+    Encode and write an image atomically.
+
+    The image is written to a temporary file next to `path` and renamed
+    over it, so readers never see a partly written file and a failed
+    write leaves any previous file intact.
+
+    Args:
+        path (str): Destination. The extension selects the encoder.
+        image (numpy.ndarray): 8-bit image.
+
+    Raises:
+        IOError: If the image cannot be encoded or written.
+    """
+    import cv2
+    tmp = tempPath(path)
+    try:
+        if not cv2.imwrite(tmp, image):
+            raise IOError("Cannot write image: " + path)
+        os.replace(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+        raise
+
+
+def fusion(img1, img2, out=None, wavelet='db5', level=1, method='mean',
+           cache=None, color=False, engine='dwt', precision='float64',
+           workspace=None, align=None, threads=1):
     """
     Perform image fusion using Discrete Wavelet Transform (DWT).
 
     This function takes two input images and fuses them using the DWT
     algorithm. The images are decomposed into approximation and detail
-    coefficients, which are then combined using the mean method and
+    coefficients, which are then combined using the chosen fuse rule and
     reconstructed into a single fused image.
 
+    Every step is reported to the installed tracer, if any (see
+    fusion_trace.py).
+
     The fusion process:
-    1. Load images in grayscale
-    2. Resize image 2 to match image 1 dimensions
-    3. Apply 2D DWT using Daubechies-5 wavelet
-    4. Fuse coefficients: cA (approx), cH (horizontal), cV (vertical), cD (diagonal)
+    1. Load images in grayscale (or in color, see `color`)
+    2. Resize image 2 to match image 1 dimensions, or register and warp
+       it onto image 1 (see `align`)
+    3. Apply a `level`-deep 2D DWT (Daubechies-5 by default)
+    4. Fuse the packed coefficients of all levels in place
     5. Apply inverse DWT to reconstruct
     6. Normalize pixel values to [0, 255]
     7. Save result as JPEG
 
+    Steps 2 to 6 are done by fuseArrays(); this function adds the file
+    reading and writing around it.
+
     Args:
         img1 (str): File path to the first input image.
         img2 (str): File path to the second input image.
+        out (str, optional): File path to write the fused image to. The
+            extension selects the encoder. Defaults to outputPath().
+        wavelet (str): Wavelet name. Defaults to 'db5'.
+        level (int): Number of decomposition levels. Defaults to 1.
+        method (str or dict): Fuse rule, either one of FUSION_METHODS for
+            every band or {'approx': ..., 'detail': ...}. Defaults to
+            'mean'.
+        cache (FusionCache, optional): Cache of decoded images and
+            decompositions (see fusion_cache.py). Repeated calls on the
+            same files then skip decoding and the forward DWT.
+        color (bool): Keep color, fusing luma with `method` and chroma
+            with the cheaper chromaMethod(). See fuseArrays().
+        engine (str): 'dwt', 'pyramid' or 'auto', see fuseArrays(). The
+            cache keeps decompositions for the 'dwt' engine only; other
+            engines reuse just the decoded images.
+        precision (str): 'float64' or 'float32', see fuseArrays(). A
+            cache keeps its decompositions in float64.
+        workspace (FusionWorkspace, optional): Buffers to reuse across
+            calls, e.g. over a long batch of same-sized pairs. Not used
+            with a cache, which keeps its own arrays.
+        align (str, optional): Register image 2 to image 1 with this
+            motion model before fusing, see fuseArrays(). With a cache,
+            only the decoded images are reused.
+        threads (int): Number of threads, see fuseArrays(). Above 1,
+            both files are also read at once. Not used with a cache.
 
     Returns:
-        str: File path to the generated fused image (demo/outXXXX.jpg).
+        str: File path to the generated fused image.
+
+    Raises:
+        IOError: If either input image cannot be read.
+        ValueError: If the fuse rule, precision or motion model is
+            unknown.
 
     Note:
-        - Both images are converted to grayscale
-        - Output is saved in the demo/ directory
-        - File name includes a random number (1000-2000)
+        - Both images are converted to grayscale unless `color` is set
+        - Without `out`, output is saved in the demo/ directory under a
+          name derived from the input contents and parameters (see
+          outputPath()), so reruns replace their own result only
+        - The output file is replaced atomically, see writeImage()
 
     Example:
         >>> result_path = fusion("demo/medical1.png", "demo/medical2.png")
         >>> print(f"Fused image saved to: {result_path}")
-        Fused image saved to: demo/out1523.jpg
+        Fused image saved to: demo/out3fa94c0e1b27.jpg
+        >>> fusion("demo/rose1.png", "demo/rose2.png", level=3,
+        ...        method={'approx': 'mean', 'detail': 'max'})
     """
-    # Fusion method configuration
-    # Options: 'mean', 'min', 'max'
-    FUSION_METHOD = 'mean'
-
-    # Load both images in grayscale (0 = grayscale flag)
-    I1 = cv2.imread(img1, 0)
-    I2 = cv2.imread(img2, 0)
-
-    # Get dimensions of first image and resize second image to match
-    # This ensures both images have the same size for coefficient fusion
-    x = I1.shape
-    invX = x[::-1]  # Reverse dimensions for cv2.resize (width, height)
-    I2 = cv2.resize(I2, invX)
-
-    # Apply 2D Discrete Wavelet Transform
-    # Using Daubechies-5 wavelet with periodization mode
-    wavelet = 'db5'
-    cooef1 = pywt.dwt2(I1, wavelet, mode='periodization')
-    cooef2 = pywt.dwt2(I2, wavelet, mode='periodization')
-
-    # Unpack wavelet coefficients
-    # cA: Approximation coefficients (low-frequency, overall structure)
-    # cH: Horizontal detail coefficients (horizontal edges)
-    # cV: Vertical detail coefficients (vertical edges)
-    # cD: Diagonal detail coefficients (diagonal edges)
-    cA1, (cH1, cV1, cD1) = cooef1
-    cA2, (cH2, cV2, cD2) = cooef2
-
-    # Fuse all coefficients using mean method
-    # This creates a balanced combination of both images
-    cA = (cA1 + cA2) / 2  # Fused approximation
-    cH = (cH1 + cH2) / 2  # Fused horizontal details
-    cV = (cV1 + cV2) / 2  # Fused vertical details
-    cD = (cD1 + cD2) / 2  # Fused diagonal details
-
-    # Pack fused coefficients for inverse transform
-    finco = cA, (cH, cV, cD)
-
-    # Reconstruct image using inverse DWT
-    outImage = pywt.idwt2(finco, wavelet, mode='periodization')
-
-    # Normalize pixel values to [0, 255] range
-    # Min-max normalization: (value - min) / (max - min) * 255
-    outImage = np.multiply(
-        np.divide(outImage - np.min(outImage),
-                  (np.max(outImage) - np.min(outImage))),
-        255
-    )
-
-    # Convert to 8-bit unsigned integer for image saving
-    outImage = outImage.astype(np.uint8)
+    import cv2
+    if cache is not None:
+        I1 = cache.image(img1, color=color)
+        engine = selectEngine(engine, I1.shape)
+        if align is not None:
+            I2 = cache.image(img2, color=color)
+            outImage = fuseArrays(I1, I2, wavelet, level, method,
+                                  color=color, engine=engine,
+                                  precision=precision, align=align)
+        elif engine == 'dwt':
+            outImage = cache.fuse(img1, img2, wavelet, level, method,
+                                  color=color)
+        else:
+            I2 = cache.image(img2, I1.shape[:2], color)
+            outImage = fuseArrays(I1, I2, wavelet, level, method,
+                                  color=color, engine=engine,
+                                  precision=precision)
+    else:
+        # Load both images in grayscale (0) or color (1)
+        with trace.stage('read') as st:
+            if threads > 1:
+                import fusion_parallel
+                I1, I2 = fusion_parallel.Parallel(threads).pair(
+                    cv2.imread, (img1, int(color)), (img2, int(color)))
+            else:
+                I1 = cv2.imread(img1, int(color))
+                I2 = cv2.imread(img2, int(color))
+            if I1 is None:
+                raise IOError("Cannot read image: " + img1)
+            if I2 is None:
+                raise IOError("Cannot read image: " + img2)
+            st.output(I1, I2)
 
-    # Generate unique output filename with random number
-    x = random.randint(1000, 2000)
-    loc = 'demo/out' + str(x) + '.jpg'
+        outImage = fuseArrays(I1, I2, wavelet, level, method, color=color,
+                              engine=engine, precision=precision,
+                              workspace=workspace, align=align,
+                              threads=threads)
 
-    # Save the fused image
-    cv2.imwrite(loc, outImage)
+    # Save the fused image, by default under a content-derived name
+    loc = out
+    if loc is None:
+        import fusion_store
+        loc = outputPath(fusion_store.resultKey(img1, img2, {
+            'wavelet': wavelet, 'level': level, 'method': method,
+            'color': color, 'engine': engine, 'precision': precision,
+            'align': align}))
+    with trace.stage('write', outImage):
+        writeImage(loc, outImage)
 
     return loc
@@ -0,0 +1,388 @@
+#!/usr/bin/env python3
+"""
+fusion_morph.py - Morph Sequences from One Pair of Decompositions
+
+This module turns two images into an N-frame sequence that blends from
+image 1 to image 2, written as a video or a folder of numbered images.
+
+Each input is decomposed once. Every frame then only interpolates the two
+packed coefficient arrays with its own weight and inverts the result:
+
+    frame(t) = inverse(coeffs1 + w(t) * (coeffs2 - coeffs1))
+
+The difference of the decompositions is computed once, so a frame costs
+one multiply-add over the coefficients and one inverse transform, instead
+of the two decodes, two forward transforms and a fuse of a fusion() call.
+Frames are independent and can be rendered on several threads.
+
+The approximation always moves with the frame weight t. With `sharpness`
+above 0 the detail bands follow a steeper S-curve around the middle, so
+the edges of one image give way to those of the other over fewer frames
+and the middle frames show less double contour. With `sharpness` 0 every
+band uses t and the sequence is a plain cross-dissolve.
+
+Color sequences interpolate luma in the wavelet domain and chroma directly
+in the pixel domain, which is the same thing for a linear blend (see
+fusion_main.fuseArrays()). Frames are clipped to [0, 255] rather than
+stretched, so the first and last frames reproduce the inputs (color ones
+up to the rounding of the YCrCb round trip) and the brightness does not
+flicker along the sequence.
+
+Usage:
+    python3 fusion_morph.py demo/face1.png demo/face2.png morph.mp4 --frames 60
+    python3 fusion_morph.py demo/face1.png demo/face2.png frames/ --threads 4
+
+Example:
+    import fusion_morph
+    fusion_morph.morphSequence("face1.png", "face2.png", "morph.mp4",
+                               frames=60, level=3, sharpness=4)
+
+    morph = fusion_morph.morphArrays(I1, I2, level=3, color=True)
+    middle = morph.frame(0.5)
+"""
+
+import argparse
+import collections
+import os
+import sys
+
+import cv2
+import numpy as np
+
+import fusion_align
+import fusion_main as fuse
+
+
+def morphWeights(frames):
+    """
+    Return the frame weights of a sequence, from 0 (image 1) to 1 (image 2).
+
+    Args:
+        frames (int): Number of frames, at least 2.
+
+    Returns:
+        numpy.ndarray: `frames` evenly spaced weights.
+
+    Raises:
+        ValueError: If there are fewer than 2 frames.
+    """
+    if frames < 2:
+        raise ValueError("A morph needs at least 2 frames")
+    return np.linspace(0.0, 1.0, frames)
+
+
+def easeWeight(t, sharpness=0.0):
+    """
+    Map a frame weight onto an S-curve that keeps 0, 0.5 and 1 in place.
+
+    Args:
+        t (float): Frame weight in [0, 1].
+        sharpness (float): Steepness of the curve around the middle. 0
+            returns `t` unchanged.
+
+    Returns:
+        float: Weight in [0, 1].
+    """
+    if sharpness <= 0:
+        return t
+    return 0.5 + 0.5 * np.tanh(sharpness * (2 * t - 1)) / np.tanh(sharpness)
+
+
+def morphPath(key, frames):
+    """
+    Return the default output of a morph in the demo/ directory.
+
+    Args:
+        key (str): Key from fusion_store.resultKey() for the inputs.
+        frames (int): Number of frames.
+
+    Returns:
+        str: File path such as 'demo/morph3fa94c0e1b27-60.mp4'.
+    """
+    return os.path.join('demo', 'morph%s-%d.mp4' % (key[:12], frames))
+
+
+def _toFrame(image):
+    """
+    Turn a float frame into an 8-bit image, in place.
+
+    Args:
+        image (numpy.ndarray): 2D float image, or float YCrCb plane stack.
+
+    Returns:
+        numpy.ndarray: 2D uint8 image, or 3-channel uint8 BGR image.
+    """
+    np.clip(image, 0, 255, out=image)
+    np.rint(image, out=image)
+    if image.ndim == 2:
+        return image.astype(np.uint8)
+    image = image.astype(np.uint8).transpose(1, 2, 0)
+    return cv2.cvtColor(np.ascontiguousarray(image), cv2.COLOR_YCrCb2BGR)
+
+
+class Morph(object):
+    """
+    Frames between two decomposed images.
+
+    frame() only reads the arrays held here, so several threads may
+    render frames at once.
+
+    Attributes:
+        coeffs1 (numpy.ndarray): Packed decomposition of image 1 (luma
+            for color). Not modified.
+        diff (numpy.ndarray): Decomposition of image 2 minus that of
+            image 1.
+        slices (list): Band locations returned by fusion_main.decompose().
+        shape (tuple): (rows, cols) of the frames.
+        wavelet (str): Wavelet name.
+    """
+
+    def __init__(self, coeffs1, coeffs2, slices, shape, wavelet='db5',
+                 chroma=None):
+        """
+        Args:
+            coeffs1 (numpy.ndarray): Packed 2D decomposition of image 1,
+                e.g. from a FusionCache or a ProgressiveFusion.
+            coeffs2 (numpy.ndarray): Same for image 2, of the same size.
+            slices (list): Band locations returned by decompose().
+            shape (tuple): (rows, cols) of the decomposed images.
+            wavelet (str): Wavelet name used for the decompositions.
+            chroma (tuple, optional): (chroma1, chroma2), the Cr and Cb
+                planes of both images as (2, rows, cols) arrays, for
+                color frames. None for grayscale.
+        """
+        self.coeffs1 = coeffs1
+        self.diff = np.subtract(coeffs2, coeffs1)
+        self.slices = slices
+        self.shape = tuple(shape)
+        self.wavelet = wavelet
+        self._approx = slices[0]
+        self._chroma = None
+        if chroma is not None:
+            chroma1 = np.asarray(chroma[0], coeffs1.dtype)
+            self._chroma = (chroma1, np.subtract(chroma[1], chroma1,
+                                                 dtype=coeffs1.dtype))
+
+    def frame(self, t, sharpness=0.0):
+        """
+        Render the frame at weight `t`.
+
+        Args:
+            t (float): 0 for image 1, 1 for image 2, in between for a
+                blend.
+            sharpness (float): Steepness of the detail transition, see
+                easeWeight().
+
+        Returns:
+            numpy.ndarray: uint8 frame, 2D or 3-channel BGR.
+        """
+        detail = easeWeight(t, sharpness)
+        coeffs = np.multiply(self.diff, detail)
+        if detail != t:
+            np.multiply(self.diff[self._approx], t,
+                        out=coeffs[self._approx])
+        coeffs += self.coeffs1
+        luma = fuse.reconstruct(coeffs, self.slices, self.wavelet)
+        luma = luma[:self.shape[0], :self.shape[1]]
+        del coeffs
+
+        if self._chroma is None:
+            return _toFrame(luma)
+        image = np.empty((3,) + self.shape, luma.dtype)
+        image[0] = luma
+        np.multiply(self._chroma[1], t, out=image[1:])
+        image[1:] += self._chroma[0]
+        return _toFrame(image)
+
+    def frames(self, count, sharpness=0.0, threads=1):
+        """
+        Render a whole sequence, in order.
+
+        Args:
+            count (int): Number of frames, at least 2.
+            sharpness (float): See frame().
+            threads (int): Frames rendered at the same time. At most
+                2 * `threads` frames are held at once.
+
+        Yields:
+            numpy.ndarray: uint8 frames, from image 1 to image 2.
+
+        Raises:
+            ValueError: If `count` is below 2.
+        """
+        weights = morphWeights(count)
+        if threads <= 1:
+            for t in weights:
+                yield self.frame(t, sharpness)
+            return
+
+        import fusion_parallel
+        pool = fusion_parallel.executor(threads)
+        pending = collections.deque()
+        for t in weights:
+            pending.append(pool.submit(self.frame, t, sharpness))
+            if len(pending) >= 2 * threads:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def morphArrays(I1, I2, wavelet='db5', level=1, color=False,
+                precision='float64', align=None):
+    """
+    Decompose two images held in memory for a morph.
+
+    Args:
+        I1 (numpy.ndarray): First image, grayscale or BGR.
+        I2 (numpy.ndarray): Second image, resized to the first.
+        wavelet (str): Wavelet name. Defaults to 'db5'.
+        level (int): Number of decomposition levels. Defaults to 1.
+        color (bool): Render color frames.
+        precision (str): 'float64' or 'float32', see
+            fusion_main.fuseArrays().
+        align (str, optional): Register image 2 to image 1 with this
+            motion model instead of resizing it, see fusion_align.py.
+
+    Returns:
+        Morph: The decomposed pair.
+
+    Raises:
+        ValueError: If the precision or motion model is unknown.
+    """
+    dtype = fuse.workingDtype(precision)
+    if align is not None:
+        I2, _ = fusion_align.align(I1, I2, align)
+    elif I2.shape[:2] != I1.shape[:2]:
+        I2 = cv2.resize(I2, I1.shape[1::-1])
+    I1 = fuse.toWorkingSpace(I1, color)
+    I2 = fuse.toWorkingSpace(I2, color)
+
+    chroma = None
+    if color:
+        chroma = (I1[1:], I2[1:])
+        I1, I2 = I1[0], I2[0]
+    coeffs1, slices = fuse.decompose(I1, wavelet, level, dtype)
+    coeffs2, _ = fuse.decompose(I2, wavelet, level, dtype)
+    return Morph(coeffs1, coeffs2, slices, I1.shape, wavelet, chroma)
+
+
+def morphFiles(img1, img2, wavelet='db5', level=1, color=False, cache=None,
+               align=None):
+    """
+    Decode and decompose two image files for a morph.
+
+    Args:
+        img1 (str): File path to the first image.
+        img2 (str): File path to the second image.
+        wavelet, level, color, align: See morphArrays().
+        cache (FusionCache, optional): Take decoded images, and for
+            grayscale the decompositions, from this cache.
+
+    Returns:
+        Morph: The decomposed pair.
+
+    Raises:
+        IOError: If either image cannot be read.
+        ValueError: If the motion model is unknown.
+    """
+    if cache is not None and not color and align is None:
+        # The same decompositions a fusion of the pair uses
+        coeffs1, slices, shape = cache.decomposition(img1, wavelet, level)
+        coeffs2, _, _ = cache.decomposition(img2, wavelet, level, shape)
+        return Morph(coeffs1, coeffs2, slices, shape, wavelet)
+
+    if cache is not None:
+        I1 = cache.image(img1, color=color)
+        I2 = cache.image(img2, color=color)
+    else:
+        I1 = cv2.imread(img1, int(color))
+        I2 = cv2.imread(img2, int(color))
+        if I1 is None:
+            raise IOError("Cannot read image: " + img1)
+        if I2 is None:
+            raise IOError("Cannot read image: " + img2)
+    return morphArrays(I1, I2, wavelet, level, color, align=align)
+
+
+def morphSequence(img1, img2, out, frames=30, fps=25.0, wavelet='db5',
+                  level=1, color=False, sharpness=0.0, threads=1, cache=None,
+                  align=None, report=None):
+    """
+    Write a morph from one image file to another.
+
+    Args:
+        img1 (str): File path to the first image.
+        img2 (str): File path to the second image.
+        out (str): Output video file or folder, see
+            fusion_video.FrameSink.
+        frames (int): Number of frames, at least 2. Defaults to 30.
+        fps (float): Frame rate of a video output.
+        wavelet, level, color, cache, align: See morphFiles().
+        sharpness (float): See Morph.frame().
+        threads (int): Frames rendered at the same time.
+        report (callable, optional): Called with (index, frames) after
+            every frame is written.
+
+    Returns:
+        str: The output path.
+
+    Raises:
+        IOError: If an input cannot be read or the output written.
+        ValueError: If `frames` is below 2 or the motion model is
+            unknown.
+    """
+    from fusion_video import FrameSink
+
+    morphWeights(frames)  # validate before creating the output
+    morph = morphFiles(img1, img2, wavelet, level, color, cache, align)
+    sink = FrameSink(out, fps)
+    try:
+        for index, frame in enumerate(morph.frames(frames, sharpness,
+                                                   threads)):
+            sink.write(index, frame)
+            if report is not None:
+                report(index, frames)
+    finally:
+        sink.close()
+    return out
+
+
+def main(argv=None):
+    """Command line entry point."""
+    parser = argparse.ArgumentParser(
+        description="Morph one image into another as a frame sequence.")
+    parser.add_argument('img1', help="first image")
+    parser.add_argument('img2', help="second image")
+    parser.add_argument('out', help="output video file (.mp4, .avi, ...) "
+                                    "or folder of numbered frames")
+    parser.add_argument('--frames', type=int, default=30,
+                        help="number of frames (default: 30)")
+    parser.add_argument('--fps', type=float, default=25.0,
+                        help="video frame rate (default: 25)")
+    parser.add_argument('--wavelet', default='db5')
+    parser.add_argument('--level', type=int, default=1,
+                        help="decomposition levels (default: 1)")
+    parser.add_argument('--color', action='store_true',
+                        help="color frames instead of grayscale")
+    parser.add_argument('--sharpness', type=float, default=0.0,
+                        help="steepness of the detail transition; 0 is a "
+                             "plain cross-dissolve (default: 0)")
+    parser.add_argument('--align', choices=fusion_align.MOTIONS,
+                        help="register image 2 to image 1 first")
+    parser.add_argument('-j', '--threads', type=int, default=1,
+                        help="frames rendered at the same time (default: 1)")
+    args = parser.parse_args(argv)
+
+    try:
+        morphSequence(args.img1, args.img2, args.out, args.frames, args.fps,
+                      args.wavelet, args.level, args.color, args.sharpness,
+                      args.threads, align=args.align)
+    except (IOError, ValueError) as e:
+        print(e, file=sys.stderr)
+        return 1
+    print("%d frames written to %s" % (args.frames, args.out))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,268 @@
+"""
+fusion_parallel.py - Multi-Threaded Execution of a Single Fusion
+
+fusion_main.fuseArrays() and fusion() run every stage on one core. With
+`threads` > 1 they hand the heavy stages to this module, which spreads each
+of them over a thread pool. OpenCV, pywt and numpy release the GIL inside
+their C loops, so threads run truly in parallel:
+
+- read, convert, decompose: the two inputs are processed at the same time.
+- fuse: the packed coefficient array is cut into subbands, and the
+  subbands of pixelwise rules into row bands, all fused concurrently.
+  Region rules need whole subbands, so they parallelize over subbands
+  and planes only.
+- reconstruct: every level of the inverse 2D DWT is done as two 1D
+  passes, rows first and then columns (as pywt.waverec2 does). Each pass
+  is split into bands along the other axis, which needs no overlap; the
+  intermediate results are stored transposed so every band is contiguous.
+- normalize: the min-max search, scaling, 8-bit conversion and color
+  conversion run per row band.
+
+Every band runs the same arithmetic as the single-threaded code, so the
+result is identical bit for bit.
+
+Example:
+    import fusion_main as fuse
+    fused = fuse.fuseArrays(I1, I2, level=3, threads=8)
+"""
+
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pywt
+
+import fusion_main as fuse
+
+
+# Thread pools by size, shared by all fusions of the process
+_pools = {}
+_poolsLock = threading.Lock()
+
+
+def executor(threads):
+    """
+    Return the shared thread pool with `threads` workers.
+
+    Args:
+        threads (int): Number of worker threads.
+
+    Returns:
+        concurrent.futures.ThreadPoolExecutor: Pool that lives as long as
+            the process.
+    """
+    with _poolsLock:
+        pool = _pools.get(threads)
+        if pool is None:
+            pool = _pools[threads] = ThreadPoolExecutor(
+                threads, thread_name_prefix='fusion-parallel')
+        return pool
+
+
+def rowBands(rows, parts):
+    """
+    Split `rows` into at most `parts` contiguous, nearly equal slices.
+
+    Args:
+        rows (int): Number of rows.
+        parts (int): Number of bands wanted.
+
+    Returns:
+        list: slice objects covering range(rows), none of them empty.
+    """
+    parts = max(1, min(parts, rows))
+    bounds = [rows * i // parts for i in range(parts + 1)]
+    return [slice(bounds[i], bounds[i + 1]) for i in range(parts)]
+
+
+class Parallel(object):
+    """
+    Run the stages of one fusion on a thread pool.
+
+    Tasks never wait for other tasks, so one pool can safely serve
+    several fusions at once.
+
+    Attributes:
+        threads (int): Number of threads, which is also the number of
+            bands work is split into.
+    """
+
+    def __init__(self, threads):
+        """
+        Args:
+            threads (int): Number of threads, at least 1.
+        """
+        self.threads = max(1, int(threads))
+        self.pool = executor(self.threads)
+
+    def map(self, func, items):
+        """Call func(item) for every item concurrently; return results."""
+        items = list(items)
+        if len(items) == 1:
+            return [func(items[0])]
+        return list(self.pool.map(func, items))
+
+    def pair(self, func, args1, args2):
+        """
+        Call func(*args1) and func(*args2) at the same time.
+
+        The second call runs on the calling thread.
+
+        Returns:
+            tuple: Both results.
+        """
+        first = self.pool.submit(func, *args1)
+        second = func(*args2)
+        return first.result(), second
+
+    def fuseBands(self, coeffs1, coeffs2, slices, method='mean', out=None):
+        """
+        Parallel counterpart of fusion_main.fuseBands().
+
+        Args:
+            coeffs1 (numpy.ndarray): Packed coefficients of image 1.
+            coeffs2 (numpy.ndarray): Packed coefficients of image 2.
+            slices (list): Band locations returned by decompose().
+            method (str or dict): Fuse rule, see fusion_main.bandMethods().
+            out (numpy.ndarray, optional): Array receiving the result.
+                Defaults to `coeffs1`.
+
+        Returns:
+            numpy.ndarray: `out`. Padding between bands of odd-sized
+                decompositions is not written; reconstruct() never reads
+                it.
+        """
+        if out is None:
+            out = coeffs1
+        approx, detail = fuse.bandMethods(method)
+        window = fuse.regionWindow(method)
+        if coeffs1.ndim == 3:
+            chroma = fuse.chromaMethod(method)
+            planes = [(coeffs1[0], coeffs2[0], out[0], approx, detail)]
+            planes += [(coeffs1[c], coeffs2[c], out[c], chroma, chroma)
+                       for c in (1, 2)]
+        else:
+            planes = [(coeffs1, coeffs2, out, approx, detail)]
+
+        subbands = [slices[0][-2:]]
+        subbands += [level[key][-2:] for level in slices[1:]
+                     for key in ('da', 'ad', 'dd')]
+        tasks = []
+        for plane1, plane2, planeOut, approxRule, detailRule in planes:
+            for k, sub in enumerate(subbands):
+                rule = approxRule if k == 0 else detailRule
+                band1 = plane1[sub]
+                if not band1.size:
+                    continue
+                if rule in fuse.REGION_METHODS:
+                    # Neighbourhoods span the whole subband
+                    tasks.append((band1, plane2[sub], planeOut[sub], rule))
+                    continue
+                for rows in rowBands(band1.shape[0], self.threads):
+                    tasks.append((band1[rows], plane2[sub][rows],
+                                  planeOut[sub][rows], rule))
+
+        self.map(lambda t: fuse.fuseCoeff(t[0], t[1], t[3], out=t[2],
+                                          window=window), tasks)
+        return out
+
+    def reconstruct(self, coeffs, slices, wavelet='db5'):
+        """
+        Parallel counterpart of fusion_main.reconstruct().
+
+        Args:
+            coeffs (numpy.ndarray): Packed coefficient array.
+            slices (list): Band locations returned by decompose().
+            wavelet (str): Wavelet name used for the decomposition.
+
+        Returns:
+            numpy.ndarray: Reconstructed image, 2D or channel stack.
+        """
+        bands = pywt.array_to_coeffs(coeffs, slices, output_format='wavedec2')
+        mode = 'periodization'
+        approx = bands[0]
+        for cH, cV, cD in bands[1:]:
+            # An odd-sized level leaves the approximation one larger
+            if approx.shape[-2:] != cH.shape[-2:]:
+                approx = approx[..., :cH.shape[-2], :cH.shape[-1]]
+            rows, cols = cH.shape[-2:]
+            lead = cH.shape[:-2]
+
+            # Along each row: (approx, vertical) -> low, (horizontal,
+            # diagonal) -> high. Row bands are independent. low and high
+            # are kept transposed, so the column pass below also works on
+            # contiguous rows; strided bands would be much slower.
+            lowT = np.empty(lead + (2 * cols, rows), coeffs.dtype)
+            highT = np.empty_like(lowT)
+
+            def alongRows(r, approx=approx, cH=cH, cV=cV, cD=cD, lowT=lowT,
+                          highT=highT):
+                lowT[..., r] = pywt.idwt(approx[..., r, :], cV[..., r, :],
+                                         wavelet, mode,
+                                         axis=-1).swapaxes(-1, -2)
+                highT[..., r] = pywt.idwt(cH[..., r, :], cD[..., r, :],
+                                          wavelet, mode,
+                                          axis=-1).swapaxes(-1, -2)
+
+            self.map(alongRows, rowBands(rows, self.threads))
+
+            # Then along each column, i.e. each row of the transposed
+            # arrays; column bands are independent
+            imageT = np.empty(lead + (2 * cols, 2 * rows), coeffs.dtype)
+
+            def alongCols(c, lowT=lowT, highT=highT, imageT=imageT):
+                imageT[..., c, :] = pywt.idwt(lowT[..., c, :],
+                                              highT[..., c, :], wavelet,
+                                              mode, axis=-1)
+
+            self.map(alongCols, rowBands(2 * cols, self.threads))
+            del lowT, highT
+
+            # And back to row-major order
+            approx = np.empty(lead + (2 * rows, 2 * cols), coeffs.dtype)
+
+            def transpose(r, imageT=imageT, image=approx):
+                image[..., r, :] = imageT[..., r].swapaxes(-1, -2)
+
+            self.map(transpose, rowBands(2 * rows, self.threads))
+        return approx
+
+    def toUint8(self, image):
+        """
+        Parallel counterpart of fusion_main.toUint8(), also in place.
+
+        Args:
+            image (numpy.ndarray): 2D float image, or float YCrCb plane
+                stack.
+
+        Returns:
+            numpy.ndarray: 2D uint8 image, or 3-channel uint8 BGR image.
+        """
+        luma = image if image.ndim == 2 else image[0]
+        bands = rowBands(luma.shape[0], self.threads)
+        extremes = self.map(lambda r: (np.min(luma[r]), np.max(luma[r])),
+                            bands)
+        lo = min(e[0] for e in extremes)
+        hi = max(e[1] for e in extremes)
+        scale = (hi - lo) if hi > lo else 1
+
+        if image.ndim == 2:
+            out = np.empty(luma.shape, np.uint8)
+        else:
+            import cv2
+            out = np.empty(luma.shape + (3,), np.uint8)
+
+        def normalize(r):
+            band = luma[r]
+            band -= lo
+            band /= scale
+            band *= 255
+            if image.ndim == 2:
+                out[r] = band
+                return
+            np.clip(image[1:, r], 0, 255, out=image[1:, r])
+            out[r] = image[:, r].transpose(1, 2, 0)
+            cv2.cvtColor(out[r], cv2.COLOR_YCrCb2BGR, dst=out[r])
+
+        self.map(normalize, bands)
+        return out
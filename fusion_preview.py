@@ -0,0 +1,279 @@
+"""
+fusion_preview.py - Progressive Fusion Preview
+
+This module lets an interactive client show a reduced-resolution fusion
+early and compute the full-resolution result only when the user commits
+to it.
+
+A `level`-deep wavelet decomposition already contains the image at every
+coarser scale: the bands of the deepest levels occupy the top left block
+of the packed coefficient array and invert to the approximation at
+1/2, 1/4, 1/8... of the original size. The preview fuses and inverts only
+that block, which costs a small fraction of the full fuse and inverse
+transform. The analysis is not reduced: both inputs are still decoded at
+full resolution and fully decomposed before the preview can be shown.
+The full result later reuses the same decompositions, so nothing computed
+for the preview is thrown away.
+
+The approximation is offset against the image by the delay of the
+analysis filters, usually a fraction of a coarse pixel; the preview is
+shifted back with sub-pixel interpolation, so it lines up with the full
+result to within about 0.05 preview pixels.
+
+Example:
+    from fusion_preview import ProgressiveFusion
+
+    job = ProgressiveFusion("demo/rose1.png", "demo/rose2.png", scale=4)
+    small = job.preview()          # 1/4 scale, fast
+    job.save("rose_fused.jpg")     # full resolution, on commit
+"""
+
+import cv2
+import numpy as np
+import pywt
+
+import fusion_main as fuse
+
+
+def previewScale(shape, height, maxScale=8):
+    """
+    Choose the coarsest power-of-two scale still at least `height` tall.
+
+    Args:
+        shape (tuple): (rows, cols) of the full image.
+        height (int): Minimum preview height in pixels.
+        maxScale (int): Largest reduction factor to use.
+
+    Returns:
+        int: Reduction factor, 1, 2, 4... up to `maxScale`.
+    """
+    scale = 1
+    while scale < maxScale and shape[0] // (scale * 2) >= height:
+        scale *= 2
+    return scale
+
+
+def _approxDelay(wavelet, depth):
+    """
+    Return the shift, in coarse pixels, of the level-`depth` approximation.
+
+    Periodized analysis filters are not centred, so the approximation is
+    circularly shifted against the image. The delay is the DC group delay
+    of the cascaded low-pass filter, measured on 1D impulses at every
+    decimation phase. It is usually fractional and is undone on the
+    preview with a sub-pixel shift, see _shift().
+    """
+    step = 2 ** depth
+    size = 64 * step
+    delays = []
+    for phase in range(step):
+        impulse = np.zeros(size)
+        impulse[size // 2 + phase] = 1
+        approx = pywt.wavedec(impulse, wavelet, mode='periodization',
+                              level=depth)[0]
+        centre = (approx * np.arange(approx.size)).sum() / approx.sum()
+        # Coarse pixel i is centred on fine position (i + 0.5) * step - 0.5
+        delays.append(centre - ((size // 2 + phase + 0.5) / step - 0.5))
+    return float(np.mean(delays))
+
+
+def _shift(image, delay):
+    """
+    Circularly shift `image` up and left by `delay` pixels on both axes.
+
+    Fractional delays are interpolated linearly; the border wraps around
+    as it does in the periodized transform.
+    """
+    matrix = np.float64([[1, 0, delay], [0, 1, delay]])
+    return cv2.warpAffine(image, matrix, image.shape[::-1],
+                          flags=cv2.INTER_LINEAR | cv2.WARP_INVERSE_MAP,
+                          borderMode=cv2.BORDER_WRAP)
+
+
+def _blockExtent(slices, count):
+    """Return (rows, cols) covering the first `count` packed bands."""
+    if count == 1:
+        rows, cols = slices[0][-2:]
+    else:
+        rows, cols = slices[count - 1]['dd'][-2:]
+    return rows.stop, cols.stop
+
+
+class ProgressiveFusion(object):
+    """
+    Fuse two images at reduced resolution first, full resolution later.
+
+    The full result always uses the requested `level`, so it equals
+    fusion_main.fusion() with the same settings whatever the preview
+    scale. When the preview needs a deeper approximation than `level`
+    gives, only the small level-`level` approximation bands are
+    decomposed further.
+
+    Attributes:
+        shape (tuple): (rows, cols) of the full-resolution result.
+        scale (int): Reduction factor of preview(), a power of two.
+        level (int): Decomposition depth of the full result.
+    """
+
+    def __init__(self, img1, img2, wavelet='db5', level=1, method='mean',
+                 scale=4, cache=None, progress=None):
+        """
+        Decode and decompose both inputs.
+
+        Args:
+            img1 (str): File path to the first input image.
+            img2 (str): File path to the second input image.
+            wavelet (str): Wavelet name. Defaults to 'db5'.
+            level (int): Decomposition depth for the full result.
+            method (str or dict): Fuse rule, see fusion_main.fusion().
+            scale (int): Preview reduction factor, a power of two.
+            cache (FusionCache, optional): Cache to take decoded images
+                and decompositions from.
+            progress (callable, optional): Stage callback, see
+                fusion_main.fuseArrays().
+
+        Raises:
+            IOError: If either input image cannot be read.
+            ValueError: If `scale` is not a power of two.
+        """
+        if scale < 1 or scale & (scale - 1):
+            raise ValueError("Preview scale must be a power of two")
+        self.wavelet = wavelet
+        self.method = method
+        self.scale = scale
+        self.level = level
+        depth = scale.bit_length() - 1
+
+        if progress is not None:
+            progress('decompose')
+        if cache is not None:
+            self.shape = cache.image(img1).shape
+            self.coeffs1, self.slices, _ = cache.decomposition(
+                img1, wavelet, self.level)
+            self.coeffs2, _, _ = cache.decomposition(
+                img2, wavelet, self.level, self.shape)
+        else:
+            I1 = cv2.imread(img1, 0)
+            I2 = cv2.imread(img2, 0)
+            if I1 is None:
+                raise IOError("Cannot read image: " + img1)
+            if I2 is None:
+                raise IOError("Cannot read image: " + img2)
+            self.shape = I1.shape
+            if I2.shape != self.shape:
+                I2 = cv2.resize(I2, self.shape[::-1])
+            self.coeffs1, self.slices = fuse.decompose(I1, wavelet,
+                                                       self.level)
+            self.coeffs2, _ = fuse.decompose(I2, wavelet, self.level)
+
+        # The actual reduction may be smaller than requested for tiny inputs
+        maxLevel = pywt.dwt_max_level(min(self.shape), wavelet)
+        self.scale = 2 ** min(depth, max(self.level, maxLevel))
+        self._full = None
+        self._deeper = None
+
+    def _previewBands(self, depth):
+        """
+        Return (coeffs1, coeffs2, slices, count) to take the preview from.
+
+        The first `count` bands of `slices` invert to the level-`depth`
+        approximation.
+
+        These are the full decompositions when they are at least `depth`
+        levels deep. Otherwise the level-`level` approximation bands are
+        decomposed by the missing levels, which is what a deeper full
+        decomposition would hold in its coarse block.
+        """
+        if depth <= self.level:
+            return (self.coeffs1, self.coeffs2, self.slices,
+                    self.level - depth + 1)
+        if self._deeper is None:
+            extra = depth - self.level
+            band = self.slices[0][-2:]
+            coeffs1, slices = fuse.decompose(self.coeffs1[band],
+                                             self.wavelet, extra)
+            coeffs2, _ = fuse.decompose(self.coeffs2[band], self.wavelet,
+                                        extra)
+            # The approximation alone is the level-`depth` one
+            self._deeper = (coeffs1, coeffs2, slices, 1)
+        return self._deeper
+
+    def preview(self, progress=None):
+        """
+        Fuse at 1/scale of the full resolution.
+
+        Only the coarse bands are fused and only the deepest levels are
+        inverted; no full-size array is touched. The decoding and the
+        full forward transforms were already done by the constructor.
+
+        Args:
+            progress (callable, optional): Stage callback.
+
+        Returns:
+            numpy.ndarray: Fused uint8 image about shape / scale in size.
+        """
+        if self._full is not None and self.scale == 1:
+            return self._full
+        depth = self.scale.bit_length() - 1
+        coeffs1, coeffs2, slices, count = self._previewBands(depth)
+        rows, cols = _blockExtent(slices, count)
+        block1 = coeffs1[:rows, :cols]
+        block2 = coeffs2[:rows, :cols]
+
+        if progress is not None:
+            progress('fuse')
+        fused = fuse.fuseBands(block1, block2, slices, self.method,
+                               out=np.empty_like(block1))
+
+        if progress is not None:
+            progress('reconstruct')
+        bands = pywt.array_to_coeffs(fused, slices[:count],
+                                     output_format='wavedec2')
+        image = pywt.waverec2(bands, self.wavelet, mode='periodization')
+        if depth:
+            image = _shift(image, _approxDelay(self.wavelet, depth))
+        image = image[:-(-self.shape[0] // self.scale),
+                      :-(-self.shape[1] // self.scale)]
+
+        if progress is not None:
+            progress('normalize')
+        return fuse.toUint8(image)
+
+    def full(self, progress=None):
+        """
+        Fuse at full resolution, reusing the preview's decompositions.
+
+        The result is kept, so repeated calls are free.
+
+        Args:
+            progress (callable, optional): Stage callback.
+
+        Returns:
+            numpy.ndarray: Fused uint8 image of the full shape.
+        """
+        if self._full is None:
+            self._full = fuse.fuseDecomposed(
+                self.coeffs1, self.coeffs2, self.slices, self.shape,
+                self.wavelet, self.method, progress, inPlace=False)
+        return self._full
+
+    def save(self, out, progress=None):
+        """
+        Fuse at full resolution and write the result.
+
+        Args:
+            out (str): Output file path.
+            progress (callable, optional): Stage callback, also called
+                with 'save' before writing.
+
+        Returns:
+            str: The output path.
+
+        Raises:
+            IOError: If the output cannot be written.
+        """
+        image = self.full(progress)
+        if progress is not None:
+            progress('save')
+        fuse.writeImage(out, image)
+        return out
@@ -0,0 +1,165 @@
+"""
+fusion_pyramid.py - Laplacian Pyramid Fusion Engine
+
+This module is the 'pyramid' engine of fusion_main.fuseArrays(), an
+alternative to the wavelet ('dwt') engine with the same fuse rules and the
+same output contract.
+
+A Laplacian pyramid splits an image into band-pass detail layers, one per
+level, plus a low-pass residual, using OpenCV's SIMD-optimized pyrDown and
+pyrUp in float32:
+
+    G0 = image,  G(k+1) = pyrDown(Gk)
+    Lk = Gk - pyrUp(G(k+1))            (detail of level k)
+    image = L0 + pyrUp(L1 + pyrUp(... + pyrUp(Gn)))
+
+The residual Gn plays the part of the DWT approximation band and takes the
+rule's 'approx' method; every Lk takes the 'detail' method. Like the DWT,
+the pyramid is linear and reconstructs exactly, so mean-fused chroma can
+still skip the transform.
+
+Example:
+    import fusion_main as fuse
+    fused = fuse.fuseArrays(I1, I2, level=4, engine='pyramid',
+                            method={'approx': 'mean', 'detail': 'energy'})
+"""
+
+import cv2
+import numpy as np
+
+import fusion_main as fuse
+import fusion_trace as trace
+
+
+def maxLevel(shape):
+    """Return the deepest level at which every layer is at least 2x2."""
+    level = 0
+    rows, cols = shape[-2:]
+    while min(rows, cols) >= 4:
+        rows, cols = (rows + 1) // 2, (cols + 1) // 2
+        level += 1
+    return level
+
+
+def decompose(image, level=1):
+    """
+    Build a Laplacian pyramid.
+
+    Args:
+        image (numpy.ndarray): 2D image, or 3D (channels, rows, cols)
+            plane stack.
+        level (int): Number of detail levels. Limited to maxLevel().
+
+    Returns:
+        list: float32 layers [L0, L1, ..., residual], finest first, each
+            with the channel axis first for 3D input.
+    """
+    if image.ndim == 3:
+        planes = [decompose(plane, level) for plane in image]
+        return [np.stack(layers) for layers in zip(*planes)]
+
+    gauss = image.astype(np.float32)
+    layers = []
+    for _ in range(min(level, maxLevel(image.shape))):
+        down = cv2.pyrDown(gauss)
+        up = cv2.pyrUp(down, dstsize=gauss.shape[::-1])
+        # The Gaussian level is not needed any more: turn it into the detail
+        layers.append(np.subtract(gauss, up, out=gauss))
+        gauss = down
+    layers.append(gauss)
+    return layers
+
+
+def reconstruct(layers):
+    """
+    Invert decompose().
+
+    Args:
+        layers (list): Pyramid layers as returned by decompose().
+
+    Returns:
+        numpy.ndarray: float32 image, 2D or plane stack.
+    """
+    if layers[0].ndim == 3:
+        return np.stack([reconstruct([layer[c] for layer in layers])
+                         for c in range(layers[0].shape[0])])
+    image = layers[-1]
+    for detail in reversed(layers[:-1]):
+        image = cv2.pyrUp(image, dstsize=detail.shape[::-1])
+        image += detail
+    return image
+
+
+def fuseBands(layers1, layers2, method='mean'):
+    """
+    Fuse two pyramids in place into `layers1`.
+
+    The residual takes the rule's approximation method, every detail
+    layer its detail method. For color pyramids the rule applies to luma
+    and chroma uses fusion_main.chromaMethod(), as with the DWT engine.
+
+    Args:
+        layers1 (list): Pyramid of image 1, overwritten with the result.
+        layers2 (list): Pyramid of image 2.
+        method (str or dict): Fuse rule, see fusion_main.bandMethods().
+
+    Returns:
+        list: `layers1`.
+    """
+    approx, detail = fuse.bandMethods(method)
+    window = fuse.regionWindow(method)
+    last = len(layers1) - 1
+    for k, (layer1, layer2) in enumerate(zip(layers1, layers2)):
+        rule = approx if k == last else detail
+        if layer1.ndim == 3:
+            chroma = fuse.chromaMethod(method)
+            fuse.fuseCoeff(layer1[0], layer2[0], rule, out=layer1[0],
+                           window=window)
+            fuse.fuseCoeff(layer1[1:], layer2[1:], chroma, out=layer1[1:],
+                           window=window)
+        else:
+            fuse.fuseCoeff(layer1, layer2, rule, out=layer1, window=window)
+    return layers1
+
+
+def fuseDecomposed(layers1, layers2, shape, method='mean', progress=None,
+                   chroma=None):
+    """
+    Fuse two pyramids and turn the result into an 8-bit image.
+
+    The pyramid counterpart of fusion_main.fuseDecomposed(). `layers1` is
+    overwritten.
+
+    Args:
+        layers1 (list): Pyramid of image 1.
+        layers2 (list): Pyramid of image 2.
+        shape (tuple): (rows, cols) of the source images.
+        method (str or dict): Fuse rule.
+        progress (callable, optional): Stage callback, see
+            fusion_main.fuseArrays().
+        chroma (numpy.ndarray, optional): Already fused chroma planes.
+
+    Returns:
+        numpy.ndarray: Fused uint8 image, 3-channel BGR with `chroma` or a
+            color pyramid.
+    """
+    if progress is not None:
+        progress('fuse')
+    with trace.stage('fuse', layers1[0], layers2[0]) as st:
+        fused = fuseBands(layers1, layers2, method)
+        st.output(*fused)
+
+    if progress is not None:
+        progress('reconstruct')
+    with trace.stage('reconstruct', fused[0]) as st:
+        outImage = reconstruct(fused)[..., :shape[0], :shape[1]]
+        if chroma is not None:
+            outImage = np.concatenate((outImage[np.newaxis], chroma))
+        st.output(outImage)
+
+    if progress is not None:
+        progress('normalize')
+    with trace.stage('normalize', outImage) as st:
+        outImage = fuse.toUint8(outImage)
+        st.output(outImage)
+    return outImage
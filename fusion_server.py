@@ -0,0 +1,536 @@
+#!/usr/bin/env python3
+"""
+fusion_server.py - Local Fusion HTTP Service
+
+This module serves fusion over HTTP so other services can call it directly
+instead of shelling out to the GUI. Requests are handled by threads, and
+the fusion itself runs on a pool of worker processes behind a bounded
+queue: when every worker is busy and the queue is full, new requests are
+turned away at once with 429 Too Many Requests and a Retry-After header,
+instead of piling up. The check comes before the request body is read,
+so a turned away upload is never buffered.
+
+Endpoints:
+    POST /fuse
+        multipart/form-data with file fields `image1` and `image2`, or
+        application/json with server-side paths {"img1": ..., "img2": ...}
+        (relative to the server's --root; paths outside it are refused).
+        Optional parameters, as form fields or JSON keys:
+            wavelet (default db5), level (default 1),
+            method (a FUSION_METHODS name or a JSON rule dict),
+            color (true/false), format (png or jpg, default png)
+        Responds with the encoded image. The result is encoded in full
+        by the worker and then written to the socket in chunks.
+
+    GET /stats
+        JSON with queue depth, running and completed jobs, rejections,
+        latency percentiles and throughput.
+
+The server binds to 127.0.0.1 by default.
+
+Usage:
+    python3 fusion_server.py --port 8000 --workers 4 --queue 16
+
+    curl -F image1=@demo/rose1.png -F image2=@demo/rose2.png \\
+         -F level=2 http://127.0.0.1:8000/fuse -o fused.png
+    curl -H 'Content-Type: application/json' \\
+         -d '{"img1": "demo/rose1.png", "img2": "demo/rose2.png"}' \\
+         http://127.0.0.1:8000/fuse -o fused.png
+    curl http://127.0.0.1:8000/stats
+"""
+
+import argparse
+import collections
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from email.parser import BytesParser
+from email.policy import HTTP
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+import fusion_main as fuse
+
+
+# Encoders a client may ask for
+OUTPUT_FORMATS = {'png': ('.png', 'image/png'),
+                  'jpg': ('.jpg', 'image/jpeg')}
+
+# Bytes written per socket write of a response body
+CHUNK_SIZE = 64 * 1024
+
+# Seconds a connection may stall before it is dropped, so a slow upload
+# cannot hold an admission slot forever
+REQUEST_TIMEOUT = 30
+
+# Number of recent latencies the percentiles are computed from
+LATENCY_WINDOW = 1000
+
+
+class RequestError(Exception):
+    """A client error, answered with the given HTTP status."""
+
+    def __init__(self, status, message):
+        Exception.__init__(self, message)
+        self.status = status
+
+
+def _fuseJob(source1, source2, params):
+    """
+    Fuse one request inside a worker process.
+
+    Args:
+        source1 (bytes or str): Encoded image 1, or its file path.
+        source2 (bytes or str): Encoded image 2, or its file path.
+        params (dict): wavelet, level, method, color and format.
+
+    Returns:
+        bytes: The encoded fused image.
+
+    Raises:
+        IOError: If an input cannot be decoded or the result encoded.
+    """
+    import cv2
+
+    flag = int(params['color'])
+    images = []
+    for source in (source1, source2):
+        if isinstance(source, str):
+            image = cv2.imread(source, flag)
+        else:
+            image = cv2.imdecode(np.frombuffer(source, np.uint8), flag)
+        if image is None:
+            raise IOError("Cannot decode image %d" % (len(images) + 1))
+        images.append(image)
+
+    fused = fuse.fuseArrays(images[0], images[1], params['wavelet'],
+                            params['level'], params['method'],
+                            color=params['color'])
+    ok, encoded = cv2.imencode(OUTPUT_FORMATS[params['format']][0], fused)
+    if not ok:
+        raise IOError("Cannot encode the result")
+    return encoded.tobytes()
+
+
+def parseParams(fields):
+    """
+    Validate the fusion parameters of a request.
+
+    Args:
+        fields (dict): Raw parameter values, strings for form fields.
+
+    Returns:
+        dict: wavelet, level, method, color and format.
+
+    Raises:
+        RequestError: 400 if a parameter is invalid.
+    """
+    import pywt
+
+    wavelet = fields.get('wavelet', 'db5')
+    if not isinstance(wavelet, str) or \
+            wavelet not in pywt.wavelist(kind='discrete'):
+        raise RequestError(400, "Unknown wavelet: %s" % wavelet)
+    try:
+        level = int(fields.get('level', 1))
+    except (TypeError, ValueError):
+        raise RequestError(400, "level must be an integer")
+    if not 1 <= level <= 10:
+        raise RequestError(400, "level must be between 1 and 10")
+
+    method = fields.get('method', 'mean')
+    if isinstance(method, str) and method.startswith('{'):
+        try:
+            method = json.loads(method)
+        except ValueError:
+            raise RequestError(400, "method is not valid JSON")
+    try:
+        fuse.bandMethods(method)
+        fuse.chromaMethod(method)
+        fuse.regionWindow(method)
+    except (ValueError, AttributeError, TypeError) as e:
+        raise RequestError(400, "Invalid method: %s" % e)
+
+    color = fields.get('color', False)
+    if isinstance(color, str):
+        color = color.lower() in ('1', 'true', 'yes', 'on')
+
+    fmt = fields.get('format', 'png')
+    if not isinstance(fmt, str) or fmt not in OUTPUT_FORMATS:
+        raise RequestError(400, "format must be one of: " +
+                           ", ".join(sorted(OUTPUT_FORMATS)))
+    return {'wavelet': wavelet, 'level': level, 'method': method,
+            'color': bool(color), 'format': fmt}
+
+
+def parseMultipart(contentType, body):
+    """
+    Split a multipart/form-data body into its fields.
+
+    Args:
+        contentType (str): The request's Content-Type header, with the
+            boundary.
+        body (bytes): The request body.
+
+    Returns:
+        tuple: (files, fields) where `files` maps field names to bytes
+            for file uploads and `fields` maps names to strings.
+    """
+    message = BytesParser(policy=HTTP).parsebytes(
+        b'Content-Type: ' + contentType.encode('latin-1') + b'\r\n\r\n' +
+        body)
+    files = {}
+    fields = {}
+    for part in message.iter_parts():
+        name = part.get_param('name', header='content-disposition')
+        if name is None:
+            continue
+        payload = part.get_payload(decode=True) or b''
+        if part.get_filename() is not None:
+            files[name] = payload
+        else:
+            fields[name] = payload.decode('utf-8', 'replace')
+    return files, fields
+
+
+class ServerStats(object):
+    """
+    Thread-safe counters and latency window of a FusionServer.
+
+    Attributes:
+        workers (int): Number of worker processes.
+    """
+
+    def __init__(self, workers):
+        self.workers = workers
+        self.started = time.time()
+        self.pending = 0
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+        self._latencies = collections.deque(maxlen=LATENCY_WINDOW)
+        self._finished = collections.deque()
+        self._lock = threading.Lock()
+
+    def accept(self):
+        with self._lock:
+            self.pending += 1
+
+    def reject(self):
+        with self._lock:
+            self.rejected += 1
+
+    def finish(self, latency, ok):
+        now = time.time()
+        with self._lock:
+            self.pending -= 1
+            if ok:
+                self.completed += 1
+                self._latencies.append(latency)
+                self._finished.append(now)
+            else:
+                self.failed += 1
+
+    def snapshot(self):
+        """
+        Return the current statistics.
+
+        Returns:
+            dict: Queue depth (jobs waiting for a worker), running,
+                completed, failed and rejected job counts, latency
+                percentiles in seconds over the last LATENCY_WINDOW jobs,
+                and throughput in jobs per second over the last minute and
+                since start.
+        """
+        now = time.time()
+        with self._lock:
+            while self._finished and self._finished[0] < now - 60:
+                self._finished.popleft()
+            latencies = np.array(self._latencies)
+            recent = len(self._finished)
+            snapshot = {
+                'queue_depth': max(0, self.pending - self.workers),
+                'running': min(self.pending, self.workers),
+                'workers': self.workers,
+                'completed': self.completed,
+                'failed': self.failed,
+                'rejected': self.rejected,
+                'uptime': now - self.started,
+            }
+        if latencies.size:
+            p50, p95, p99 = np.percentile(latencies, (50, 95, 99))
+            snapshot['latency'] = {'p50': p50, 'p95': p95, 'p99': p99,
+                                   'max': float(latencies.max())}
+        else:
+            snapshot['latency'] = None
+        window = min(60.0, snapshot['uptime'])
+        snapshot['throughput'] = {
+            'last_minute': recent / window if window > 0 else 0.0,
+            'overall': snapshot['completed'] / snapshot['uptime']
+            if snapshot['uptime'] > 0 else 0.0,
+        }
+        return snapshot
+
+
+class FusionServer(ThreadingHTTPServer):
+    """
+    HTTP server running fusions on a process pool behind a bounded queue.
+
+    At most `workers + queueSize` jobs are accepted at a time; the rest
+    are answered with 429.
+
+    Attributes:
+        pool (ProcessPoolExecutor): Worker processes.
+        stats (ServerStats): Counters reported by GET /stats.
+        root (str): Directory that server-side paths must lie in.
+        maxUpload (int): Largest accepted request body, in bytes.
+        quiet (bool): Do not log every request.
+    """
+
+    daemon_threads = True
+    quiet = False
+
+    def __init__(self, address=('127.0.0.1', 8000), workers=None,
+                 queueSize=16, root='.', maxUpload=256 * 1024 * 1024):
+        """
+        Args:
+            address (tuple): (host, port) to bind to. Port 0 picks a free
+                port, see server_address.
+            workers (int, optional): Worker processes. Defaults to the
+                number of CPUs.
+            queueSize (int): Jobs that may wait for a free worker.
+            root (str): Directory for server-side paths.
+            maxUpload (int): Largest accepted request body, in bytes.
+        """
+        ThreadingHTTPServer.__init__(self, address, FusionHandler)
+        workers = workers or os.cpu_count() or 1
+        self.pool = ProcessPoolExecutor(max_workers=workers)
+        self.stats = ServerStats(workers)
+        self.slots = threading.BoundedSemaphore(workers + queueSize)
+        self.root = os.path.realpath(root)
+        self.maxUpload = maxUpload
+
+    def server_close(self):
+        ThreadingHTTPServer.server_close(self)
+        self.pool.shutdown(wait=True)
+
+    def resolve(self, path):
+        """
+        Resolve a server-side path inside `root`.
+
+        Raises:
+            RequestError: 400 if `path` is not a string, 403 if it lies
+                outside `root`, 404 if it does not exist.
+        """
+        if not isinstance(path, str):
+            raise RequestError(400, "Paths must be strings")
+        full = os.path.realpath(os.path.join(self.root, path))
+        if os.path.commonpath((full, self.root)) != self.root:
+            raise RequestError(403, "Path outside the server root: " + path)
+        if not os.path.isfile(full):
+            raise RequestError(404, "No such file: " + path)
+        return full
+
+
+class FusionHandler(BaseHTTPRequestHandler):
+    """Request handler of FusionServer."""
+
+    server_version = 'ImfusionServer/1.0'
+    timeout = REQUEST_TIMEOUT
+
+    def do_GET(self):
+        if self.path.split('?')[0] == '/stats':
+            self.sendJson(200, self.server.stats.snapshot())
+        else:
+            self.sendJson(404, {'error': 'Not found'})
+
+    def do_POST(self):
+        if self.path.split('?')[0] != '/fuse':
+            self.sendJson(404, {'error': 'Not found'})
+            return
+        try:
+            length = self.contentLength()
+        except RequestError as e:
+            # The body is left unread: drop the connection with it
+            self.close_connection = True
+            self.sendJson(e.status, {'error': str(e)},
+                          {'Connection': 'close'})
+            return
+
+        # Admission control: refuse at once rather than queue unboundedly.
+        # Checked before reading the body, so rejected uploads cost no
+        # memory; their connection is closed unread.
+        if not self.server.slots.acquire(blocking=False):
+            self.server.stats.reject()
+            self.close_connection = True
+            self.sendJson(429, {'error': 'Server busy, retry later'},
+                          {'Retry-After': '1', 'Connection': 'close'})
+            return
+
+        # Whatever happens from here on, the slot is given back
+        try:
+            result, params = self.runJob(length)
+        finally:
+            self.server.slots.release()
+        if result is None:
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', OUTPUT_FORMATS[params['format']][1])
+        self.send_header('Content-Length', str(len(result)))
+        self.end_headers()
+        # The encoded result is already in memory; write it in slices
+        view = memoryview(result)
+        for offset in range(0, len(view), CHUNK_SIZE):
+            self.wfile.write(view[offset:offset + CHUNK_SIZE])
+
+    def runJob(self, length):
+        """
+        Read a request whose admission slot is held, and fuse it.
+
+        Errors are answered here; the caller releases the slot.
+
+        Args:
+            length (int): Body size, see contentLength().
+
+        Returns:
+            tuple: (result, params) with the encoded image, or (None,
+                None) once an error response has been sent.
+        """
+        try:
+            source1, source2, params = self.readRequest(length)
+        except RequestError as e:
+            self.sendJson(e.status, {'error': str(e)})
+            return None, None
+        except OSError:
+            # Stalled past the timeout or reset: nobody to answer
+            self.close_connection = True
+            return None, None
+
+        stats = self.server.stats
+        stats.accept()
+        start = time.perf_counter()
+        try:
+            future = self.server.pool.submit(_fuseJob, source1, source2,
+                                             params)
+            result = future.result()
+        except (IOError, ValueError) as e:
+            stats.finish(time.perf_counter() - start, False)
+            self.sendJson(422, {'error': str(e)})
+            return None, None
+        except Exception as e:
+            stats.finish(time.perf_counter() - start, False)
+            self.sendJson(500, {'error': "%s: %s" % (type(e).__name__, e)})
+            return None, None
+        stats.finish(time.perf_counter() - start, True)
+        return result, params
+
+    def contentLength(self):
+        """
+        Return the announced body size of a request, without reading it.
+
+        Raises:
+            RequestError: 411 without a valid Content-Length, 413 if it
+                exceeds the server's maxUpload.
+        """
+        try:
+            length = int(self.headers.get('Content-Length', ''))
+        except ValueError:
+            raise RequestError(411, "Content-Length required")
+        if length < 0:
+            raise RequestError(400, "Invalid Content-Length")
+        if length > self.server.maxUpload:
+            raise RequestError(413, "Request body too large")
+        return length
+
+    def readRequest(self, length):
+        """
+        Read the images and parameters of a POST /fuse request.
+
+        Args:
+            length (int): Body size, see contentLength().
+
+        Returns:
+            tuple: (source1, source2, params) where each source is the
+                uploaded bytes or a resolved server-side path.
+
+        Raises:
+            RequestError: For malformed, oversized or incomplete requests.
+        """
+        body = self.rfile.read(length)
+        if len(body) < length:
+            raise RequestError(400, "Request body ended early")
+
+        contentType = self.headers.get('Content-Type', '')
+        if contentType.startswith('multipart/form-data'):
+            files, fields = parseMultipart(contentType, body)
+            if 'image1' not in files or 'image2' not in files:
+                raise RequestError(400, "Upload files image1 and image2")
+            return files['image1'], files['image2'], parseParams(fields)
+        if contentType.startswith('application/json'):
+            try:
+                fields = json.loads(body.decode('utf-8'))
+            except ValueError:
+                raise RequestError(400, "Body is not valid JSON")
+            if not isinstance(fields, dict) or 'img1' not in fields or \
+                    'img2' not in fields:
+                raise RequestError(400, "Give img1 and img2 paths")
+            return (self.server.resolve(fields['img1']),
+                    self.server.resolve(fields['img2']),
+                    parseParams(fields))
+        raise RequestError(415, "Use multipart/form-data or application/json")
+
+    def sendJson(self, status, payload, headers=None):
+        """Send a JSON response."""
+        body = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        if not self.server.quiet:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+
+def main(argv=None):
+    """Command line entry point."""
+    parser = argparse.ArgumentParser(
+        description="Serve image fusion over HTTP on localhost.")
+    parser.add_argument('--host', default='127.0.0.1',
+                        help="address to bind (default: 127.0.0.1)")
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('-j', '--workers', type=int, default=None,
+                        help="worker processes (default: CPU count)")
+    parser.add_argument('--queue', type=int, default=16,
+                        help="jobs that may wait for a worker (default: 16)")
+    parser.add_argument('--root', default='.',
+                        help="directory for server-side paths (default: .)")
+    parser.add_argument('--quiet', action='store_true',
+                        help="do not log every request")
+    args = parser.parse_args(argv)
+
+    server = FusionServer((args.host, args.port), args.workers, args.queue,
+                          args.root)
+    server.quiet = args.quiet
+    host, port = server.server_address[:2]
+    print("Serving fusion on http://%s:%d/ with %d workers" % (
+        host, port, server.stats.workers))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
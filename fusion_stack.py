@@ -0,0 +1,254 @@
+#!/usr/bin/env python3
+"""
+fusion_stack.py - Streaming N-Image Stack Fusion
+
+This module fuses any number of captures of the same scene, for focus
+stacking or multi-exposure fusion, instead of just two. Images are
+streamed one at a time: each is decomposed with fusion_main.decompose()
+and folded into a running accumulator of packed wavelet coefficients, so
+memory stays constant no matter how many images are in the stack. The
+next image is decoded on a background thread while the current one is
+being transformed.
+
+Stack rules:
+    - 'mean': Average of all coefficients
+    - 'maxabs': Detail coefficient with the largest magnitude wins, the
+      approximation is averaged (keeps the sharpest detail of every
+      region, the usual choice for focus stacking)
+    - 'weighted': Weighted average with one weight per image (e.g. an
+      exposure or quality score)
+
+Usage:
+    python3 fusion_stack.py stacked.jpg shot_*.png --rule maxabs
+
+Example:
+    import fusion_stack
+    fusion_stack.fusionStack(["f1.png", "f2.png", "f3.png"], "out.jpg",
+                             rule='maxabs', level=3)
+"""
+
+import argparse
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+
+import fusion_align
+import fusion_main as fuse
+
+
+# Accumulation rules understood by fuseStackArrays()
+STACK_RULES = ('mean', 'maxabs', 'weighted')
+
+
+def fuseStackArrays(images, rule='mean', weights=None, wavelet='db5',
+                    level=1, color=False, align=None):
+    """
+    Fuse a stream of images held in memory.
+
+    Only the accumulators and the decomposition of the current image are
+    kept, so `images` may be a generator producing them one by one.
+
+    Args:
+        images (iterable): 2D grayscale or 3-channel BGR images. Every
+            image is resized to the size of the first one.
+        rule (str): One of STACK_RULES.
+        weights (sequence, optional): One weight per image, required by
+            the 'weighted' rule.
+        wavelet (str): Wavelet name. Defaults to 'db5'.
+        level (int): Number of decomposition levels. Defaults to 1.
+        color (bool): Fuse in color. The rule applies to luma; chroma is
+            always averaged (weighted under 'weighted').
+        align (str, optional): Register every image to the first one
+            with this motion model instead of resizing it, see
+            fusion_align.py. Hand-held stacks need it.
+
+    Returns:
+        numpy.ndarray: Fused uint8 image, 2D or, with `color`, 3-channel
+            BGR.
+
+    Raises:
+        ValueError: If the rule or motion model is unknown, weights are
+            missing, not finite, sum to zero or do not match the number
+            of images, or `images` is empty.
+    """
+    if rule not in STACK_RULES:
+        raise ValueError("Unknown stack rule: " + str(rule))
+    if rule == 'weighted' and weights is None:
+        raise ValueError("The 'weighted' rule needs one weight per image")
+    if rule == 'weighted':
+        if not np.all(np.isfinite(weights)):
+            raise ValueError("Weights must be finite numbers")
+        # The accumulators are divided by the sum
+        if np.sum(weights) == 0:
+            raise ValueError("Weights must not sum to zero")
+    if align is not None and align not in fusion_align.MOTIONS:
+        raise ValueError("Unknown motion model: " + str(align))
+
+    acc = None          # running (weighted) sum of luma coefficients
+    chroma = None       # running (weighted) sum of chroma planes
+    sharpest = None     # largest-magnitude coefficients so far, 'maxabs'
+    count = 0
+    total = 0.0
+    for image in images:
+        if acc is None:
+            shape = image.shape[:2]
+            reference = image if align is not None else None
+        elif align is not None:
+            image, _ = fusion_align.align(reference, image, align)
+        elif image.shape[:2] != shape:
+            image = cv2.resize(image, shape[::-1])
+
+        weight = 1.0
+        if rule == 'weighted':
+            if count >= len(weights):
+                raise ValueError("More images than weights")
+            weight = weights[count]
+        total += weight
+
+        image = fuse.toWorkingSpace(image, color)
+        if color:
+            # Averaging commutes with the DWT, so chroma is summed in the
+            # pixel domain and only luma is ever decomposed
+            planes = np.multiply(image[1:], weight, dtype=np.float64)
+            if chroma is None:
+                chroma = planes
+            else:
+                chroma += planes
+            image = image[0]
+
+        coeffs, slices = fuse.decompose(image, wavelet, level)
+        if rule == 'maxabs':
+            if sharpest is None:
+                sharpest = coeffs.copy()
+            else:
+                larger = np.greater(np.abs(coeffs), np.abs(sharpest))
+                np.copyto(sharpest, coeffs, where=larger)
+        elif weight != 1.0:
+            coeffs *= weight
+
+        # The first decomposition becomes the accumulator
+        if acc is None:
+            acc = coeffs
+        else:
+            acc += coeffs
+        count += 1
+
+    if acc is None:
+        raise ValueError("No images to fuse")
+    if rule == 'weighted' and count != len(weights):
+        raise ValueError("%d weights given for %d images"
+                         % (len(weights), count))
+
+    acc /= total
+    if sharpest is not None:
+        # Detail bands take the sharpest coefficient, the approximation
+        # stays averaged
+        band = slices[0][-2:]
+        sharpest[band] = acc[band]
+        acc = sharpest
+
+    outImage = fuse.reconstruct(acc, slices, wavelet)[:shape[0], :shape[1]]
+    if chroma is not None:
+        chroma /= total
+        outImage = np.concatenate((outImage[np.newaxis], chroma))
+    return fuse.toUint8(outImage)
+
+
+def readAhead(paths, color=False):
+    """
+    Decode images, one ahead of the consumer.
+
+    While the caller works on image k, image k+1 is decoded on a
+    background thread, so decoding overlaps with the wavelet transform.
+    At most two decoded images exist at any time.
+
+    Args:
+        paths (sequence): Image file paths.
+        color (bool): Decode as 3-channel BGR instead of grayscale.
+
+    Yields:
+        numpy.ndarray: Decoded uint8 images in order.
+
+    Raises:
+        IOError: If an image cannot be read.
+    """
+    def load(path):
+        image = cv2.imread(path, int(color))
+        if image is None:
+            raise IOError("Cannot read image: " + path)
+        return image
+
+    if not paths:
+        return
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        pending = pool.submit(load, paths[0])
+        for path in paths[1:]:
+            current = pending.result()
+            pending = pool.submit(load, path)
+            yield current
+            del current
+        yield pending.result()
+
+
+def fusionStack(paths, out=None, rule='mean', weights=None, wavelet='db5',
+                level=1, color=False, align=None):
+    """
+    Fuse a stack of image files into one image.
+
+    Args:
+        paths (sequence): Image file paths, at least one.
+        out (str, optional): File path to write the fused image to.
+            Defaults to fusion_main.outputPath().
+        rule (str): One of STACK_RULES.
+        weights (sequence, optional): One weight per image for 'weighted'.
+        wavelet (str): Wavelet name. Defaults to 'db5'.
+        level (int): Number of decomposition levels. Defaults to 1.
+        color (bool): Fuse in color, see fuseStackArrays().
+        align (str, optional): Motion model to register the images with,
+            see fuseStackArrays().
+
+    Returns:
+        str: File path to the generated fused image.
+
+    Raises:
+        IOError: If an input cannot be read or the output written.
+        ValueError: See fuseStackArrays().
+    """
+    outImage = fuseStackArrays(readAhead(list(paths), color), rule, weights,
+                               wavelet, level, color, align)
+    loc = fuse.outputPath() if out is None else out
+    fuse.writeImage(loc, outImage)
+    return loc
+
+
+def main(argv=None):
+    """Command line entry point."""
+    parser = argparse.ArgumentParser(
+        description="Fuse a stack of captures of the same scene.")
+    parser.add_argument('out', help="output image path")
+    parser.add_argument('images', nargs='+', help="input images")
+    parser.add_argument('--rule', choices=STACK_RULES, default='mean',
+                        help="accumulation rule (default: mean)")
+    parser.add_argument('--weights', type=float, nargs='+',
+                        help="one weight per image for --rule weighted")
+    parser.add_argument('--wavelet', default='db5',
+                        help="wavelet name (default: db5)")
+    parser.add_argument('--level', type=int, default=1,
+                        help="decomposition levels (default: 1)")
+    parser.add_argument('--color', action='store_true',
+                        help="fuse in color instead of grayscale")
+    parser.add_argument('--align', choices=fusion_align.MOTIONS,
+                        help="register every image to the first one with "
+                             "this motion model")
+    args = parser.parse_args(argv)
+
+    fusionStack(args.images, args.out, args.rule, args.weights,
+                args.wavelet, args.level, args.color, args.align)
+    print(args.out)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,363 @@
+#!/usr/bin/env python3
+"""
+fusion_store.py - Content-Addressed Result Store
+
+This module keeps fused images under a key derived from what they were made
+of: the content of both input files and every parameter that affects the
+output. Asking for a result that was fused before returns the stored file
+instead of fusing again, so re-running a large batch after a few inputs
+changed only recomputes the changed pairs. Renaming or moving an input does
+not invalidate its results; editing it does.
+
+Layout:
+    <root>/<first two key characters>/<key><ext>
+
+Results are written to a temporary file in the same directory and renamed
+into place, so a crash or a concurrent run never leaves a truncated result
+behind. A hit refreshes the file's modification time, which evict() uses to
+drop the least recently used results first.
+
+Usage:
+    python3 fusion_store.py stats --root .fusion_store
+    python3 fusion_store.py evict --root .fusion_store --max-size 2G
+
+Example:
+    from fusion_store import FusionStore
+
+    store = FusionStore(".fusion_store")
+    path, hit = store.fuse("demo/rose1.png", "demo/rose2.png", level=3,
+                           method='maxabs')
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import sys
+import threading
+import time
+
+import fusion_main as fuse
+
+
+# Bumped whenever a change to the fusion algorithm alters its output, so
+# results stored by an older version are not reused
+STORE_VERSION = 1
+
+# Parameters of fusion_main.fusion() that change the result, with their
+# defaults. Keys always include all of them, so passing a default
+# explicitly gives the same key as leaving it out.
+RESULT_PARAMS = {
+    'wavelet': 'db5',
+    'level': 1,
+    'method': 'mean',
+    'color': False,
+    'engine': 'dwt',
+    'precision': 'float64',
+    'align': None,
+}
+
+# Parameters that only affect how a result is computed
+_NEUTRAL_PARAMS = ('cache', 'workspace', 'progress', 'threads')
+
+# Temporary files older than this (seconds) are left over from a crash
+_STALE_TEMP = 3600
+
+_CHUNK = 1 << 20
+
+# File digests by (path, size, mtime), so a file is hashed once per process
+# unless it changes
+_digests = {}
+_digestsLock = threading.Lock()
+
+
+def fileDigest(path):
+    """
+    Return the SHA-256 hex digest of a file's content.
+
+    Args:
+        path (str): File path.
+
+    Returns:
+        str: 64 hex characters.
+
+    Raises:
+        IOError: If the file cannot be read.
+    """
+    st = os.stat(path)
+    ident = (os.path.realpath(path), st.st_size, st.st_mtime_ns)
+    with _digestsLock:
+        digest = _digests.get(ident)
+    if digest is not None:
+        return digest
+
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(_CHUNK), b''):
+            h.update(chunk)
+    digest = h.hexdigest()
+    with _digestsLock:
+        if len(_digests) >= 4096:
+            _digests.clear()
+        _digests[ident] = digest
+    return digest
+
+
+def resultKey(img1, img2, params=None):
+    """
+    Return the key of the result of fusing two files.
+
+    Args:
+        img1 (str): File path to the first input image.
+        img2 (str): File path to the second input image.
+        params (dict, optional): Keyword arguments of
+            fusion_main.fusion(). Missing ones take RESULT_PARAMS
+            defaults; cache, workspace, progress and threads are
+            ignored.
+
+    Returns:
+        str: 64 hex characters, equal for equal inputs and parameters.
+
+    Raises:
+        IOError: If an input cannot be read.
+        ValueError: If `params` holds an unknown parameter.
+    """
+    merged = dict(RESULT_PARAMS)
+    for name, value in (params or {}).items():
+        if name in _NEUTRAL_PARAMS:
+            continue
+        if name not in RESULT_PARAMS:
+            raise ValueError("Unknown fusion parameter: " + str(name))
+        merged[name] = value
+    record = {
+        'version': STORE_VERSION,
+        'inputs': [fileDigest(img1), fileDigest(img2)],
+        'params': merged,
+    }
+    data = json.dumps(record, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+
+def copyFile(src, dst):
+    """Copy `src` to `dst` atomically: `dst` is whole or untouched."""
+    tmp = fuse.tempPath(dst)
+    try:
+        shutil.copyfile(src, tmp)
+        os.replace(tmp, dst)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+        raise
+
+
+def parseSize(text):
+    """
+    Parse a byte count such as '500M' or '2G'.
+
+    Args:
+        text (str): Number with an optional K, M, G or T suffix (powers
+            of 1024).
+
+    Returns:
+        int: Number of bytes.
+
+    Raises:
+        ValueError: If the text is not a size.
+    """
+    units = {'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30, 'T': 1 << 40}
+    text = text.strip().upper().rstrip('B')
+    scale = units.get(text[-1:], 1)
+    if text[-1:] in units:
+        text = text[:-1]
+    return int(float(text) * scale)
+
+
+class FusionStore(object):
+    """
+    Fused images stored under content-derived keys.
+
+    Safe to use from several threads and processes at once: two runs
+    fusing the same pair both write it, and the last rename wins with an
+    identical file.
+
+    Attributes:
+        root (str): Directory holding the store.
+        hits (int): Results served from the store.
+        misses (int): Results that had to be fused.
+    """
+
+    def __init__(self, root='.fusion_store'):
+        """
+        Args:
+            root (str): Store directory, created if needed.
+        """
+        self.root = root
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+
+    def path(self, key, ext='.jpg'):
+        """Return the file path of the result `key`, stored or not."""
+        return os.path.join(self.root, key[:2], key + ext)
+
+    def get(self, key, ext='.jpg'):
+        """
+        Look up a stored result.
+
+        Args:
+            key (str): Key from resultKey().
+            ext (str): Image extension the result was stored with.
+
+        Returns:
+            str: File path of the result, or None if it is not stored.
+        """
+        path = self.path(key, ext)
+        try:
+            # Mark it as recently used for evict()
+            os.utime(path)
+        except OSError:
+            return None
+        return path
+
+    def fuse(self, img1, img2, out=None, ext=None, **options):
+        """
+        Fuse two files, or take the result from the store.
+
+        Args:
+            img1 (str): File path to the first input image.
+            img2 (str): File path to the second input image.
+            out (str, optional): Also copy the result to this path.
+            ext (str, optional): Image extension to store the result
+                with. Defaults to that of `out`, or '.jpg'.
+            **options: Keyword arguments for fusion_main.fusion().
+
+        Returns:
+            tuple: (path, hit) where `path` is `out`, or the stored file
+                without `out`, and `hit` tells whether fusing was
+                skipped.
+
+        Raises:
+            IOError: If an input cannot be read or a file written.
+            ValueError: If a parameter is unknown or invalid.
+        """
+        if ext is None:
+            ext = os.path.splitext(out)[1] if out else '.jpg'
+        key = resultKey(img1, img2, options)
+        path = self.get(key, ext)
+        hit = path is not None
+        if not hit:
+            path = self.path(key, ext)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # fusion() writes through a temporary file and a rename
+            fuse.fusion(img1, img2, out=path, **options)
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+        if out is None:
+            return path, hit
+        copyFile(path, out)
+        return out, hit
+
+    def _files(self):
+        """Yield (path, size, mtime, temporary) for every file stored."""
+        for directory, _, names in os.walk(self.root):
+            for name in names:
+                path = os.path.join(directory, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue  # removed meanwhile
+                yield path, st.st_size, st.st_mtime, name.startswith('.tmp-')
+
+    def stats(self):
+        """
+        Return the store's size and this instance's hit counts.
+
+        Returns:
+            dict: files, bytes, hits and misses.
+        """
+        files = [f for f in self._files() if not f[3]]
+        return {
+            'files': len(files),
+            'bytes': sum(f[1] for f in files),
+            'hits': self.hits,
+            'misses': self.misses,
+        }
+
+    def evict(self, maxBytes):
+        """
+        Delete least recently used results until the store fits.
+
+        Temporary files left behind by crashed runs are deleted as well.
+
+        Args:
+            maxBytes (int): Size, in bytes, to shrink the store to.
+
+        Returns:
+            dict: removed (files), freed (bytes) and bytes (remaining).
+        """
+        now = time.time()
+        files = []
+        removed = freed = 0
+        for path, size, mtime, temporary in self._files():
+            if temporary:
+                if now - mtime > _STALE_TEMP:
+                    removed, freed = self._remove(path, size, removed, freed)
+            else:
+                files.append((mtime, size, path))
+
+        total = sum(size for _, size, _ in files)
+        for mtime, size, path in sorted(files):
+            if total <= maxBytes:
+                break
+            removed, freed = self._remove(path, size, removed, freed)
+            total -= size
+        return {'removed': removed, 'freed': freed, 'bytes': total}
+
+    @staticmethod
+    def _remove(path, size, removed, freed):
+        try:
+            os.unlink(path)
+        except OSError:
+            return removed, freed
+        try:
+            os.rmdir(os.path.dirname(path))  # only once it is empty
+        except OSError:
+            pass
+        return removed + 1, freed + size
+
+
+def main(argv=None):
+    """Command line entry point."""
+    parser = argparse.ArgumentParser(
+        description="Inspect or shrink a fusion result store.")
+    parser.add_argument('--root', default='.fusion_store',
+                        help="store directory (default: .fusion_store)")
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+    commands.add_parser('stats', help="print the number and size of results")
+    evict = commands.add_parser(
+        'evict', help="delete least recently used results")
+    evict.add_argument('--max-size', type=parseSize, required=True,
+                       help="size to shrink the store to, e.g. 500M or 2G")
+    args = parser.parse_args(argv)
+
+    store = FusionStore(args.root)
+    if args.command == 'stats':
+        stats = store.stats()
+        print("%d results, %.1f MiB" % (stats['files'],
+                                        stats['bytes'] / (1 << 20)))
+    else:
+        result = store.evict(args.max_size)
+        print("removed %d results (%.1f MiB), %.1f MiB left" % (
+            result['removed'], result['freed'] / (1 << 20),
+            result['bytes'] / (1 << 20)))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,468 @@
+#!/usr/bin/env python3
+"""
+fusion_sweep.py - Fuse Rule and Wavelet Sweep with Quality Metrics
+
+Choosing a fuse rule or a wavelet used to mean running fusion() once per
+candidate and comparing the results by eye. This module tries every
+combination of the requested wavelets and rules on one pair and ranks the
+results with objective, no-reference fusion metrics:
+
+    - 'entropy': Shannon entropy of the fused image, in bits (information
+      content)
+    - 'sf': Spatial frequency, the RMS of horizontal and vertical pixel
+      differences (overall activity and sharpness)
+    - 'mi': Mutual information of the fused image with each source,
+      summed, in bits (how much of the sources it carries)
+    - 'ssim': Mean structural similarity with the two sources, averaged
+    - 'qabf': Xydeas-Petrovic Q^AB/F, the share of the sources' Sobel edge
+      strength and orientation that survives in the fused image, weighted
+      by source edge strength (0 to 1)
+
+Higher is better for all of them; results are ranked by one of them,
+'qabf' by default.
+
+The inputs are decoded once and decomposed once per wavelet; every rule of
+that wavelet is fused from the same two decompositions into one reused
+output buffer. Every metric is computed with whole-array numpy and OpenCV
+operations, and everything that only depends on the sources (gradients,
+histograms, local means and variances) is computed once per sweep, not
+once per candidate.
+
+Usage:
+    python3 fusion_sweep.py demo/medical1.png demo/medical2.png
+    python3 fusion_sweep.py demo/rose1.png demo/rose2.png --wavelets db5 haar sym4 \\
+        --methods mean min max maxabs energy --level 3 --rank ssim --best best.jpg
+
+Example:
+    import fusion_sweep
+    results = fusion_sweep.sweep("demo/rose1.png", "demo/rose2.png",
+                                 wavelets=('db5', 'haar'), level=2,
+                                 out="best.jpg")
+    print(results[0]['wavelet'], results[0]['method'], results[0]['qabf'])
+"""
+
+import argparse
+import json
+import sys
+import time
+
+import cv2
+import numpy as np
+
+import fusion_main as fuse
+
+
+# Metrics computed by Scorer.score(), in table order
+METRICS = ('entropy', 'sf', 'mi', 'ssim', 'qabf')
+
+# Rules tried by default
+SWEEP_METHODS = ('mean', 'min', 'max', 'maxabs')
+
+# SSIM constants for 8-bit images and its Gaussian window
+_SSIM_C1 = (0.01 * 255) ** 2
+_SSIM_C2 = (0.03 * 255) ** 2
+_SSIM_SIGMA = 1.5
+
+# Q^AB/F sigmoid constants for edge strength (g) and orientation (a), as
+# given by Xydeas and Petrovic
+_QG = (0.9994, -15.0, 0.5)
+_QA = (0.9879, -22.0, 0.8)
+
+
+def entropy(image):
+    """
+    Return the Shannon entropy of an 8-bit image.
+
+    Args:
+        image (numpy.ndarray): uint8 image.
+
+    Returns:
+        float: Entropy in bits per pixel, 0 to 8.
+    """
+    counts = np.bincount(image.ravel(), minlength=256)
+    p = counts[counts > 0] / image.size
+    return float(-(p * np.log2(p)).sum())
+
+
+def spatialFrequency(image):
+    """
+    Return the spatial frequency of an image.
+
+    Args:
+        image (numpy.ndarray): 2D image.
+
+    Returns:
+        float: sqrt(RF^2 + CF^2), RF and CF being the RMS differences
+            between neighbouring pixels along rows and columns.
+    """
+    image = image.astype(np.float32)
+    rf = np.mean(np.square(np.diff(image, axis=1)))
+    cf = np.mean(np.square(np.diff(image, axis=0)))
+    return float(np.sqrt(rf + cf))
+
+
+def mutualInformation(a, b):
+    """
+    Return the mutual information of two 8-bit images of the same size.
+
+    Args:
+        a (numpy.ndarray): uint8 image.
+        b (numpy.ndarray): uint8 image.
+
+    Returns:
+        float: Mutual information in bits.
+    """
+    joint = np.bincount(a.ravel().astype(np.intp) * 256 + b.ravel(),
+                        minlength=65536).reshape(256, 256)
+    return _mutualInformation(joint / a.size)
+
+
+def _mutualInformation(joint):
+    """Mutual information of a normalized 256x256 joint histogram."""
+    pa = joint.sum(axis=1, keepdims=True)
+    pb = joint.sum(axis=0, keepdims=True)
+    nz = joint > 0
+    return float((joint[nz] * np.log2(joint[nz] / (pa @ pb)[nz])).sum())
+
+
+def _localStats(image):
+    """Return the Gaussian local mean and variance used by SSIM."""
+    image = image.astype(np.float32)
+    mean = cv2.GaussianBlur(image, (11, 11), _SSIM_SIGMA)
+    var = cv2.GaussianBlur(image * image, (11, 11), _SSIM_SIGMA)
+    var -= mean * mean
+    return image, mean, var
+
+
+def _ssim(x, y):
+    """Mean SSIM of two images given as _localStats() triples."""
+    image1, mu1, var1 = x
+    image2, mu2, var2 = y
+    # Reuse the image-sized temporaries in place
+    mu12 = mu1 * mu2
+    cov = cv2.GaussianBlur(image1 * image2, (11, 11), _SSIM_SIGMA)
+    cov -= mu12
+    cov *= 2
+    cov += _SSIM_C2
+    mu12 *= 2
+    mu12 += _SSIM_C1
+    num = np.multiply(mu12, cov, out=cov)
+    den = np.square(mu1)
+    den += np.square(mu2, out=mu12)
+    den += _SSIM_C1
+    var = np.add(var1, var2, out=mu12)
+    var += _SSIM_C2
+    den *= var
+    num /= den
+    return float(np.mean(num))
+
+
+def ssim(a, b):
+    """
+    Return the mean structural similarity (SSIM) of two 8-bit images.
+
+    Uses the usual 11x11 Gaussian window with sigma 1.5.
+
+    Args:
+        a (numpy.ndarray): 2D image.
+        b (numpy.ndarray): 2D image of the same size.
+
+    Returns:
+        float: Mean SSIM, 1 for identical images.
+    """
+    return _ssim(_localStats(a), _localStats(b))
+
+
+def _edges(image):
+    """Return the Sobel edge strength and orientation of an image."""
+    image = image.astype(np.float32)
+    gx = cv2.Sobel(image, cv2.CV_32F, 1, 0, ksize=3)
+    gy = cv2.Sobel(image, cv2.CV_32F, 0, 1, ksize=3)
+    strength = np.sqrt(gx * gx + gy * gy)
+    # Orientation in [-pi/2, pi/2]; flat pixels (gx = 0) count as vertical
+    with np.errstate(divide='ignore', invalid='ignore'):
+        angle = np.arctan(gy / gx)
+    angle[gx == 0] = np.pi / 2
+    return strength, angle
+
+
+def _edgePreservation(source, fused):
+    """Return Q^AF per pixel from two _edges() pairs."""
+    gs, angles = source
+    gf, anglef = fused
+    # Relative strength: the weaker edge over the stronger one
+    with np.errstate(divide='ignore', invalid='ignore'):
+        g = np.where(gs > gf, gf / gs, gs / gf)
+    g[(gs == 0) & (gf == 0)] = 0
+    a = np.subtract(angles, anglef)
+    np.abs(a, out=a)
+    a *= -2 / np.pi
+    a += 1
+    np.abs(a, out=a)
+    # Sigmoids, in place: gamma / (1 + exp(kappa * (x - sigma)))
+    for x, (gamma, kappa, sigma) in ((g, _QG), (a, _QA)):
+        x -= sigma
+        x *= kappa
+        np.exp(x, out=x)
+        x += 1
+        np.divide(gamma, x, out=x)
+    g *= a
+    return g
+
+
+def qabf(a, b, fused):
+    """
+    Return the Xydeas-Petrovic Q^AB/F edge preservation metric.
+
+    Args:
+        a (numpy.ndarray): First source, 2D.
+        b (numpy.ndarray): Second source, 2D, of the same size.
+        fused (numpy.ndarray): Fused image, 2D, of the same size.
+
+    Returns:
+        float: 0 (no source edges kept) to 1 (all kept).
+    """
+    return _qabf(_edges(a), _edges(b), _edges(fused))
+
+
+def _qabf(ea, eb, ef):
+    """Q^AB/F from three _edges() pairs."""
+    weights = ea[0] + eb[0]
+    total = weights.sum()
+    if total == 0:
+        return 0.0
+    q = _edgePreservation(ea, ef) * ea[0]
+    q += _edgePreservation(eb, ef) * eb[0]
+    return float(q.sum() / total)
+
+
+def _gray(image):
+    """Return a BGR image as grayscale, other images unchanged."""
+    if image.ndim == 3:
+        return cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    return image
+
+
+class Scorer(object):
+    """
+    Score fused images of one source pair with all METRICS.
+
+    Everything that depends only on the sources is computed once here,
+    so scoring many candidates of the same pair is cheap. Color images
+    are scored on their grayscale version.
+
+    Attributes:
+        shape (tuple): (rows, cols) of the sources.
+    """
+
+    def __init__(self, I1, I2):
+        """
+        Args:
+            I1 (numpy.ndarray): First source, uint8, grayscale or BGR.
+            I2 (numpy.ndarray): Second source, of the same size.
+        """
+        self._sources = (_gray(I1), _gray(I2))
+        self.shape = self._sources[0].shape
+        self._stats = [_localStats(s) for s in self._sources]
+        self._edges = [_edges(s) for s in self._sources]
+        self._codes = [s.ravel().astype(np.intp) * 256
+                       for s in self._sources]
+
+    def score(self, fused):
+        """
+        Compute every metric of one fused image.
+
+        Args:
+            fused (numpy.ndarray): uint8 fused image of the sources' size,
+                grayscale or BGR.
+
+        Returns:
+            dict: Metric name -> value, see METRICS.
+        """
+        fused = _gray(fused)
+        flat = fused.ravel()
+        mi = 0.0
+        for codes in self._codes:
+            joint = np.bincount(codes + flat, minlength=65536)
+            mi += _mutualInformation(joint.reshape(256, 256) / flat.size)
+        stats = _localStats(fused)
+        return {
+            'entropy': entropy(fused),
+            'sf': spatialFrequency(fused),
+            'mi': mi,
+            'ssim': (_ssim(self._stats[0], stats) +
+                     _ssim(self._stats[1], stats)) / 2,
+            'qabf': _qabf(self._edges[0], self._edges[1], _edges(fused)),
+        }
+
+
+def methodName(method):
+    """Return a printable name of a fuse rule, str or dict."""
+    if isinstance(method, dict):
+        return json.dumps(method, sort_keys=True)
+    return method
+
+
+def sweepArrays(I1, I2, wavelets=('db5',), methods=SWEEP_METHODS, level=1,
+                color=False, rankBy='qabf', keep='best'):
+    """
+    Fuse two images with every wavelet and rule and rank the results.
+
+    Args:
+        I1 (numpy.ndarray): First image, grayscale or BGR.
+        I2 (numpy.ndarray): Second image, resized to the first.
+        wavelets (sequence): Wavelet names.
+        methods (sequence): Fuse rules, str or dict, see
+            fusion_main.fusion().
+        level (int): Number of decomposition levels.
+        color (bool): Fuse in color. Metrics use the grayscale result.
+        rankBy (str): Metric to rank by, one of METRICS.
+        keep (str): Which fused images to return: 'best', 'all' or
+            'none'.
+
+    Returns:
+        list: One dict per combination, best first, with wavelet,
+            method, level, rank, every metric, seconds (fusion time) and
+            image (uint8 result, or None if not kept).
+
+    Raises:
+        ValueError: If `rankBy`, `keep` or a rule is unknown.
+    """
+    if rankBy not in METRICS:
+        raise ValueError("Unknown metric: " + str(rankBy))
+    if keep not in ('best', 'all', 'none'):
+        raise ValueError("keep must be 'best', 'all' or 'none'")
+    for method in methods:
+        fuse.bandMethods(method)  # fail before any work
+
+    if I2.shape[:2] != I1.shape[:2]:
+        I2 = cv2.resize(I2, I1.shape[1::-1])
+    scorer = Scorer(I1, I2)
+    X1 = fuse.toWorkingSpace(I1, color)
+    X2 = fuse.toWorkingSpace(I2, color)
+    shape = I1.shape[:2]
+
+    workspace = fuse.FusionWorkspace()
+    results = []
+    best = None
+    for wavelet in wavelets:
+        # One decomposition per input and wavelet, shared by every rule
+        coeffs1, slices = workspace.decompose('coeffs1', X1, wavelet, level,
+                                              np.float64)
+        coeffs2, _ = workspace.decompose('coeffs2', X2, wavelet, level,
+                                         np.float64)
+        for method in methods:
+            start = time.perf_counter()
+            image = fuse.fuseDecomposed(coeffs1, coeffs2, slices, shape,
+                                        wavelet, method, inPlace=False,
+                                        workspace=workspace)
+            seconds = time.perf_counter() - start
+            result = {'wavelet': wavelet, 'method': method, 'level': level,
+                      'seconds': seconds}
+            result.update(scorer.score(image))
+            if keep == 'all':
+                result['image'] = image
+            elif keep == 'best' and (best is None or
+                                     result[rankBy] > best[rankBy]):
+                if best is not None:
+                    best['image'] = None
+                result['image'] = image
+                best = result
+            else:
+                result['image'] = None
+            results.append(result)
+
+    results.sort(key=lambda r: r[rankBy], reverse=True)
+    for rank, result in enumerate(results, 1):
+        result['rank'] = rank
+    return results
+
+
+def sweep(img1, img2, out=None, wavelets=('db5',), methods=SWEEP_METHODS,
+          level=1, color=False, rankBy='qabf', keep='best'):
+    """
+    Sweep two image files and optionally save the best result.
+
+    Args:
+        img1 (str): File path to the first input image.
+        img2 (str): File path to the second input image.
+        out (str, optional): Write the best fused image here.
+        wavelets, methods, level, color, rankBy, keep: See sweepArrays().
+            With `out`, at least the best image is kept.
+
+    Returns:
+        list: Ranked results, see sweepArrays().
+
+    Raises:
+        IOError: If an input cannot be read or the output written.
+        ValueError: If `rankBy`, `keep` or a rule is unknown.
+    """
+    I1 = cv2.imread(img1, int(color))
+    I2 = cv2.imread(img2, int(color))
+    if I1 is None:
+        raise IOError("Cannot read image: " + img1)
+    if I2 is None:
+        raise IOError("Cannot read image: " + img2)
+    if out is not None and keep == 'none':
+        keep = 'best'
+    results = sweepArrays(I1, I2, wavelets, methods, level, color, rankBy,
+                          keep)
+    if out is not None and results:
+        fuse.writeImage(out, results[0]['image'])
+    return results
+
+
+def printTable(results):
+    """Print ranked sweep results as a table."""
+    print("%4s  %-8s %-24s %8s %8s %8s %8s %8s %8s" % (
+        'rank', 'wavelet', 'method', 'entropy', 'sf', 'mi', 'ssim', 'qabf',
+        'ms'))
+    for r in results:
+        print("%4d  %-8s %-24s %8.3f %8.2f %8.3f %8.4f %8.4f %8.1f" % (
+            r['rank'], r['wavelet'], methodName(r['method']), r['entropy'],
+            r['sf'], r['mi'], r['ssim'], r['qabf'], r['seconds'] * 1000))
+
+
+def main(argv=None):
+    """Command line entry point."""
+    parser = argparse.ArgumentParser(
+        description="Fuse a pair with several rules and wavelets and rank "
+                    "the results by fusion quality metrics.")
+    parser.add_argument('img1', help="first image")
+    parser.add_argument('img2', help="second image")
+    parser.add_argument('--wavelets', nargs='+', default=['db5'])
+    parser.add_argument('--methods', nargs='+', default=list(SWEEP_METHODS),
+                        choices=fuse.FUSION_METHODS)
+    parser.add_argument('--level', type=int, default=1,
+                        help="decomposition levels (default: 1)")
+    parser.add_argument('--color', action='store_true',
+                        help="fuse in color instead of grayscale")
+    parser.add_argument('--rank', choices=METRICS, default='qabf',
+                        help="metric to rank by (default: qabf)")
+    parser.add_argument('--best', help="write the best fused image here")
+    parser.add_argument('--json', help="write the ranked table here")
+    args = parser.parse_args(argv)
+
+    try:
+        results = sweep(args.img1, args.img2, args.best, args.wavelets,
+                        args.methods, args.level, args.color, args.rank,
+                        keep='best' if args.best else 'none')
+    except (IOError, ValueError) as e:
+        print(e, file=sys.stderr)
+        return 1
+
+    printTable(results)
+    if args.json:
+        table = [{k: v for k, v in r.items() if k != 'image'}
+                 for r in results]
+        with open(args.json, 'w') as f:
+            json.dump(table, f, indent=1)
+    if args.best:
+        print("best: %s %s -> %s" % (results[0]['wavelet'],
+                                     methodName(results[0]['method']),
+                                     args.best))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
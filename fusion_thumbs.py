@@ -0,0 +1,287 @@
+"""
+fusion_thumbs.py - Reduced-Resolution Decoding and Thumbnail Cache
+
+The GUI preview panels are a few hundred pixels high, yet decoding a 50 MP
+input at full resolution just to shrink it takes seconds and hundreds of MB.
+This module decodes previews at reduced resolution instead and keeps the
+results:
+
+- readReduced() reads the image size from the file header and asks OpenCV
+  for the largest of its 1/2, 1/4 and 1/8 reductions (IMREAD_REDUCED_*)
+  that still covers the requested height. For JPEG files the reduction
+  happens inside the decoder (DCT scaling), so full-resolution pixels are
+  never produced.
+- ThumbnailCache keeps finished thumbnails in memory (an LRU cache with a
+  byte budget, see fusion_cache.FusionCache) and on disk, keyed by file
+  identity, so reopening a file, even after a restart, costs one small
+  PNG read or nothing at all. The disk layer has a byte budget too and
+  drops its least recently used files, including those orphaned when
+  their source was edited.
+
+Example:
+    from fusion_thumbs import ThumbnailCache
+
+    thumbs = ThumbnailCache()
+    small = thumbs.thumbnail("big_scan.jpg", height=400)
+"""
+
+import hashlib
+import os
+import struct
+import threading
+
+import cv2
+
+import fusion_main as fuse
+from fusion_cache import FusionCache, fileKey
+
+
+# Default directory of the on-disk thumbnail cache
+THUMB_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'imfusion',
+                         'thumbs')
+
+# Default byte budget of the on-disk thumbnail cache
+THUMB_DISK_BYTES = 128 * 1024 * 1024
+
+# Reduced decoding flags of OpenCV by reduction factor
+_COLOR_FLAGS = {1: cv2.IMREAD_COLOR, 2: cv2.IMREAD_REDUCED_COLOR_2,
+                4: cv2.IMREAD_REDUCED_COLOR_4, 8: cv2.IMREAD_REDUCED_COLOR_8}
+_GRAY_FLAGS = {1: cv2.IMREAD_GRAYSCALE, 2: cv2.IMREAD_REDUCED_GRAYSCALE_2,
+               4: cv2.IMREAD_REDUCED_GRAYSCALE_4,
+               8: cv2.IMREAD_REDUCED_GRAYSCALE_8}
+
+# JPEG start-of-frame markers, which carry the image size
+_JPEG_SOF = set(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+
+
+def imageSize(path):
+    """
+    Read the size of a PNG or JPEG image from its header.
+
+    Args:
+        path (str): Image file path.
+
+    Returns:
+        tuple: (rows, cols), or None for other formats or unreadable
+            headers.
+    """
+    try:
+        with open(path, 'rb') as f:
+            head = f.read(24)
+            if head[:8] == b'\x89PNG\r\n\x1a\n' and head[12:16] == b'IHDR':
+                cols, rows = struct.unpack('>II', head[16:24])
+                return rows, cols
+            if head[:2] != b'\xff\xd8':
+                return None
+            # Walk the JPEG segments up to the first start of frame
+            f.seek(2)
+            while True:
+                marker = f.read(2)
+                if len(marker) < 2 or marker[0] != 0xFF:
+                    return None
+                if marker[1] == 0xFF:
+                    f.seek(-1, os.SEEK_CUR)  # fill byte
+                    continue
+                length = struct.unpack('>H', f.read(2))[0]
+                if marker[1] in _JPEG_SOF:
+                    rows, cols = struct.unpack('>xHH', f.read(5))
+                    return rows, cols
+                f.seek(length - 2, os.SEEK_CUR)
+    except (OSError, struct.error):
+        return None
+
+
+def readReduced(path, height, color=True):
+    """
+    Decode an image at the coarsest resolution that is still `height`
+    pixels high.
+
+    Args:
+        path (str): Image file path.
+        height (int): Smallest acceptable number of rows.
+        color (bool): Decode in BGR instead of grayscale.
+
+    Returns:
+        numpy.ndarray: uint8 image, 1, 2, 4 or 8 times smaller than the
+            file, never less than `height` rows unless the file is.
+
+    Raises:
+        IOError: If the image cannot be read.
+    """
+    factor = 1
+    size = imageSize(path)
+    if size is not None:
+        while factor < 8 and size[0] // (factor * 2) >= height:
+            factor *= 2
+    flags = _COLOR_FLAGS if color else _GRAY_FLAGS
+    image = cv2.imread(path, flags[factor])
+    if image is None:
+        raise IOError("Cannot read image: " + path)
+    return image
+
+
+class ThumbnailCache(object):
+    """
+    Memory- and disk-backed cache of thumbnails.
+
+    Thumbnails are keyed by file identity (see fusion_cache.fileKey()),
+    height and color, so an edited file gets a new thumbnail. The memory
+    layer is a byte-bounded FusionCache; the disk layer keeps one small
+    PNG per thumbnail, written atomically. Disk hits refresh the file's
+    modification time, and once the directory outgrows `maxDiskBytes`
+    the least recently used files are deleted, as FusionStore.evict()
+    does.
+
+    Attributes:
+        memory (FusionCache): The memory layer.
+        directory (str): Directory of the disk layer, or None for memory
+            only.
+        maxDiskBytes (int): Byte budget of the disk layer.
+    """
+
+    def __init__(self, maxBytes=64 * 1024 * 1024, directory=THUMB_DIR,
+                 maxDiskBytes=THUMB_DISK_BYTES, hashContent=False):
+        """
+        Args:
+            maxBytes (int): Memory budget. Defaults to 64 MiB.
+            directory (str, optional): Disk cache directory, created if
+                needed. None keeps thumbnails in memory only.
+            maxDiskBytes (int): Disk budget. Defaults to 128 MiB.
+            hashContent (bool): Key files by content hash, see
+                fusion_cache.fileKey().
+        """
+        self.memory = FusionCache(maxBytes, hashContent)
+        self.directory = directory
+        self.maxDiskBytes = maxDiskBytes
+        self._diskBytes = 0
+        self._diskLock = threading.Lock()
+        if directory is not None:
+            try:
+                os.makedirs(directory, exist_ok=True)
+            except OSError:
+                self.directory = None  # read-only home: memory only
+            else:
+                self.evict(maxDiskBytes)
+
+    def _diskPath(self, key):
+        name = hashlib.sha1(repr(key).encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, name + '.png')
+
+    def _diskFiles(self):
+        """Yield (mtime, size, path) for every thumbnail on disk."""
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return
+        for name in names:
+            path = os.path.join(self.directory, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue  # removed meanwhile
+            yield st.st_mtime, st.st_size, path
+
+    def evict(self, maxBytes):
+        """
+        Delete least recently used thumbnails until the disk layer fits.
+
+        Args:
+            maxBytes (int): Size, in bytes, to shrink the directory to.
+
+        Returns:
+            dict: removed (files), freed (bytes) and bytes (remaining).
+        """
+        removed = freed = total = 0
+        if self.directory is None:
+            return {'removed': 0, 'freed': 0, 'bytes': 0}
+        with self._diskLock:
+            files = sorted(self._diskFiles())
+            total = sum(size for _, size, _ in files)
+            for _, size, path in files:
+                if total <= maxBytes:
+                    break
+                try:
+                    os.unlink(path)
+                except OSError:
+                    continue
+                removed += 1
+                freed += size
+                total -= size
+            self._diskBytes = total
+        return {'removed': removed, 'freed': freed, 'bytes': total}
+
+    def _readDisk(self, diskPath):
+        """Read a thumbnail from disk and mark it as recently used."""
+        thumb = cv2.imread(diskPath, cv2.IMREAD_UNCHANGED)
+        if thumb is not None:
+            try:
+                os.utime(diskPath)
+            except OSError:
+                pass
+        return thumb
+
+    def _writeDisk(self, diskPath, thumb):
+        """Write a thumbnail to disk, pruning the layer when over budget."""
+        try:
+            fuse.writeImage(diskPath, thumb)
+            size = os.path.getsize(diskPath)
+        except (IOError, OSError, cv2.error):
+            return  # the disk layer is best effort
+        with self._diskLock:
+            self._diskBytes += size
+            over = self._diskBytes > self.maxDiskBytes
+        if over:
+            # Shrink below the budget so not every write rescans the
+            # directory
+            self.evict(self.maxDiskBytes * 3 // 4)
+
+    def stats(self):
+        """
+        Return the hit counts of the memory layer and the disk usage.
+
+        Returns:
+            dict: FusionCache.stats() of the memory layer plus diskBytes.
+        """
+        stats = self.memory.stats()
+        stats['diskBytes'] = self._diskBytes
+        return stats
+
+    def thumbnail(self, path, height=400, color=True):
+        """
+        Return an image scaled to `height` rows, from the cache if possible.
+
+        Args:
+            path (str): Image file path.
+            height (int): Thumbnail height in pixels. Images smaller than
+                that are not enlarged.
+            color (bool): BGR instead of grayscale.
+
+        Returns:
+            numpy.ndarray: uint8 thumbnail, 2D or 3-channel BGR. Treat it
+                as read-only: it is shared with the cache.
+
+        Raises:
+            IOError: If the image cannot be read.
+        """
+        key = ('thumb', fileKey(path, self.memory.hashContent), height,
+               color)
+        thumb = self.memory.get(key)
+        if thumb is not None:
+            return thumb
+
+        diskPath = None
+        if self.directory is not None:
+            diskPath = self._diskPath(key)
+            if os.path.exists(diskPath):
+                thumb = self._readDisk(diskPath)
+        if thumb is None:
+            thumb = readReduced(path, height, color)
+            rows, cols = thumb.shape[:2]
+            if rows > height:
+                width = max(1, cols * height // rows)
+                thumb = cv2.resize(thumb, (width, height),
+                                   interpolation=cv2.INTER_AREA)
+            if diskPath is not None:
+                self._writeDisk(diskPath, thumb)
+        self.memory.put(key, thumb, thumb.nbytes)
+        return thumb
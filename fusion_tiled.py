@@ -0,0 +1,210 @@
+"""
+fusion_tiled.py - Tiled, Out-of-Core Image Fusion
+
+This module fuses very large images (satellite scenes, slide scans) tile by
+tile so that peak memory is bounded by the tile size instead of the image
+size. It produces the same result as fusion_main.fusion() without ever
+holding the float64 wavelet subbands of the whole image.
+
+How it works:
+1. Both inputs are opened lazily. `.npy` files are memory-mapped, so only
+   the rows of the current tile are paged in; other formats are decoded
+   once as 8-bit grayscale (1 byte per pixel).
+2. The image is walked in square tiles. Every tile is read with a halo
+   sized to the wavelet filter length, so the DWT of the tile sees the
+   same neighbourhood as the DWT of the whole image and no seams appear.
+   At the image border the halo wraps around, matching the periodization
+   mode of the whole-image transform.
+3. Each tile is decomposed with fusion_main.decompose(), fused,
+   reconstructed and cropped back to its core. Cores are spilled to a
+   float32 scratch file while the global minimum and maximum are tracked.
+4. A cheap second pass streams the scratch file in row bands, applies the
+   global min-max normalization and writes the 8-bit output incrementally.
+
+Example:
+    import fusion_tiled
+    fusion_tiled.fusionTiled("scene_a.npy", "scene_b.npy", "fused.npy")
+"""
+
+import os
+import tempfile
+
+import cv2
+import numpy as np
+import pywt
+
+import fusion_main as fuse
+
+
+def openImage(path, shape=None):
+    """
+    Open an image for tiled reading.
+
+    `.npy` files are memory-mapped read-only and must already be 2D.
+    Any other format is decoded by OpenCV in grayscale and, if `shape` is
+    given, resized to it like fusion_main.fusion() does for image 2.
+
+    Args:
+        path (str): Path to the image.
+        shape (tuple, optional): (rows, cols) the image must have.
+
+    Returns:
+        numpy.ndarray or numpy.memmap: 2D array supporting slicing.
+
+    Raises:
+        IOError: If the image cannot be read.
+        ValueError: If a memory-mapped image is not 2D or its shape does
+            not match `shape`.
+    """
+    if path.lower().endswith('.npy'):
+        image = np.load(path, mmap_mode='r')
+        if image.ndim != 2:
+            raise ValueError("Expected a 2D array in " + path)
+        if shape is not None and image.shape != tuple(shape):
+            raise ValueError("Shape %s of %s does not match %s"
+                             % (image.shape, path, tuple(shape)))
+        return image
+
+    image = cv2.imread(path, 0)
+    if image is None:
+        raise IOError("Cannot read image: " + path)
+    if shape is not None and image.shape != tuple(shape):
+        image = cv2.resize(image, tuple(shape)[::-1])
+    return image
+
+
+def haloSize(wavelet, level=1, window=1):
+    """
+    Return the halo width, in pixels, needed around a tile.
+
+    One level of analysis followed by synthesis spreads every pixel over
+    about one filter length, and each further level doubles that reach.
+    A region fuse rule adds half its window, counted in coefficients of
+    the deepest level. The width is rounded up to a multiple of 2**level
+    so that tile origins keep the decimation phase of the whole image.
+
+    Args:
+        wavelet (str): Wavelet name, e.g. 'db5'.
+        level (int): Number of decomposition levels.
+        window (int): Neighbourhood size of the fuse rule, 1 for
+            pixelwise rules.
+
+    Returns:
+        int: Halo width in pixels.
+    """
+    step = 2 ** level
+    reach = pywt.Wavelet(wavelet).dec_len * (step - 1)
+    reach += (window // 2) * step
+    return -(-reach // step) * step
+
+
+def _readWrapped(image, y0, y1, x0, x1):
+    """Read image[y0:y1, x0:x1] as float64, wrapping around the borders."""
+    rows, cols = image.shape
+    if 0 <= y0 and y1 <= rows and 0 <= x0 and x1 <= cols:
+        return np.asarray(image[y0:y1, x0:x1], dtype=np.float64)
+    ys = np.arange(y0, y1) % rows
+    xs = np.arange(x0, x1) % cols
+    return np.asarray(image[np.ix_(ys, xs)], dtype=np.float64)
+
+
+def _fuseTile(tile1, tile2, wavelet, level, method):
+    """Fuse two co-located tiles with a multi-level DWT."""
+    coeffs1, slices = fuse.decompose(tile1, wavelet, level)
+    coeffs2, _ = fuse.decompose(tile2, wavelet, level)
+    fuse.fuseBands(coeffs1, coeffs2, slices, method)
+    return fuse.reconstruct(coeffs1, slices, wavelet)
+
+
+def _openOutput(path, shape, workdir):
+    """Create the uint8 output array, memory-mapped on disk."""
+    if path.lower().endswith('.npy'):
+        return np.lib.format.open_memmap(path, mode='w+', dtype=np.uint8,
+                                         shape=shape)
+    return np.memmap(os.path.join(workdir, 'out.u8'), mode='w+',
+                     dtype=np.uint8, shape=shape)
+
+
+def fusionTiled(img1, img2, out, tile=2048, method='mean', wavelet='db5',
+                level=1):
+    """
+    Fuse two large images tile by tile with bounded memory.
+
+    Args:
+        img1 (str): Path to the first input image (`.npy` is memory-mapped).
+        img2 (str): Path to the second input image.
+        out (str): Output path. A `.npy` output is written incrementally
+            through a memory map; any other extension is encoded by
+            OpenCV from a memory-mapped buffer once all tiles are done.
+        tile (int): Tile edge length in pixels. Rounded up to a multiple
+            of 2**level.
+        method (str or dict): Fuse rule, see fusion_main.bandMethods().
+        wavelet (str): Wavelet name. Defaults to 'db5'.
+        level (int): Number of decomposition levels. Defaults to 1.
+
+    Returns:
+        str: The output path.
+
+    Raises:
+        IOError: If an input cannot be read or the output cannot be written.
+        ValueError: If `method` is unknown or the input shapes differ.
+
+    Note:
+        Peak memory is a few float64 copies of one tile plus its halo,
+        independent of the image size. Scratch data lives in a temporary
+        directory next to `out`.
+    """
+    approx, detail = fuse.bandMethods(method)
+    window = 1
+    if approx in fuse.REGION_METHODS or detail in fuse.REGION_METHODS:
+        window = fuse.regionWindow(method)
+
+    I1 = openImage(img1)
+    I2 = openImage(img2, shape=I1.shape)
+    rows, cols = I1.shape
+
+    step = 2 ** level
+    tile = max(step, -(-tile // step) * step)
+    halo = haloSize(wavelet, level, window)
+
+    workdir = tempfile.mkdtemp(prefix='.fusion-', dir=os.path.dirname(
+        os.path.abspath(out)))
+    try:
+        # Pass 1: fuse every tile, spill the float result, track min/max
+        spill = np.memmap(os.path.join(workdir, 'fused.f32'), mode='w+',
+                          dtype=np.float32, shape=(rows, cols))
+        lo, hi = np.inf, -np.inf
+        for y0 in range(0, rows, tile):
+            y1 = min(y0 + tile, rows)
+            for x0 in range(0, cols, tile):
+                x1 = min(x0 + tile, cols)
+                t1 = _readWrapped(I1, y0 - halo, y1 + halo,
+                                  x0 - halo, x1 + halo)
+                t2 = _readWrapped(I2, y0 - halo, y1 + halo,
+                                  x0 - halo, x1 + halo)
+                fused = _fuseTile(t1, t2, wavelet, level, method)
+                core = fused[halo:halo + y1 - y0, halo:halo + x1 - x0]
+                spill[y0:y1, x0:x1] = core
+                lo = min(lo, float(core.min()))
+                hi = max(hi, float(core.max()))
+
+        # Pass 2: global min-max normalization, one row band at a time
+        output = _openOutput(out, (rows, cols), workdir)
+        scale = 255.0 / (hi - lo) if hi > lo else 0.0
+        for y0 in range(0, rows, tile):
+            y1 = min(y0 + tile, rows)
+            band = (spill[y0:y1] - np.float32(lo)) * np.float32(scale)
+            output[y0:y1] = band.astype(np.uint8)
+        del spill
+
+        if out.lower().endswith('.npy'):
+            output.flush()
+        elif not cv2.imwrite(out, output):
+            raise IOError("Cannot write image: " + out)
+        del output
+    finally:
+        for name in os.listdir(workdir):
+            os.remove(os.path.join(workdir, name))
+        os.rmdir(workdir)
+
+    return out
@@ -0,0 +1,304 @@
+"""
+fusion_vector.py - Vectorized Fusion of Many Same-Sized Pairs
+
+fusion_main.fusion() transforms one image at a time. For small images the
+time goes into Python and pywt call overhead rather than arithmetic, and a
+batch of thousands of thumbnails or video frames pays it on every pair.
+
+This module stacks pairs of the same size into (N, rows, cols) arrays and
+processes the whole stack with single calls:
+
+- one pywt.wavedec2 / waverec2 per stack, over the last two axes;
+- the fuse rule applied once per subband for all N images (region rules
+  filter each image's subband separately, as they must);
+- the min-max normalization computed per image with array reductions.
+
+Results are identical, bit for bit, to fusing every pair with
+fusion_main.fuseArrays().
+
+Stacks are cut into chunks that fit a memory budget (BATCH_BYTES by
+default), so any number of pairs can be fused. fusionMany() streams file
+pairs: it decodes them in order, groups them by size and fuses a group as
+soon as it holds one chunk.
+
+Example:
+    import fusion_vector
+    fused = fusion_vector.fuseMany(frames1, frames2, level=2)
+
+    fusion_vector.fusionMany(pairs, outs, method='maxabs')
+"""
+
+import cv2
+import numpy as np
+
+import fusion_main as fuse
+
+
+# Memory budget of one chunk, in bytes. pywt is compute bound once an
+# image is a few hundred pixels wide; stacks that stay in the CPU caches
+# are fastest, larger ones only add cache misses.
+BATCH_BYTES = 4 * 1024 * 1024
+
+# Image-sized working arrays per pair while a chunk is fused: two inputs,
+# two decompositions and the reconstruction with its temporaries
+_WORKING_COPIES = 6
+
+
+def chunkSize(shape, color=False, precision='float64',
+              maxBytes=BATCH_BYTES):
+    """
+    Return how many pairs of one size are fused at once.
+
+    Args:
+        shape (tuple): (rows, cols) of the images.
+        color (bool): Fusing in color, three planes per image.
+        precision (str): 'float64' or 'float32'.
+        maxBytes (int): Memory budget of a chunk.
+
+    Returns:
+        int: Pairs per chunk, at least 1.
+    """
+    planes = 3 if color else 1
+    itemsize = np.dtype(fuse.workingDtype(precision)).itemsize
+    perPair = _WORKING_COPIES * planes * shape[0] * shape[1] * itemsize
+    return max(1, int(maxBytes // perPair))
+
+
+def _fuseSubbands(coeffs1, coeffs2, slices, approx, detail, window):
+    """Fuse two (N, ...) packed stacks in place, one subband at a time."""
+    subbands = [slices[0][-2:]]
+    subbands += [level[key][-2:] for level in slices[1:]
+                 for key in ('da', 'ad', 'dd')]
+    for k, sub in enumerate(subbands):
+        rule = approx if k == 0 else detail
+        sub = (Ellipsis,) + tuple(sub)
+        band1, band2 = coeffs1[sub], coeffs2[sub]
+        if rule not in fuse.REGION_METHODS:
+            fuse.fuseCoeff(band1, band2, rule, out=band1)
+            continue
+        # Neighbourhoods stay inside each image: filter plane by plane
+        rows, cols = band1.shape[-2:]
+        fused = fuse.fuseCoeff(band1.reshape(-1, rows, cols),
+                               band2.reshape(-1, rows, cols), rule,
+                               window=window)
+        band1[...] = fused.reshape(band1.shape)
+
+
+def fuseStacks(stack1, stack2, wavelet='db5', level=1, method='mean',
+               color=False, precision='float64'):
+    """
+    Fuse N same-sized image pairs held as two stacks.
+
+    Args:
+        stack1 (numpy.ndarray): uint8 images, (N, rows, cols) grayscale
+            or (N, rows, cols, 3) BGR.
+        stack2 (numpy.ndarray): The second images, of the same shape.
+        wavelet (str): Wavelet name. Defaults to 'db5'.
+        level (int): Number of decomposition levels. Defaults to 1.
+        method (str or dict): Fuse rule, see fusion_main.fusion().
+        color (bool): Fuse in color, see fusion_main.fuseArrays().
+        precision (str): 'float64' or 'float32'.
+
+    Returns:
+        numpy.ndarray: N fused uint8 images, (N, rows, cols) or, with
+            `color`, (N, rows, cols, 3) BGR.
+
+    Raises:
+        ValueError: If the rule or precision is unknown or the stacks
+            differ in shape.
+    """
+    if stack1.shape != stack2.shape:
+        raise ValueError("Stacks differ in shape: %s and %s"
+                         % (stack1.shape, stack2.shape))
+    dtype = fuse.workingDtype(precision)
+    approx, detail = fuse.bandMethods(method)
+    window = fuse.regionWindow(method)
+    count, rows, cols = stack1.shape[:3]
+    if count == 1:
+        # Nothing to share: the stack would only add copies
+        return fuse.fuseArrays(stack1[0], stack2[0], wavelet, level, method,
+                               color=color, precision=precision)[None]
+
+    # Same working space and chroma shortcut as fuseArrays()
+    chroma = None
+    if color:
+        stack1 = np.stack([fuse.toWorkingSpace(i, True) for i in stack1])
+        stack2 = np.stack([fuse.toWorkingSpace(i, True) for i in stack2])
+        if fuse.chromaMethod(method) == 'mean':
+            chroma = np.add(stack1[:, 1:], stack2[:, 1:], dtype=dtype)
+            chroma *= 0.5
+            stack1, stack2 = stack1[:, 0], stack2[:, 0]
+    elif stack1.ndim == 4:
+        stack1 = np.stack([fuse.toWorkingSpace(i) for i in stack1])
+        stack2 = np.stack([fuse.toWorkingSpace(i) for i in stack2])
+
+    # One transform per stack for all N images
+    coeffs1, slices = fuse.decompose(stack1, wavelet, level, dtype)
+    coeffs2, _ = fuse.decompose(stack2, wavelet, level, dtype)
+    del stack1, stack2
+    if coeffs1.ndim == 4:
+        # Full color stacks: luma takes the rule, chroma its own
+        chromaRule = fuse.chromaMethod(method)
+        _fuseSubbands(coeffs1[:, 0], coeffs2[:, 0], slices, approx, detail,
+                      window)
+        _fuseSubbands(coeffs1[:, 1:], coeffs2[:, 1:], slices, chromaRule,
+                      chromaRule, window)
+    else:
+        _fuseSubbands(coeffs1, coeffs2, slices, approx, detail, window)
+    del coeffs2
+    image = fuse.reconstruct(coeffs1, slices, wavelet)[..., :rows, :cols]
+    del coeffs1
+
+    if chroma is not None:
+        image = np.concatenate([image[:, None], chroma], axis=1)
+    return toUint8Stack(image)
+
+
+def toUint8Stack(images):
+    """
+    Normalize a stack of reconstructed images to 8 bits, per image.
+
+    Same arithmetic as fusion_main.toUint8() for each image, done with
+    array reductions over the whole stack and in place.
+
+    Args:
+        images (numpy.ndarray): (N, rows, cols) float images, or
+            (N, 3, rows, cols) YCrCb plane stacks.
+
+    Returns:
+        numpy.ndarray: (N, rows, cols) uint8, or (N, rows, cols, 3) BGR.
+    """
+    luma = images if images.ndim == 3 else images[:, 0]
+    lo = luma.min(axis=(-2, -1), keepdims=True)
+    hi = luma.max(axis=(-2, -1), keepdims=True)
+    luma -= lo
+    luma /= np.where(hi > lo, hi - lo, 1)
+    luma *= 255
+    if images.ndim == 3:
+        return luma.astype(np.uint8)
+
+    np.clip(images[:, 1:], 0, 255, out=images[:, 1:])
+    planes = images.astype(np.uint8).transpose(0, 2, 3, 1)
+    return np.stack([cv2.cvtColor(np.ascontiguousarray(image),
+                                  cv2.COLOR_YCrCb2BGR) for image in planes])
+
+
+def fuseMany(images1, images2, wavelet='db5', level=1, method='mean',
+             color=False, precision='float64', maxBytes=BATCH_BYTES):
+    """
+    Fuse many image pairs of any sizes, grouping the same-sized ones.
+
+    Args:
+        images1 (sequence): First images, grayscale or BGR uint8.
+        images2 (sequence): Second images, each resized to its partner.
+        wavelet, level, method, color, precision: See fuseStacks().
+        maxBytes (int): Memory budget of one chunk.
+
+    Returns:
+        list: Fused uint8 images, in the order of the inputs.
+
+    Raises:
+        ValueError: If the sequences differ in length, or the rule or
+            precision is unknown.
+    """
+    if len(images1) != len(images2):
+        raise ValueError("Got %d first and %d second images"
+                         % (len(images1), len(images2)))
+    groups = {}
+    for index, image in enumerate(images1):
+        groups.setdefault((image.shape[:2], image.ndim), []).append(index)
+
+    results = [None] * len(images1)
+    for (shape, _), indices in groups.items():
+        size = chunkSize(shape, color, precision, maxBytes)
+        for start in range(0, len(indices), size):
+            chunk = indices[start:start + size]
+            stack1 = np.stack([images1[i] for i in chunk])
+            stack2 = np.stack([_matchShape(images2[i], images1[i])
+                               for i in chunk])
+            fused = fuseStacks(stack1, stack2, wavelet, level, method, color,
+                               precision)
+            for i, image in zip(chunk, fused):
+                results[i] = image
+    return results
+
+
+def _matchShape(image, reference):
+    """Resize `image` to the size of `reference`, with its channels."""
+    if image.ndim != reference.ndim:
+        if image.ndim == 2:
+            image = cv2.cvtColor(image, cv2.COLOR_GRAY2BGR)
+        else:
+            image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    if image.shape[:2] != reference.shape[:2]:
+        image = cv2.resize(image, reference.shape[1::-1])
+    return image
+
+
+def fusionMany(pairs, outs, wavelet='db5', level=1, method='mean',
+               color=False, precision='float64', maxBytes=BATCH_BYTES,
+               report=None):
+    """
+    Fuse many pairs of image files, chunk by chunk.
+
+    Pairs are decoded in order and kept in one group per image size; a
+    group is fused and written as soon as it fills a chunk, and the rest
+    at the end. A pair that cannot be read or written fails on its own.
+
+    Args:
+        pairs (sequence): (img1, img2) file path tuples.
+        outs (sequence): Output path of every pair.
+        wavelet, level, method, color, precision, maxBytes: See
+            fuseMany().
+        report (callable, optional): Called with (index, error) as every
+            pair finishes, `error` being None or an exception.
+
+    Returns:
+        list: For every pair, None on success or the exception raised.
+
+    Raises:
+        ValueError: If the rule or precision is unknown.
+    """
+    fuse.bandMethods(method)  # fail before any work
+    fuse.workingDtype(precision)
+    errors = [None] * len(pairs)
+    groups = {}
+
+    def finish(index, error):
+        errors[index] = error
+        if report is not None:
+            report(index, error)
+
+    def flush(key):
+        indices, images1, images2 = groups.pop(key)
+        try:
+            fused = fuseStacks(np.stack(images1), np.stack(images2), wavelet,
+                               level, method, color, precision)
+        except Exception as e:
+            for index in indices:
+                finish(index, e)
+            return
+        for index, image in zip(indices, fused):
+            try:
+                fuse.writeImage(outs[index], image)
+                finish(index, None)
+            except Exception as e:
+                finish(index, e)
+
+    for index, (img1, img2) in enumerate(pairs):
+        I1 = cv2.imread(img1, int(color))
+        I2 = cv2.imread(img2, int(color))
+        if I1 is None or I2 is None:
+            finish(index, IOError("Cannot read image: " +
+                                  (img1 if I1 is None else img2)))
+            continue
+        key = I1.shape
+        group = groups.setdefault(key, ([], [], []))
+        group[0].append(index)
+        group[1].append(I1)
+        group[2].append(_matchShape(I2, I1))
+        if len(group[0]) >= chunkSize(key[:2], color, precision, maxBytes):
+            flush(key)
+    for key in list(groups):
+        flush(key)
+    return errors
@@ -0,0 +1,421 @@
+#!/usr/bin/env python3
+"""
+fusion_video.py - Pipelined Video / Frame-Sequence Fusion
+
+This module fuses two synchronized frame streams, such as a visible and a
+thermal camera, frame by frame. Each source is a video file or a folder of
+numbered images, read lazily by a generator.
+
+The work is split into three stages connected by bounded queues, so that
+decoding, DWT fusion and encoding of different frames overlap on several
+cores while memory stays bounded by the queue sizes:
+
+    reader thread --> decoded queue --> fuse threads --> fused queue --> encoder
+    (both sources)                      (fuseArrays)                     (in order)
+
+Fuse threads may finish out of order; the encoder restores frame order.
+The run reports the sustained frame rate and the end-to-end latency of
+every frame, from the start of its decode to the end of its encode.
+
+Usage:
+    python3 fusion_video.py visible.mp4 thermal.mp4 fused.mp4
+    python3 fusion_video.py visible/ thermal/ fused/ --workers 4 --level 2
+
+Example:
+    import fusion_video
+    stats = fusion_video.fusionVideo("visible.mp4", "thermal.mp4",
+                                     "fused.mp4", color=True)
+    print(stats['fps'], stats['latency']['p95'])
+"""
+
+import argparse
+import os
+import queue
+import re
+import sys
+import threading
+import time
+
+import cv2
+import numpy as np
+
+import fusion_main as fuse
+
+
+# Extensions written with cv2.VideoWriter; any other output is a folder
+VIDEO_EXTENSIONS = ('.mp4', '.avi', '.mov', '.mkv')
+
+# Marks the end of a queue's stream
+_DONE = object()
+
+
+def _naturalKey(name):
+    """Sort key that orders frame2.png before frame10.png."""
+    return [int(part) if part.isdigit() else part
+            for part in re.split(r'(\d+)', name)]
+
+
+def openFrames(source, color=False):
+    """
+    Iterate over the frames of a video file or an image folder.
+
+    Args:
+        source (str): Video file, or folder whose image files are taken
+            in natural name order (frame2.png before frame10.png).
+        color (bool): Yield 3-channel BGR frames instead of grayscale.
+
+    Yields:
+        numpy.ndarray: uint8 frames.
+
+    Raises:
+        IOError: If the source cannot be opened or a frame cannot be read.
+    """
+    if os.path.isdir(source):
+        for name in sorted(os.listdir(source), key=_naturalKey):
+            path = os.path.join(source, name)
+            if not os.path.isfile(path):
+                continue
+            frame = cv2.imread(path, int(color))
+            if frame is None:
+                raise IOError("Cannot read image: " + path)
+            yield frame
+        return
+
+    capture = cv2.VideoCapture(source)
+    if not capture.isOpened():
+        raise IOError("Cannot open video: " + source)
+    try:
+        while True:
+            ok, frame = capture.read()
+            if not ok:
+                break
+            if not color:
+                frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+            yield frame
+    finally:
+        capture.release()
+
+
+def sourceFps(source, default=25.0):
+    """
+    Return the frame rate of a video file.
+
+    Args:
+        source (str): Video file or image folder.
+        default (float): Rate to use for folders and unknown rates.
+
+    Returns:
+        float: Frames per second.
+    """
+    if os.path.isdir(source):
+        return default
+    capture = cv2.VideoCapture(source)
+    fps = capture.get(cv2.CAP_PROP_FPS) if capture.isOpened() else 0
+    capture.release()
+    return fps if fps > 0 else default
+
+
+class FrameSink(object):
+    """
+    Write fused frames to a video file or a folder of numbered images.
+
+    Attributes:
+        out (str): Output video file or folder.
+        fps (float): Frame rate of a video output.
+    """
+
+    def __init__(self, out, fps=25.0, ext='.png'):
+        """
+        Args:
+            out (str): Output path. A name ending in one of
+                VIDEO_EXTENSIONS is encoded as video; anything else is a
+                folder, created if needed, receiving frame_000000.png...
+            fps (float): Frame rate of a video output.
+            ext (str): Image extension for folder output.
+        """
+        self.out = out
+        self.fps = fps
+        self.ext = ext
+        self._writer = None
+        self._video = out.lower().endswith(VIDEO_EXTENSIONS)
+        if not self._video:
+            os.makedirs(out, exist_ok=True)
+
+    def write(self, index, frame):
+        """
+        Write one frame.
+
+        Args:
+            index (int): Frame number, used for folder output names.
+            frame (numpy.ndarray): uint8 grayscale or BGR frame.
+
+        Raises:
+            IOError: If the frame cannot be written.
+        """
+        if not self._video:
+            path = os.path.join(self.out, 'frame_%06d%s' % (index, self.ext))
+            if not cv2.imwrite(path, frame):
+                raise IOError("Cannot write image: " + path)
+            return
+        if self._writer is None:
+            # Open lazily, once the frame size and channel count are known
+            fourcc = cv2.VideoWriter_fourcc(*'mp4v')
+            self._writer = cv2.VideoWriter(
+                self.out, fourcc, self.fps, (frame.shape[1], frame.shape[0]),
+                frame.ndim == 3)
+            if not self._writer.isOpened():
+                raise IOError("Cannot write video: " + self.out)
+        self._writer.write(frame)
+
+    def close(self):
+        """Finish a video output. Safe to call more than once."""
+        if self._writer is not None:
+            self._writer.release()
+            self._writer = None
+
+
+def _put(q, item, stop):
+    """Put into a bounded queue, giving up once `stop` is set."""
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+
+def _get(q, stop):
+    """Get from a queue, returning _DONE once `stop` is set."""
+    while not stop.is_set():
+        try:
+            return q.get(timeout=0.1)
+        except queue.Empty:
+            pass
+    return _DONE
+
+
+def checkPipeline(workers, queueSize):
+    """
+    Check the pipeline sizes of fuseStreams().
+
+    Without a fuse thread no frame is ever fused, and queue.Queue treats
+    a size of 0 as unbounded.
+
+    Raises:
+        ValueError: If `workers` or `queueSize` is less than 1.
+    """
+    if workers < 1:
+        raise ValueError("Need at least one fuse worker, got %d" % workers)
+    if queueSize < 1:
+        raise ValueError("Queue size must be at least 1, got %d" % queueSize)
+
+
+def fuseStreams(frames1, frames2, write, workers=2, queueSize=8,
+                wavelet='db5', level=1, method='mean', color=False,
+                report=None):
+    """
+    Fuse two frame streams through a decode / fuse / encode pipeline.
+
+    The stream ends with the shorter of the two inputs.
+
+    Args:
+        frames1 (iterable): Frames of the first stream, decoded lazily.
+        frames2 (iterable): Frames of the second stream. They are resized
+            to the first stream's frame size.
+        write (callable): Called as write(index, frame) with every fused
+            frame, in order, on the calling thread.
+        workers (int): Number of fuse threads.
+        queueSize (int): Capacity of each queue between stages. Bounds
+            memory to about 2 * queueSize frame pairs.
+        wavelet (str): Wavelet name. Defaults to 'db5'.
+        level (int): Number of decomposition levels. Defaults to 1.
+        method (str or dict): Fuse rule, see fusion_main.fusion().
+        color (bool): Fuse in color, see fusion_main.fuseArrays().
+        report (callable, optional): Called as report(index, latency)
+            after every frame is written.
+
+    Returns:
+        dict: frames, seconds, fps (sustained frames per second) and
+            latency, a dict with mean, p50, p95 and max seconds per frame.
+
+    Raises:
+        ValueError: If `workers` or `queueSize` is less than 1, or the
+            rule is unknown.
+        Exception: The first error raised by any stage, after the whole
+            pipeline has been shut down.
+    """
+    checkPipeline(workers, queueSize)
+    fuse.bandMethods(method)
+    decoded = queue.Queue(queueSize)
+    fused = queue.Queue(queueSize)
+    stop = threading.Event()
+    errors = []
+
+    def read():
+        try:
+            it1, it2 = iter(frames1), iter(frames2)
+            index = 0
+            while not stop.is_set():
+                start = time.perf_counter()
+                try:
+                    frame1 = next(it1)
+                    frame2 = next(it2)
+                except StopIteration:
+                    break
+                if not _put(decoded, (index, start, frame1, frame2), stop):
+                    return
+                index += 1
+        except BaseException as e:
+            errors.append(e)
+            stop.set()
+        finally:
+            # One end marker per fuse thread
+            for _ in range(workers):
+                _put(decoded, _DONE, stop)
+
+    def fuseFrames():
+        # Every frame has the same size: each thread reuses its buffers
+        workspace = fuse.FusionWorkspace()
+        try:
+            while True:
+                item = _get(decoded, stop)
+                if item is _DONE:
+                    break
+                index, start, frame1, frame2 = item
+                frame = fuse.fuseArrays(frame1, frame2, wavelet, level,
+                                        method, color=color,
+                                        workspace=workspace)
+                if not _put(fused, (index, start, frame), stop):
+                    return
+        except BaseException as e:
+            errors.append(e)
+            stop.set()
+        finally:
+            _put(fused, _DONE, stop)
+
+    threads = [threading.Thread(target=read, name='fusion-read')]
+    threads += [threading.Thread(target=fuseFrames, name='fusion-fuse-%d' % i)
+                for i in range(workers)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+
+    # Encode stage: write frames in order, buffering early arrivals
+    latencies = []
+    pending = {}
+    nextIndex = 0
+    running = workers
+    begin = time.perf_counter()
+    try:
+        while running:
+            item = _get(fused, stop)
+            if item is _DONE:
+                if stop.is_set():
+                    break
+                running -= 1
+                continue
+            pending[item[0]] = item
+            while nextIndex in pending:
+                index, start, frame = pending.pop(nextIndex)
+                write(index, frame)
+                latency = time.perf_counter() - start
+                latencies.append(latency)
+                if report is not None:
+                    report(index, latency)
+                nextIndex += 1
+    except BaseException as e:
+        errors.append(e)
+    finally:
+        stop.set()
+        for thread in threads:
+            thread.join()
+    elapsed = time.perf_counter() - begin
+
+    if errors:
+        raise errors[0]
+
+    if latencies:
+        lat = np.array(latencies)
+        latency = {'mean': float(lat.mean()),
+                   'p50': float(np.percentile(lat, 50)),
+                   'p95': float(np.percentile(lat, 95)),
+                   'max': float(lat.max())}
+    else:
+        latency = {'mean': 0.0, 'p50': 0.0, 'p95': 0.0, 'max': 0.0}
+    return {
+        'frames': len(latencies),
+        'seconds': elapsed,
+        'fps': len(latencies) / elapsed if elapsed > 0 else 0.0,
+        'latency': latency,
+    }
+
+
+def fusionVideo(src1, src2, out, fps=None, workers=2, queueSize=8,
+                wavelet='db5', level=1, method='mean', color=False,
+                report=None):
+    """
+    Fuse two videos or image folders into a video or image folder.
+
+    Args:
+        src1 (str): First source, video file or image folder.
+        src2 (str): Second source, frames resized to the first's.
+        out (str): Output video file or folder, see FrameSink.
+        fps (float, optional): Output frame rate. Defaults to the rate of
+            `src1`.
+        workers, queueSize, wavelet, level, method, color, report: See
+            fuseStreams().
+
+    Returns:
+        dict: Throughput and latency statistics, see fuseStreams().
+
+    Raises:
+        IOError: If a source cannot be read or the output written.
+        ValueError: If `workers` or `queueSize` is less than 1.
+    """
+    checkPipeline(workers, queueSize)
+    sink = FrameSink(out, sourceFps(src1) if fps is None else fps)
+    try:
+        return fuseStreams(openFrames(src1, color), openFrames(src2, color),
+                           sink.write, workers, queueSize, wavelet, level,
+                           method, color, report)
+    finally:
+        sink.close()
+
+
+def main(argv=None):
+    """Command line entry point."""
+    parser = argparse.ArgumentParser(
+        description="Fuse two frame streams (videos or image folders).")
+    parser.add_argument('src1', help="first video file or image folder")
+    parser.add_argument('src2', help="second video file or image folder")
+    parser.add_argument('out', help="output video file or folder")
+    parser.add_argument('-j', '--workers', type=int, default=2,
+                        help="fuse threads (default: 2)")
+    parser.add_argument('--queue', type=int, default=8,
+                        help="frames buffered between stages (default: 8)")
+    parser.add_argument('--fps', type=float, default=None,
+                        help="output frame rate (default: from src1)")
+    parser.add_argument('--level', type=int, default=1,
+                        help="decomposition levels (default: 1)")
+    parser.add_argument('--color', action='store_true',
+                        help="fuse in color instead of grayscale")
+    args = parser.parse_args(argv)
+    if args.workers < 1:
+        parser.error("--workers must be at least 1")
+    if args.queue < 1:
+        parser.error("--queue must be at least 1")
+
+    stats = fusionVideo(args.src1, args.src2, args.out, args.fps,
+                        args.workers, args.queue, level=args.level,
+                        color=args.color)
+    lat = stats['latency']
+    print("%d frames in %.2fs: %.1f fps, latency mean %.0f ms, "
+          "p95 %.0f ms, max %.0f ms" % (
+              stats['frames'], stats['seconds'], stats['fps'],
+              lat['mean'] * 1000, lat['p95'] * 1000, lat['max'] * 1000))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,446 @@
+#!/usr/bin/env python3
+"""
+fusion_volume.py - Streaming Fusion of 3D Volumes
+
+fusion_main.fusion() reads single 8-bit 2D images, which throws away the
+12 to 16 bits of CT and MRI data and handles one slice at a time. This
+module fuses whole volumes, such as a CT and an MRI series of the same
+patient, without ever loading them:
+
+- Inputs are opened lazily. `.npy` files and raw files are memory-mapped;
+  multipage TIFFs (e.g. 16-bit stacks) are read one page at a time.
+- The output volume is written through a memory map, so only the slices
+  being fused are held in memory and peak memory does not grow with the
+  depth of the volume.
+- Values keep their bit depth: slices are fused in float32 (exact for
+  16-bit data), then rounded and clipped to the output type. There is no
+  min-max stretch, so CT numbers and intensities keep their meaning.
+
+Modes:
+    - 'slice': Every slice pair is fused with the 2D DWT like an image,
+      and every 2D fuse rule is available.
+    - '3d': A 3D DWT (pywt.wavedecn) also separates detail across slices.
+      The volume is walked in slabs of `slab` slices, each read with a
+      halo of neighbouring slices as in fusion_tiled.py, so the result
+      equals a transform of the whole volume while memory is bounded by
+      the slab. The depth is first padded to a multiple of 2**level by
+      repeating the last slice, on every path, so the result does not
+      depend on `slab`; checkSlabs() measures that. Only pixelwise rules
+      apply.
+
+Volume 2 must have as many slices as volume 1; its slices are resized to
+the size of volume 1's if needed.
+
+Usage:
+    python3 fusion_volume.py ct.npy mri.npy fused.npy --method maxabs --level 2
+    python3 fusion_volume.py ct.raw mri.raw fused.npy --shape 300 512 512 --dtype int16
+    python3 fusion_volume.py ct.tif mri.tif fused.npy --mode 3d --slab 32
+
+Example:
+    import fusion_volume
+    fusion_volume.fusionVolume("ct.npy", "mri.npy", "fused.npy",
+                               method={'approx': 'mean', 'detail': 'maxabs'},
+                               level=2)
+"""
+
+import argparse
+import os
+import sys
+
+import cv2
+import numpy as np
+import pywt
+
+import fusion_main as fuse
+from fusion_tiled import haloSize
+
+
+# Ways of fusing a volume understood by fusionVolume()
+VOLUME_MODES = ('slice', '3d')
+
+# Extensions opened as multipage TIFF
+TIFF_EXTENSIONS = ('.tif', '.tiff')
+
+
+class TiffVolume(object):
+    """
+    Read-only, page-by-page view of a multipage TIFF as a 3D array.
+
+    Indexing with an int or a slice decodes only the pages asked for
+    (OpenCV 4.5 or later; older versions decode every page once and keep
+    them).
+
+    Attributes:
+        path (str): TIFF file path.
+        shape (tuple): (pages, rows, cols).
+        dtype (numpy.dtype): Pixel type, e.g. uint16.
+        ndim (int): Always 3.
+    """
+
+    def __init__(self, path):
+        """
+        Args:
+            path (str): Multipage grayscale TIFF file.
+
+        Raises:
+            IOError: If the file cannot be read.
+        """
+        self.path = path
+        self._pages = None
+        count = cv2.imcount(path)
+        if count < 1:
+            raise IOError("Cannot read image: " + path)
+        first = self._read(0, 1)[0]
+        self.shape = (count,) + first.shape[:2]
+        self.dtype = first.dtype
+        self.ndim = 3
+
+    def _read(self, start, count):
+        """Decode `count` pages from `start` on."""
+        flags = cv2.IMREAD_ANYDEPTH | cv2.IMREAD_GRAYSCALE
+        if self._pages is None:
+            try:
+                ok, pages = cv2.imreadmulti(self.path, start, count,
+                                            flags=flags)
+            except (TypeError, cv2.error):
+                # No page ranges in this OpenCV: decode everything once
+                ok, self._pages = cv2.imreadmulti(self.path, flags=flags)
+                pages = self._pages[start:start + count]
+        else:
+            ok, pages = True, self._pages[start:start + count]
+        if not ok or len(pages) != count:
+            raise IOError("Cannot read image: " + self.path)
+        return pages
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(self.shape[0])
+            pages = self._read(start, max(0, stop - start))[::step]
+            return np.stack(pages) if pages else \
+                np.empty((0,) + self.shape[1:], self.dtype)
+        index = range(self.shape[0])[index]  # negative and bounds
+        return self._read(index, 1)[0]
+
+
+def openVolume(path, shape=None, dtype=None):
+    """
+    Open a 3D volume for slice-wise reading without loading it.
+
+    Args:
+        path (str): `.npy` file (memory-mapped), multipage TIFF (read page
+            by page) or raw file (memory-mapped, needs `shape` and
+            `dtype`).
+        shape (tuple, optional): (slices, rows, cols) of a raw file.
+        dtype (str, optional): Element type of a raw file, e.g. 'uint16'
+            or '<i2'.
+
+    Returns:
+        numpy.memmap or TiffVolume: Array-like of shape (slices, rows,
+            cols), indexable by slice number.
+
+    Raises:
+        IOError: If the file cannot be read.
+        ValueError: If the volume is not 3D, or a raw file's shape or
+            type is missing or does not match its size.
+    """
+    lower = path.lower()
+    if lower.endswith('.npy'):
+        volume = np.load(path, mmap_mode='r')
+    elif lower.endswith(TIFF_EXTENSIONS):
+        return TiffVolume(path)
+    else:
+        if shape is None or dtype is None:
+            raise ValueError("Raw volume %s needs a shape and a dtype" % path)
+        shape = tuple(int(n) for n in shape)
+        expected = int(np.prod(shape)) * np.dtype(dtype).itemsize
+        if not os.path.exists(path):
+            raise IOError("Cannot read volume: " + path)
+        if os.path.getsize(path) != expected:
+            raise ValueError("%s holds %d bytes, shape %s of %s needs %d" % (
+                path, os.path.getsize(path), shape, dtype, expected))
+        volume = np.memmap(path, dtype=dtype, mode='r', shape=shape)
+    if volume.ndim != 3:
+        raise ValueError("Expected a 3D volume in " + path)
+    return volume
+
+
+def _readSlice(volume, index, shape, dtype):
+    """Read one slice as `dtype`, resized to (rows, cols) `shape`."""
+    image = np.asarray(volume[index], dtype=dtype)
+    if image.shape != tuple(shape):
+        image = cv2.resize(image, tuple(shape)[::-1])
+    return image
+
+
+def _readSlab(volume, z0, z1, shape, dtype, padded):
+    """
+    Read slices z0..z1 - 1 of the volume padded to `padded` slices.
+
+    Slices past the end repeat the last one, and indices wrap around
+    both ends of the padded volume, as the periodized transform does.
+    """
+    last = volume.shape[0] - 1
+    slab = np.empty((z1 - z0,) + tuple(shape), dtype)
+    for k, z in enumerate(range(z0, z1)):
+        slab[k] = _readSlice(volume, min(z % padded, last), shape, dtype)
+    return slab
+
+
+def toOutputType(values, dtype):
+    """
+    Round and clip fused values into an output element type, in place.
+
+    Args:
+        values (numpy.ndarray): Float values; overwritten for integer
+            types.
+        dtype (numpy.dtype): Output type.
+
+    Returns:
+        numpy.ndarray: `values` as `dtype`.
+    """
+    dtype = np.dtype(dtype)
+    if dtype.kind in 'iu':
+        info = np.iinfo(dtype)
+        np.rint(values, out=values)
+        np.clip(values, info.min, info.max, out=values)
+    return values.astype(dtype)
+
+
+def _fuseSlices(vol1, vol2, output, method, wavelet, level, dtype,
+                report):
+    """Fuse two volumes slice by slice with the 2D DWT."""
+    shape = vol1.shape[1:]
+    workspace = fuse.FusionWorkspace()
+    for z in range(vol1.shape[0]):
+        slice1 = _readSlice(vol1, z, shape, dtype)
+        slice2 = _readSlice(vol2, z, shape, dtype)
+        coeffs1, slices = workspace.decompose('coeffs1', slice1, wavelet,
+                                              level, dtype)
+        coeffs2, _ = workspace.decompose('coeffs2', slice2, wavelet, level,
+                                         dtype)
+        fuse.fuseBands(coeffs1, coeffs2, slices, method)
+        fused = fuse.reconstruct(coeffs1, slices, wavelet)
+        output[z] = toOutputType(fused[:shape[0], :shape[1]], output.dtype)
+        if report is not None:
+            report(z + 1, vol1.shape[0])
+
+
+def _fuseSlab(slab1, slab2, method, wavelet, level):
+    """Fuse two slabs with a 3D DWT; returns the reconstructed slab."""
+    approx, detail = fuse.bandMethods(method)
+    mode = 'periodization'
+    coeffs1 = pywt.wavedecn(slab1, wavelet, mode, level)
+    coeffs2 = pywt.wavedecn(slab2, wavelet, mode, level)
+    fuse.fuseCoeff(coeffs1[0], coeffs2[0], approx, out=coeffs1[0])
+    for bands1, bands2 in zip(coeffs1[1:], coeffs2[1:]):
+        for key, band in bands1.items():
+            fuse.fuseCoeff(band, bands2[key], detail, out=band)
+    return pywt.waverecn(coeffs1, wavelet, mode)
+
+
+def _fuseSlabs(vol1, vol2, output, method, wavelet, level, dtype, slab,
+               report):
+    """Fuse two volumes with a 3D DWT over a sliding slab window."""
+    depth = vol1.shape[0]
+    shape = vol1.shape[1:]
+    step = 2 ** level
+    # Every level halves the depth exactly, so the periodized transform
+    # of a slab never pads, and slabs agree with the whole volume
+    padded = -(-depth // step) * step
+    slab = max(step, -(-slab // step) * step)
+    halo = haloSize(wavelet, level)
+    if padded <= slab:
+        # The whole volume fits in one slab: no halo needed
+        slab, halo = padded, 0
+
+    for z0 in range(0, depth, slab):
+        z1 = min(z0 + slab, padded)
+        slab1 = _readSlab(vol1, z0 - halo, z1 + halo, shape, dtype, padded)
+        slab2 = _readSlab(vol2, z0 - halo, z1 + halo, shape, dtype, padded)
+        fused = _fuseSlab(slab1, slab2, method, wavelet, level)
+        del slab1, slab2
+        z1 = min(z1, depth)
+        core = fused[halo:halo + z1 - z0, :shape[0], :shape[1]]
+        output[z0:z1] = toOutputType(core, output.dtype)
+        if report is not None:
+            report(z1, depth)
+
+
+def checkSlabs(vol1, vol2, method='mean', wavelet='db5', level=1, slab=32,
+               precision='float32', shape=None, dtype=None):
+    """
+    Compare slab-wise 3D fusion against one transform of the whole volume.
+
+    Both results are kept in memory as float64 before rounding, so this
+    is meant for volumes that fit in memory.
+
+    Args:
+        vol1, vol2, method, wavelet, level, slab, precision, shape,
+            dtype: See fusionVolume().
+
+    Returns:
+        float: Largest absolute difference between the two results.
+
+    Raises:
+        IOError: If an input cannot be read.
+        ValueError: If the rule or precision is unknown, or the volumes
+            differ in depth.
+    """
+    working = fuse.workingDtype(precision)
+    volume1 = openVolume(vol1, shape, dtype)
+    volume2 = openVolume(vol2, shape, dtype)
+    if volume2.shape[0] != volume1.shape[0]:
+        raise ValueError("Volumes have %d and %d slices" % (
+            volume1.shape[0], volume2.shape[0]))
+    slabbed = np.empty(volume1.shape)
+    whole = np.empty(volume1.shape)
+    _fuseSlabs(volume1, volume2, slabbed, method, wavelet, level, working,
+               slab, None)
+    _fuseSlabs(volume1, volume2, whole, method, wavelet, level, working,
+               volume1.shape[0], None)
+    return float(np.abs(slabbed - whole).max())
+
+
+def fusionVolume(vol1, vol2, out, mode='slice', method='mean',
+                 wavelet='db5', level=1, slab=32, precision='float32',
+                 shape=None, dtype=None, outDtype=None, report=None):
+    """
+    Fuse two 3D volumes with bounded memory and full bit depth.
+
+    Args:
+        vol1 (str): First volume, see openVolume().
+        vol2 (str): Second volume with the same number of slices.
+        out (str): Output path. `.npy` gets an npy header; any other
+            name is written as raw data of shape (slices, rows, cols).
+            The file appears only once complete.
+        mode (str): 'slice' or '3d', see VOLUME_MODES.
+        method (str or dict): Fuse rule, see fusion_main.fusion(). Mode
+            '3d' takes pixelwise rules only.
+        wavelet (str): Wavelet name. Defaults to 'db5'.
+        level (int): Number of decomposition levels. Defaults to 1.
+        slab (int): Slices transformed at once in mode '3d', rounded up
+            to a multiple of 2**level. Memory grows with it.
+        precision (str): Working precision, 'float32' (default, exact
+            for 16-bit data) or 'float64'.
+        shape (tuple, optional): (slices, rows, cols) of raw inputs.
+        dtype (str, optional): Element type of raw inputs.
+        outDtype (str, optional): Output element type. Defaults to that
+            of volume 1.
+        report (callable, optional): Called with (done, total) slices
+            after every slice or slab.
+
+    Returns:
+        str: The output path.
+
+    Raises:
+        IOError: If an input cannot be read or the output written.
+        ValueError: If the mode, rule or precision is unknown, a region
+            rule is used in mode '3d', or the volumes differ in depth.
+    """
+    if mode not in VOLUME_MODES:
+        raise ValueError("Unknown volume mode: " + str(mode))
+    approx, detail = fuse.bandMethods(method)
+    if mode == '3d' and (approx in fuse.REGION_METHODS or
+                         detail in fuse.REGION_METHODS):
+        raise ValueError("Region rules need 2D subbands; use mode 'slice'")
+    working = fuse.workingDtype(precision)
+
+    volume1 = openVolume(vol1, shape, dtype)
+    volume2 = openVolume(vol2, shape, dtype)
+    if volume2.shape[0] != volume1.shape[0]:
+        raise ValueError("Volumes have %d and %d slices" % (
+            volume1.shape[0], volume2.shape[0]))
+    outDtype = np.dtype(volume1.dtype if outDtype is None else outDtype)
+
+    # Written under a temporary name and renamed once complete
+    tmp = fuse.tempPath(out)
+    try:
+        if out.lower().endswith('.npy'):
+            output = np.lib.format.open_memmap(tmp, mode='w+',
+                                               dtype=outDtype,
+                                               shape=volume1.shape)
+        else:
+            output = np.memmap(tmp, mode='w+', dtype=outDtype,
+                               shape=volume1.shape)
+        if mode == 'slice':
+            _fuseSlices(volume1, volume2, output, method, wavelet, level,
+                        working, report)
+        else:
+            _fuseSlabs(volume1, volume2, output, method, wavelet, level,
+                       working, slab, report)
+        output.flush()
+        del output
+        os.replace(tmp, out)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+        raise
+    return out
+
+
+def main(argv=None):
+    """Command line entry point."""
+    parser = argparse.ArgumentParser(
+        description="Fuse two 3D volumes (.npy, raw or multipage TIFF).")
+    parser.add_argument('vol1', help="first volume")
+    parser.add_argument('vol2', help="second volume")
+    parser.add_argument('out', help="output volume (.npy or raw)")
+    parser.add_argument('--mode', choices=VOLUME_MODES, default='slice',
+                        help="2D per slice or 3D over slabs (default: slice)")
+    parser.add_argument('--method', choices=fuse.FUSION_METHODS,
+                        default='mean', help="fuse rule (default: mean)")
+    parser.add_argument('--wavelet', default='db5')
+    parser.add_argument('--level', type=int, default=1,
+                        help="decomposition levels (default: 1)")
+    parser.add_argument('--slab', type=int, default=32,
+                        help="slices per 3D transform (default: 32)")
+    parser.add_argument('--precision', choices=fuse.PRECISIONS,
+                        default='float32',
+                        help="working precision (default: float32)")
+    parser.add_argument('--shape', type=int, nargs=3,
+                        metavar=('SLICES', 'ROWS', 'COLS'),
+                        help="shape of raw inputs")
+    parser.add_argument('--dtype', help="element type of raw inputs, "
+                                        "e.g. uint16 or int16")
+    parser.add_argument('--out-dtype',
+                        help="output element type (default: that of vol1)")
+    parser.add_argument('--check', action='store_true',
+                        help="with --mode 3d, write nothing; report the "
+                             "largest difference between --slab slabs and "
+                             "one whole-volume transform (needs memory for "
+                             "the volume)")
+    args = parser.parse_args(argv)
+
+    if args.check:
+        if args.mode != '3d':
+            parser.error("--check applies to --mode 3d")
+        try:
+            diff = checkSlabs(args.vol1, args.vol2, args.method,
+                              args.wavelet, args.level, args.slab,
+                              args.precision, args.shape, args.dtype)
+        except (IOError, ValueError) as e:
+            print(e, file=sys.stderr)
+            return 1
+        print("largest difference to the whole-volume transform: %g" % diff)
+        return 0
+
+    def report(done, total):
+        print("\r%d/%d slices" % (done, total), end='')
+        sys.stdout.flush()
+
+    try:
+        fusionVolume(args.vol1, args.vol2, args.out, args.mode, args.method,
+                     args.wavelet, args.level, args.slab, args.precision,
+                     args.shape, args.dtype, args.out_dtype, report)
+    except (IOError, ValueError) as e:
+        print(e, file=sys.stderr)
+        return 1
+    print("\nwritten to " + args.out)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -21,19 +21,221 @@ Usage:
 """
 
 import sys
-import os
-from PyQt5.QtCore import pyqtSlot
-from PyQt5 import QtCore, QtGui, QtWidgets
-from PyQt5.QtWidgets import (
-    QApplication, QWidget, QPushButton, QInputDialog,
-    QLineEdit, QFileDialog, QHBoxLayout, QLabel, QTextEdit
-)
-from PyQt5.QtGui import QIcon, QPixmap
-import webbrowser
+from PyQt5.QtCore import pyqtSlot, pyqtSignal
+from PyQt5 import QtCore, QtWidgets
+from PyQt5.QtWidgets import QFileDialog
+from PyQt5.QtGui import QPixmap, QImage
 import fusion_main as fuse
+from fusion_cache import FusionCache
+from fusion_morph import Morph, morphPath
+from fusion_preview import ProgressiveFusion, previewScale
+from fusion_store import resultKey
+from fusion_thumbs import ThumbnailCache
+from fusion_video import FrameSink
+import numpy as np
+import os
 import cv2
 
 
+# Height, in pixels, of the images shown in the preview panels
+PANEL_HEIGHT = 400
+
+# Length and frame rate of the sequence saved in Face Morphing mode
+MORPH_FRAMES = 30
+MORPH_FPS = 15.0
+
+
+def arrayToQImage(array):
+    """
+    Wrap a uint8 image array in a QImage without copying its pixels.
+
+    The QImage points at the array's own buffer, so the array is attached
+    to the returned image to keep that buffer alive.
+
+    Args:
+        array (numpy.ndarray): 2D grayscale or 3-channel BGR uint8 image.
+
+    Returns:
+        QImage: Image sharing memory with `array`.
+    """
+    array = np.ascontiguousarray(array)
+    height, width = array.shape[:2]
+    if array.ndim == 2:
+        fmt = QImage.Format_Grayscale8
+    else:
+        fmt = QImage.Format_BGR888
+    image = QImage(array.data, width, height, array.strides[0], fmt)
+    image.ndarray = array
+    return image
+
+
+class FusionCancelled(Exception):
+    """Raised inside a worker to abandon a fusion that was replaced."""
+
+
+class WorkerSignals(QtCore.QObject):
+    """
+    Signals emitted by a FusionWorker.
+
+    QRunnable is not a QObject, so the worker owns one of these to talk to
+    the GUI. Emitting from the pool thread queues the call onto the main
+    thread. Every signal carries the job id so stale results can be
+    recognised and dropped.
+
+    Signals:
+        progress (int, int, str): Job id, percent done and stage name.
+        finished (int, object): Job id and a result dict with keys job,
+            preview, image and path (see FusionWorker).
+        failed (int, str): Job id and error message.
+    """
+
+    progress = pyqtSignal(int, int, str)
+    finished = pyqtSignal(int, object)
+    failed = pyqtSignal(int, str)
+
+
+class FusionWorker(QtCore.QRunnable):
+    """
+    Run one fusion step on a QThreadPool thread.
+
+    Without a `job` the worker decodes and decomposes both inputs and
+    computes a reduced-resolution preview scaled for the GUI panel. With
+    the ProgressiveFusion `job` of an earlier preview it computes the full
+    resolution result from the same decompositions and saves it, or with
+    `morphFrames` a morph sequence between the two inputs. Every stage is
+    reported through the worker's signals, and cancel() makes it
+    stop at the next stage boundary.
+
+    Attributes:
+        PREVIEW_STAGES (tuple): Stage names of a preview, in order.
+        SAVE_STAGES (tuple): Stage names of a full fusion, in order.
+        MORPH_STAGES (tuple): Stage names of a morph sequence, in order.
+    """
+
+    PREVIEW_STAGES = ('read', 'decompose', 'fuse', 'reconstruct',
+                      'normalize')
+    SAVE_STAGES = ('fuse', 'reconstruct', 'normalize', 'save')
+    MORPH_STAGES = ('morph',)
+
+    def __init__(self, jobId, fileName1, fileName2, cache,
+                 previewHeight=PANEL_HEIGHT, job=None, morphFrames=None):
+        """
+        Args:
+            jobId (int): Identifier echoed back in every signal.
+            fileName1 (str): Path to the first input image.
+            fileName2 (str): Path to the second input image.
+            cache (FusionCache): Cache of decoded images and
+                decompositions shared between workers.
+            previewHeight (int): Height of the preview array.
+            job (ProgressiveFusion, optional): Previewed fusion to finish
+                at full resolution and save.
+            morphFrames (int, optional): With a `job`, save a morph
+                sequence of this many frames built from the job's
+                decompositions instead of the fused image.
+        """
+        super(FusionWorker, self).__init__()
+        self.jobId = jobId
+        self.fileName1 = fileName1
+        self.fileName2 = fileName2
+        self.cache = cache
+        self.previewHeight = previewHeight
+        self.job = job
+        self.morphFrames = morphFrames
+        if job is None:
+            self.stages = self.PREVIEW_STAGES
+        elif morphFrames:
+            self.stages = self.MORPH_STAGES
+        else:
+            self.stages = self.SAVE_STAGES
+        self.cancelled = False
+        self.signals = WorkerSignals()
+
+    def cancel(self):
+        """Ask the worker to stop at the next stage boundary."""
+        self.cancelled = True
+
+    def stage(self, name):
+        """Report that a stage starts, or stop if cancelled."""
+        if self.cancelled:
+            raise FusionCancelled()
+        percent = 100 * self.stages.index(name) // len(self.stages)
+        self.signals.progress.emit(self.jobId, percent, name)
+
+    def run(self):
+        """Perform the fusion step. Called by QThreadPool."""
+        try:
+            if self.job is None:
+                result = self.runPreview()
+            elif self.morphFrames:
+                result = self.runMorph()
+            else:
+                result = self.runSave()
+        except FusionCancelled:
+            return
+        except Exception as e:
+            self.signals.failed.emit(self.jobId, str(e))
+            return
+        self.signals.progress.emit(self.jobId, 100, 'done')
+        self.signals.finished.emit(self.jobId, result)
+
+    def runPreview(self):
+        """Decompose both inputs and fuse a reduced-resolution preview."""
+        self.stage('read')
+        shape = self.cache.image(self.fileName1).shape
+        job = ProgressiveFusion(
+            self.fileName1, self.fileName2, cache=self.cache,
+            scale=previewScale(shape, self.previewHeight),
+            progress=self.stage)
+        small = job.preview(progress=self.stage)
+
+        # Scale the panel preview here, not on the GUI thread
+        height, width = small.shape
+        previewWidth = max(1, width * self.previewHeight // height)
+        preview = cv2.resize(small, (previewWidth, self.previewHeight),
+                             interpolation=cv2.INTER_AREA)
+        return {'job': job, 'preview': preview, 'image': None, 'path': None}
+
+    def runSave(self):
+        """Fuse at full resolution and save the result."""
+        # Named after the inputs and parameters, so saving the same
+        # fusion twice keeps one file
+        key = resultKey(self.fileName1, self.fileName2, {
+            'wavelet': self.job.wavelet, 'level': self.job.level,
+            'method': self.job.method})
+        path = self.job.save(fuse.outputPath(key), progress=self.stage)
+        return {'job': self.job, 'preview': None, 'image': self.job.full(),
+                'path': path}
+
+    def runMorph(self):
+        """Save a morph sequence from the preview's decompositions."""
+        job = self.job
+        key = resultKey(self.fileName1, self.fileName2, {
+            'wavelet': job.wavelet, 'level': job.level})
+        path = morphPath(key, self.morphFrames)
+        self.stage('morph')
+        morph = Morph(job.coeffs1, job.coeffs2, job.slices, job.shape,
+                      job.wavelet)
+        middle = None
+        sink = FrameSink(path, MORPH_FPS)
+        try:
+            frames = morph.frames(self.morphFrames, threads=2)
+            for index, frame in enumerate(frames):
+                if self.cancelled:
+                    raise FusionCancelled()
+                sink.write(index, frame)
+                if index == self.morphFrames // 2:
+                    middle = frame
+                self.signals.progress.emit(
+                    self.jobId, 100 * index // self.morphFrames, 'morph')
+        except BaseException:
+            sink.close()
+            if os.path.exists(path):
+                os.unlink(path)  # no partial sequences
+            raise
+        sink.close()
+        return {'job': job, 'preview': None, 'image': middle, 'path': path}
+
+
 class Ui_Dialog(object):
     """
     Main UI class for the Imfusion application.
@@ -47,7 +249,11 @@ class Ui_Dialog(object):
     Attributes:
         fileName1 (str): Path to the first selected image.
         fileName2 (str): Path to the second selected image.
+        mode (str): Selected operation, or '' before one is chosen.
+        fusionJob (ProgressiveFusion): Fusion shown as a preview, finished
+            at full resolution on Save.
         generatedImage (str): Path to the generated fused image.
+        generatedArray (numpy.ndarray): Pixels of the generated image.
     """
 
     def setupUi(self, Dialog):
@@ -68,9 +274,26 @@ class Ui_Dialog(object):
         Dialog.setObjectName("Dialog")
         Dialog.resize(958, 775)
 
-        # Initialize file path storage
+        # Initialize file path and operation storage
         self.fileName1 = ''
         self.fileName2 = ''
+        self.mode = ''
+
+        # Fusion runs on a worker pool so the window stays responsive;
+        # two threads let a replacement job start while a cancelled one
+        # winds down
+        self.threadPool = QtCore.QThreadPool()
+        self.threadPool.setMaxThreadCount(2)
+        self.fusionWorker = None
+        self.fusionJobId = 0
+        self.fusionJob = None
+
+        # Decoded inputs and their decompositions, reused between clicks
+        self.fusionCache = FusionCache()
+
+        # Input panel thumbnails, decoded at reduced resolution and kept
+        # in memory and on disk, so reselecting a file is instant
+        self.thumbnails = ThumbnailCache()
 
         # Create main vertical layout container
         self.verticalLayoutWidget = QtWidgets.QWidget(Dialog)
@@ -125,6 +348,11 @@ class Ui_Dialog(object):
         self.pushButton_3.setObjectName("pushButton_3")
         self.horizontalLayout.addWidget(self.pushButton_3)
 
+        # Save Image button - fuses at full resolution and saves
+        self.pushButton_4 = QtWidgets.QPushButton(self.verticalLayoutWidget)
+        self.pushButton_4.setObjectName("pushButton_4")
+        self.horizontalLayout.addWidget(self.pushButton_4)
+
         # Exit button - closes the application
         self.pushButton = QtWidgets.QPushButton(self.verticalLayoutWidget)
         self.pushButton.setObjectName("pushButton")
@@ -132,6 +360,13 @@ class Ui_Dialog(object):
 
         self.verticalLayout.addLayout(self.horizontalLayout)
 
+        # Progress bar for the running fusion
+        self.progressBar = QtWidgets.QProgressBar(self.verticalLayoutWidget)
+        self.progressBar.setObjectName("progressBar")
+        self.progressBar.setRange(0, 100)
+        self.progressBar.setValue(0)
+        self.verticalLayout.addWidget(self.progressBar)
+
         # Label for generated image title
         self.label = QtWidgets.QLabel(Dialog)
         self.label.setGeometry(QtCore.QRect(460, 20, 151, 18))
@@ -162,8 +397,9 @@ class Ui_Dialog(object):
         self.label_6.setGeometry(QtCore.QRect(500, 440, 151, 18))
         self.label_6.setObjectName("label_6")
 
-        # Initialize generated image path storage
+        # Initialize generated image storage
         self.generatedImage = ''
+        self.generatedArray = None
 
         # Set text content for all UI elements
         self.retranslateUi(Dialog)
@@ -182,9 +418,15 @@ class Ui_Dialog(object):
         # Connect Exit button
         self.pushButton.clicked.connect(self.on_click)
 
+        # Connect Insert button (once; the options only pick the mode)
+        self.pushButton_2.clicked.connect(self.insertImages)
+
         # Connect Generate Image button
         self.pushButton_3.clicked.connect(self.openGenImage)
 
+        # Connect Save Image button
+        self.pushButton_4.clicked.connect(self.saveGenImage)
+
         # Connect radio buttons for operation selection
         self.radioButton1.clicked.connect(self.options_1)
         self.radioButton2.clicked.connect(self.options_2)
@@ -196,53 +438,62 @@ class Ui_Dialog(object):
         """
         Handle Image Mixing option selection.
 
-        Updates status text and connects Insert button to image dialogs.
+        Updates status text and enables the Insert button.
         """
+        self.mode = 'mixing'
         self.textBrowser_2.setText("You selected Image Mixing")
-        self.pushButton_2.clicked.connect(self.openFileNameDialog_1)
-        self.pushButton_2.clicked.connect(self.openFileNameDialog_2)
 
     def options_2(self):
         """
         Handle Face Morphing option selection.
 
-        Updates status text and connects Insert button to image dialogs.
+        Generate Image previews the halfway blend; Save Image writes a
+        MORPH_FRAMES-frame morph sequence from image 1 to image 2.
         """
+        self.mode = 'morphing'
         self.textBrowser_2.setText("You selected Face Morphing ")
-        self.pushButton_2.clicked.connect(self.openFileNameDialog_1)
-        self.pushButton_2.clicked.connect(self.openFileNameDialog_2)
 
     def options_3(self):
         """
         Handle Image Restoration option selection.
 
-        Updates status text and connects Insert button to image dialogs.
+        Updates status text and enables the Insert button.
         """
+        self.mode = 'restoration'
         self.textBrowser_2.setText("You selected Image restoration")
-        self.pushButton_2.clicked.connect(self.openFileNameDialog_1)
-        self.pushButton_2.clicked.connect(self.openFileNameDialog_2)
 
-    def showImg(self, img):
+    @pyqtSlot()
+    def insertImages(self):
         """
-        Display an image in a popup window.
-
-        Creates a new window with the specified image displayed.
+        Handle Insert button click.
 
-        Args:
-            img (str): Path to the image file to display.
+        Opens the dialogs for both input images once an operation mode
+        has been selected.
         """
-        hbox = QHBoxLayout(self)
-        pixmap = QPixmap(img)
+        if not self.mode:
+            self.textBrowser_2.setText("Please select an operation first")
+            return
+        self.openFileNameDialog_1()
+        self.openFileNameDialog_2()
 
-        lbl = QLabel(self)
-        lbl.setPixmap(pixmap)
+    def showInput(self, fileName, panel):
+        """
+        Show an input image in one of the preview panels.
 
-        hbox.addWidget(lbl)
-        self.setLayout(hbox)
+        The image is decoded at reduced resolution and cached by
+        self.thumbnails, so even very large inputs load quickly.
 
-        self.move(300, 200)
-        self.setWindowTitle('Image with PyQt')
-        self.show()
+        Args:
+            fileName (str): Path to the selected image.
+            panel (QLabel): Preview panel to show it in.
+        """
+        self.label.setText("Attached image: " + fileName)
+        try:
+            thumb = self.thumbnails.thumbnail(fileName, PANEL_HEIGHT)
+        except IOError as e:
+            self.textBrowser_2.setText(str(e))
+            return
+        panel.setPixmap(QPixmap.fromImage(arrayToQImage(thumb)))
 
     @pyqtSlot()
     def openFileNameDialog_1(self):
@@ -262,17 +513,7 @@ class Ui_Dialog(object):
             options=options
         )
         if self.fileName1:
-            print(self.fileName1)
-            self.label.setText("Attached image: " + self.fileName1)
-
-            # Load and scale image for preview
-            pixmap = QPixmap(self.fileName1)
-            pixmap2 = pixmap.scaledToWidth(100)
-            pixmap3 = pixmap.scaledToHeight(400)
-            self.label_3.setPixmap(pixmap3)
-
-            # Show in popup window
-            self.showImg(self.fileName1)
+            self.showInput(self.fileName1, self.label_3)
 
     @pyqtSlot()
     def openFileNameDialog_2(self):
@@ -292,17 +533,7 @@ class Ui_Dialog(object):
             options=options
         )
         if self.fileName2:
-            print(self.fileName2)
-            self.label.setText("Attached image: " + self.fileName2)
-
-            # Load and scale image for preview
-            pixmap = QPixmap(self.fileName2)
-            pixmap2 = pixmap.scaledToWidth(100)
-            pixmap3 = pixmap.scaledToHeight(400)
-            self.label_5.setPixmap(pixmap3)
-
-            # Show in popup window
-            self.showImg(self.fileName2)
+            self.showInput(self.fileName2, self.label_5)
 
     @pyqtSlot()
     def openFileNameDialog_3(self):
@@ -321,38 +552,121 @@ class Ui_Dialog(object):
             options=options
         )
         if self.fileName1:
-            print(self.fileName1)
-            self.label.setText("Attached image: " + self.fileName1)
+            self.showInput(self.fileName1, self.label_3)
 
-            # Load and scale image for preview
-            pixmap = QPixmap(self.fileName1)
-            pixmap2 = pixmap.scaledToWidth(100)
-            pixmap3 = pixmap.scaledToHeight(400)
-            self.label_3.setPixmap(pixmap3)
+    @pyqtSlot()
+    def openGenImage(self):
+        """
+        Generate a preview of the fused image from the two selected inputs.
 
-            # Show in popup window
-            self.showImg(self.fileName1)
+        Starts a reduced-resolution fusion on the worker pool and returns
+        immediately. The full resolution is only computed by Save Image.
+        A fusion that is still running is cancelled and replaced by the
+        new one. The result is shown by onFusionFinished().
+        """
+        if not self.fileName1 or not self.fileName2:
+            self.textBrowser_2.setText("Please insert two images first")
+            return
+        self.fusionJob = None
+        self.startWorker(FusionWorker(self.fusionJobId + 1, self.fileName1,
+                                      self.fileName2, self.fusionCache))
 
     @pyqtSlot()
-    def openGenImage(self):
+    def saveGenImage(self):
         """
-        Generate the fused image from the two selected input images.
+        Fuse the previewed images at full resolution and save the result.
 
-        Calls the fusion algorithm with both selected images and displays
-        the result in the generated image preview panel.
+        The full fusion reuses the decompositions computed for the
+        preview and runs on the worker pool like openGenImage(). In Face
+        Morphing mode a morph sequence is saved instead, built from the
+        same decompositions.
+        """
+        if self.fusionJob is None:
+            self.textBrowser_2.setText("Please generate an image first")
+            return
+        morphFrames = MORPH_FRAMES if self.mode == 'morphing' else None
+        self.startWorker(FusionWorker(self.fusionJobId + 1, self.fileName1,
+                                      self.fileName2, self.fusionCache,
+                                      job=self.fusionJob,
+                                      morphFrames=morphFrames))
+
+    def startWorker(self, worker):
         """
-        # Perform image fusion
-        self.generatedImage = fuse.fusion(self.fileName1, self.fileName2)
-        print(self.generatedImage)
+        Run a FusionWorker, cancelling the one still in flight.
 
-        # Load and scale fused image for preview
-        pixmap = QPixmap(self.generatedImage)
-        pixmap2 = pixmap.scaledToWidth(100)
-        pixmap3 = pixmap.scaledToHeight(400)
-        self.label_2.setPixmap(pixmap3)
+        Args:
+            worker (FusionWorker): Worker whose job id is one above the
+                current one.
+        """
+        # Cancel the fusion still in flight, its result is no longer wanted
+        if self.fusionWorker is not None:
+            self.fusionWorker.cancel()
+
+        self.fusionJobId = worker.jobId
+        worker.signals.progress.connect(self.onFusionProgress)
+        worker.signals.finished.connect(self.onFusionFinished)
+        worker.signals.failed.connect(self.onFusionFailed)
+        self.fusionWorker = worker
+        self.progressBar.setValue(0)
+        self.threadPool.start(worker)
+
+    @pyqtSlot(int, int, str)
+    def onFusionProgress(self, jobId, percent, stage):
+        """
+        Show the progress of the current fusion.
 
-        # Show in popup window
-        self.showImg(self.generatedImage)
+        Args:
+            jobId (int): Job that reported progress.
+            percent (int): Percentage done.
+            stage (str): Name of the stage that just started.
+        """
+        if jobId != self.fusionJobId:
+            return
+        self.progressBar.setValue(percent)
+        self.progressBar.setFormat(stage + " %p%")
+
+    @pyqtSlot(int, object)
+    def onFusionFinished(self, jobId, result):
+        """
+        Display a finished fusion step.
+
+        A preview goes to the generated image panel. A saved full
+        resolution result is only reported: the panel already shows its
+        preview.
+
+        Args:
+            jobId (int): Job that finished.
+            result (dict): Result of the FusionWorker.
+        """
+        if jobId != self.fusionJobId:
+            return
+        self.fusionWorker = None
+        self.fusionJob = result['job']
+
+        if result['preview'] is not None:
+            # Wrap the pre-scaled preview pixels for the panel
+            preview = arrayToQImage(result['preview'])
+            self.label_2.setPixmap(QPixmap.fromImage(preview))
+
+        if result['path'] is not None:
+            self.generatedArray = result['image']
+            self.generatedImage = result['path']
+            self.textBrowser_2.setText("Saved " + self.generatedImage)
+
+    @pyqtSlot(int, str)
+    def onFusionFailed(self, jobId, message):
+        """
+        Report a failed fusion.
+
+        Args:
+            jobId (int): Job that failed.
+            message (str): Error description.
+        """
+        if jobId != self.fusionJobId:
+            return
+        self.fusionWorker = None
+        self.progressBar.setValue(0)
+        self.textBrowser_2.setText("Fusion failed: " + message)
 
     @pyqtSlot()
     def on_click(self):
@@ -408,6 +722,7 @@ class Ui_Dialog(object):
         # Button labels
         self.pushButton_2.setText(_translate("Dialog", "Insert"))
         self.pushButton_3.setText(_translate("Dialog", "Generate Image"))
+        self.pushButton_4.setText(_translate("Dialog", "Save Image"))
         self.pushButton.setText(_translate("Dialog", "Exit"))
 
         # Image panel labels
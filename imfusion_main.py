@@ -20,12 +20,10 @@ Requirements:
     - opencv-python
     - pywt
     - numpy
-    - matplotlib
 """
 
 import sys
-from PyQt5 import QtCore, QtGui, QtWidgets
-from PyQt5 import uic
+from PyQt5 import QtWidgets
 from imfusion import Ui_Dialog
 
 